@@ -1,45 +1,218 @@
-import json
 import os
-import copy
+import collections
+import time
 import logging
 import asyncio
-import subprocess
-import xmltodict
+import aioredis
+import api.metrics as metrics
+import api.tracing as tracing
+import api.initImageStore as initImageStore
+import api.previewCache as previewCache
 import api.skinDetector as skinDetector
+import api.gpuTelemetry as gpuTelemetry
+import api.stableDiffusionComunicator as stableDiffusionComunicator
 
+from api.jobBroadcaster import JOB_CHANNEL
+
+from concurrent.futures import ProcessPoolExecutor
 from sentry_sdk import capture_exception
 from config import settings
 
 # TODO proper error detection
-# TODO set paths in config
 
 class backgroundWorkerClass():
-    smi = None
-    working = False
-    workingUuid = None
-    jobCanceled = False
+    """ Runs one backendWorker for every configured Stable Diffusion
+        backend, all of them taking jobs from the same queue. Everything
+        the API needs to know about them is kept in redis, so any replica
+        can answer for workers running in another process or host. """
+    gpus = {}
+    gpuFetched = 0
+    telemetry = None
 
-    def __init__(self, redis, client) -> None:
+    def __init__(self, redis, queue, store, results, costs, initImages, previews) -> None:
         self.redis = redis
-        self.client = client
+        self.queue = queue
+        self.store = store
+        self.workers = []
+        self.skinPool = None
+        # Streams that find the GPU info stale at the same time fetch it once
+        self.gpuLock = asyncio.Lock()
+        if settings.workers.enabled:
+            if settings.reporting.calculate_skin:
+                self.skinPool = ProcessPoolExecutor(max_workers=settings.reporting.skin_workers)
+            self.workers = [backendWorker(name=f"{settings.workers.name}-sd{index}", url=url, redis=redis, 
+                                          queue=queue, store=store, results=results, costs=costs, 
+                                          initImages=initImages, previews=previews, skinPool=self.skinPool)
+                            for index, url in enumerate(settings.sd_urls or [settings.sd_url])]
     
     async def init(self):
+        if not self.workers:
+            return
+
+        await self.queue.migrate(self.store)
+        for worker in self.workers:
+            await worker.init()
+        asyncio.create_task(self.reapTask())
+
+        if source := gpuTelemetry.createSource(settings.telemetry.source, settings.telemetry.gpu_index):
+            self.telemetry = gpuTelemetry.gpuTelemetry(self.redis, source, isBusy=lambda: self.working)
+            asyncio.create_task(self.telemetry.task())
+
+    async def close(self):
+        for worker in self.workers:
+            await worker.close()
+        if self.skinPool:
+            self.skinPool.shutdown(wait=False, cancel_futures=True)
+
+    @property
+    def working(self) -> bool:
+        """ Whether a worker of this process is running a job """
+        return any(worker.working for worker in self.workers)
+
+    async def reap(self) -> int:
+        """ Put the jobs of workers that stopped sending heartbeats (on any
+            replica) back in the queue, returns how many """
+        names = {name.decode() for name in await self.redis.redis.smembers("dreaming-workers")}
+        names.update(await self.queue.inflight())
+        reaped = 0
+        for name in names:
+            if await self.redis.redis.exists(f"dreaming-worker-{name}"):
+                continue
+            reaped += await self.queue.recover(name)
+            await self.redis.redis.srem("dreaming-workers", name)
+            await self.redis.redis.delete(f"dreaming-status-{name}", f"dreaming-working-{name}")
+            logging.warning(f"Worker {name} stopped sending heartbeats, put its jobs back in the queue")
+        return reaped
+
+    async def reapTask(self):
+        while True:
+            await asyncio.sleep(settings.workers.reap_interval)
+            try:
+                await self.reap()
+            except Exception as e:
+                logging.error(f"Failed to reap dead workers ({e})")
+
+    async def workingUuids(self) -> list:
+        """ Every job that is being worked on, by any replica """
+        return [uuid for uuids in (await self.queue.inflight()).values() for uuid in uuids]
+
+    async def cancel(self, uuid) -> bool:
+        """ Ask the worker running uuid to cancel it, returns False if no worker is """
+        if uuid not in await self.workingUuids():
+            return False
+        await self.redis.setex(f"dreaming-cancel-{uuid}", True, settings.redisKeys.working_exp)
+        return True
+
+    async def status(self) -> list:
+        """ Returns the heartbeat and current status of every live worker """
+        workers = []
+        for name in sorted(await self.redis.redis.smembers("dreaming-workers")):
+            name = name.decode()
+            if heartbeat := await self.redis.get(f"dreaming-worker-{name}"):
+                heartbeat['status'] = await self.redis.get(f"dreaming-status-{name}")
+                workers.append(heartbeat)
+        return workers
+
+    async def getGpus(self) -> dict:
+        """ Returns the last GPU telemetry of every host, cached locally for a bit """
+        if time.time() - self.gpuFetched <= settings.telemetry.interval:
+            return self.gpus
+        async with self.gpuLock:
+            if time.time() - self.gpuFetched <= settings.telemetry.interval:
+                return self.gpus
+            hosts = sorted(host.decode() for host in await self.redis.redis.smembers("dreaming-gpus"))
+            values = await self.redis.redis.mget([f"dreaming-gpu-{host}" for host in hosts]) if hosts else []
+            self.gpus = {host: self.redis.codec.decode(value) for host, value in zip(hosts, values) if value}
+            self.gpuFetched = time.time()
+        return self.gpus
+
+    async def getGpu(self, host=None) -> dict:
+        """ Returns the GPU telemetry of host. By default that of this replica,
+            or of any host when this one has no GPU. """
+        gpus = await self.getGpus()
+        if host:
+            return gpus.get(host)
+        return gpus.get(settings.workers.name) or next(iter(gpus.values()), None)
+
+class backendWorker():
+    """ Takes jobs from the queue and runs them on a single backend """
+
+    def __init__(self, name, url, redis, queue, store, results, costs, initImages, previews, skinPool) -> None:
+        self.name = name
+        self.store = store
+        self.results = results
+        self.costs = costs
+        self.initImages = initImages
+        self.previews = previews
+        self.skinPool = skinPool
+        self.statsTasks = set()
+        self.redis = redis
+        self.queue = queue
+        self.client = stableDiffusionComunicator.communicator(url=url)
+        self.working = False
+        self.workingUuid = None
+        self.jobCanceled = False
+        self.statusKey = f"dreaming-status-{name}"
+        self.workingKey = f"dreaming-working-{name}"
+
+        self.heartbeatKey = f"dreaming-worker-{name}"
+
+    async def init(self):
+        await self.client.init()
+        await self.redis.redis.sadd("dreaming-workers", self.name)
+        asyncio.create_task(self.heartbeatTask())
         asyncio.create_task(self.workerTask())
-        asyncio.create_task(self.nvidiaSmiTask())
 
-    def getNvidiaSmi(self):
-        try:
-            info = subprocess.check_output(["/usr/bin/nvidia-smi", "-x", "-q"], stderr=subprocess.STDOUT)
-            return xmltodict.parse(info.decode("utf8"))
-        except Exception as e:
-            logging.error(f"Failed to execute nvidia-smi! ({e})")
-            return f"Executing nvidia-smi failed: {e}"
+    async def close(self):
+        if self.statsTasks:
+            await asyncio.wait(self.statsTasks)
+        await self.redis.redis.srem("dreaming-workers", self.name)
+        await self.redis.delete(self.heartbeatKey)
+        await self.client.close()
 
-    async def jobprocessRespline(self, respLine, job):
-        """ Process a line as returned by lstein's Stable Diffusion api"""
-        await self.redis.setex("dreaming-status", {"uuid": job['uuid'], "status": respLine}, 
-                                settings.redisKeys.working_exp)
+    async def heartbeatTask(self):
+        """ Let the other replicas know this worker is alive and what it is doing """
+        attempt = 0
+        while True:
+            try:
+                # A worker that was taken for dead comes back
+                await self.redis.redis.sadd("dreaming-workers", self.name)
+                await self.redis.setex(self.heartbeatKey, {"name": self.name, "url": self.client.url, 
+                    "uuid": self.workingUuid if self.working else None, "heartbeat": time.time()}, 
+                    settings.workers.heartbeat * 3)
+            except aioredis.RedisError as e:
+                # Without a heartbeat the reaper puts our jobs back in the queue, try again soon
+                await self.backoff(attempt, "send a heartbeat", e, cap=settings.workers.heartbeat)
+                attempt += 1
+                continue
+            attempt = 0
+            await asyncio.sleep(settings.workers.heartbeat)
+
+    def stageSave(self, pipe, job, fields, expire):
+        """ Add storing the changed fields of the job and letting everyone
+            watching it know it changed to a pipeline """
+        self.store.stageUpdate(pipe, job['uuid'], {field: job[field] for field in fields}, expire)
+        pipe.publish(f"{JOB_CHANNEL}{job['uuid']}", self.redis.codec.encode(
+            {key: value for key, value in job.items() if key not in ("initimg", "raw")}))
+
+    async def fail(self, jobs, error):
+        """ End jobs that can't be run as canceled, so nobody waits on them forever """
+        jobs = [job for job in jobs if job.get("event") not in ("done", "canceled")]
+        async with self.redis.redis.pipeline(transaction=False) as pipe:
+            pipe.delete(self.workingKey)
+            for job in jobs:
+                job.update({"event": "canceled", "error": error})
+                self.stageSave(pipe, job, ["event", "error"], 3000)
+                metrics.registry.inc("dreaming_jobs_total", initiator=job.get("initiator"), 
+                                     backend=self.name, event="failed")
+            await pipe.execute()
+        for job in jobs:
+            if "fingerprint" in job:
+                await self.results.release(job['fingerprint'], job['uuid'])
 
+    def jobprocessRespline(self, respLine, job) -> list:
+        """ Process a line as returned by lstein's Stable Diffusion api,
+            returns the fields of the job it changed """
         # Update the job dictionary with the current state
         if "event" in respLine and respLine['event'] == "step":
             job['event'] = "generating"
@@ -49,97 +222,295 @@ class backgroundWorkerClass():
             job['event'] = respLine['event']
             job['step'] = 0
 
+        fields = ["event", "step"]
         if "progress_images" in job and job['progress_images'] \
             and "url" in respLine and respLine['url'] != None:
             job['url'] = os.path.basename(respLine['url'])
+            fields.append("url")
 
-        await self.redis.setex(f"dreaming-job-{job['uuid']}", 
-            job, settings.redisKeys.job_exp)
-        return job
+        return [field for field in fields if field in job]
 
-    async def execute(self, job):
+    async def flushProgress(self, jobs, respLine, changed, cancelKeys, preview=None) -> int:
+        """ Write the worker status, the changed fields of every job and the
+            new preview (step, data) if there is one in one round trip, checking
+            for cancels on the way. Returns how many jobs of the batch are canceled. """
+        async with self.redis.redis.pipeline(transaction=False) as pipe:
+            pipe.setex(self.statusKey, settings.redisKeys.working_exp, 
+                       self.redis.codec.encode({"uuid": jobs[0]['uuid'], "status": respLine}))
+            for job in jobs:
+                if preview:
+                    step, data = preview
+                    self.previews.stage(pipe, job['uuid'], data, settings.redisKeys.job_exp)
+                    job['preview'] = self.previews.url(job['uuid'], step)
+                    changed[job['uuid']].add("preview")
+                if changed[job['uuid']]:
+                    self.stageSave(pipe, job, changed[job['uuid']], settings.redisKeys.job_exp)
+                    changed[job['uuid']] = set()
+            pipe.exists(*cancelKeys)
+            *_, canceled = await pipe.execute()
+        return canceled
+
+    async def execute(self, jobs):
+        """ Run a job, or a batch of jobs that only differ in their random
+            seed as one backend request. Progress goes to every job of the
+            batch, each result to the next job that doesn't have one yet. """
+        job = jobs[0]
         self.working = True
         self.workingUuid = job['uuid']
         
-        results = {}
-        promptBuffer = []
+        results = {batchJob['uuid']: {} for batchJob in jobs}
+        changed = {batchJob['uuid']: set() for batchJob in jobs}
+        waiting = collections.deque(jobs)
+        # Keep only as many raw events as we are going to store
+        promptBuffer = collections.deque(maxlen=settings.reporting.raw_events_last 
+                                         if settings.reporting.raw_events == "last" else None)
+        cancelKeys = [f"dreaming-cancel-{batchJob['uuid']}" for batchJob in jobs]
+        # Intermediate images lstein wrote for this request, and the newest one without a preview yet
+        intermediates = []
+        pendingPreview = None
         
-        logging.info(f"Working on: {job['prompt']} ({job['uuid']})")
-        await self.redis.setex("dreaming-working", 
+        logging.info(f"[{self.name}] Working on: {job['prompt']} ({', '.join(results)})")
+        await self.redis.setex(self.workingKey, 
             job['uuid'], settings.redisKeys.working_exp)
         
-        # Remove parameters that we don't need
-        request_parameters = copy.deepcopy(job)
-        for parameter in ['event', 'uuid', 'initiator', 'timestamp']:
-            request_parameters.pop(parameter)
+        # Only send what the backend takes, jobs carry plenty of our own fields
+        request_parameters = stableDiffusionComunicator.backendOptions(job)
+        if len(jobs) > 1:
+            request_parameters['batch'] = len(jobs)
+
+        # Jobs only carry a reference to their init image, read it just before sending
+        initimg = request_parameters.get('initimg')
+        if initImageStore.isReference(initimg):
+            request_parameters['initimg'] = await self.initImages.load(initimg)
+            if not request_parameters['initimg']:
+                # Without it the backend would make an image from the prompt alone
+                logging.warning(f"[{self.name}] Init image {initimg} of {job['uuid']} is gone")
+                await self.fail(jobs, "The init image of this job is gone, upload it again")
+                return
+
+        startTime = lastStep = time.time()
+        lastFlush = 0
+        firstStep = None
+        stepTimes = []
+        upscaleStart = upscaleTime = None
+        for batchJob in jobs:
+            if "timestamp" in batchJob:
+                metrics.registry.observe("dreaming_queue_wait_seconds", startTime - batchJob['timestamp'],
+                                         initiator=batchJob.get("initiator"))
         
         async for respLine in self.client.generate(**request_parameters):
-            promptBuffer.append(respLine)
-            job = await self.jobprocessRespline(respLine, job)
+            if respLine.get("event") == "step":
+                if lastStep == startTime:
+                    firstStep = time.time() - startTime
+                    metrics.registry.observe("dreaming_first_step_seconds", firstStep,
+                                             initiator=job.get("initiator"), backend=self.name)
+                else:
+                    stepTimes.append(time.time() - lastStep)
+                    metrics.registry.observe("dreaming_step_seconds", stepTimes[-1], backend=self.name)
+                lastStep = time.time()
+            elif respLine.get("event") == "upscaling-started":
+                upscaleStart = time.time()
+            elif respLine.get("event") == "upscaling-done" and upscaleStart:
+                upscaleTime = time.time() - upscaleStart
+
+            if settings.reporting.raw_events != "off":
+                promptBuffer.append(respLine)
+            for batchJob in jobs:
+                changed[batchJob['uuid']].update(self.jobprocessRespline(respLine, batchJob))
+            if settings.previews.enabled and job.get("progress_images") and respLine.get("url") \
+                and respLine.get("event") == "step":
+                intermediates.append(os.path.join(settings.paths.outputs, "intermediates", os.path.basename(respLine['url'])))
+                pendingPreview = (intermediates[-1], respLine['step'])
              
-            if "event" in respLine and respLine['event'] == "result":
-                results = respLine
-            
+            if "event" in respLine and respLine['event'] == "result" and waiting:
+                results[waiting.popleft()['uuid']] = respLine
+
+            # Steps that follow each other quickly are written together,
+            # anything else (upscaling, results, errors) right away
+            if respLine.get("event") != "step" or time.time() - lastFlush >= settings.workers.min_update_interval:
+                # Only the newest intermediate gets a preview, the ones in between are skipped
+                preview = None
+                if pendingPreview:
+                    path, step = pendingPreview
+                    pendingPreview = None
+                    if data := await self.previews.render(path):
+                        preview = (step, data)
+                    if settings.previews.delete_intermediates and len(intermediates) > 1:
+                        await asyncio.get_event_loop().run_in_executor(None, previewCache.removeFiles, intermediates[:-1])
+                        del intermediates[:-1]
+
+                with tracing.span("job.save"):
+                    canceled = await self.flushProgress(jobs, respLine, changed, cancelKeys, preview)
+                lastFlush = time.time()
+
+                # A batch is only canceled on the backend once every job in it is
+                if not self.jobCanceled:
+                    self.jobCanceled = canceled == len(jobs)
+
             if self.jobCanceled:
-                job['event'] = "cancelled"
+                for batchJob in jobs:
+                    batchJob['event'] = "cancelled"
                 await self.client.cancelJob()
 
-        job['event'] = "done"
-        job['raw'] = promptBuffer
-        job['result'] = results
-        
-        if self.jobCanceled or not "url" in job['result']:
-            logging.warn(f"Job failed or canceled: {job['prompt']} ({job['uuid']})")
-            job['event'] = "canceled"
+        metrics.registry.observe("dreaming_generation_seconds", time.time() - startTime,
+                                 initiator=job.get("initiator"), backend=self.name)
 
-        await self.redis.setex(f"dreaming-job-{job['uuid']}", job, 3000) # Job result will expire in a hour
-        
-        # Set back to default
-        await self.redis.delete("dreaming-working")
-        await self.redis.set("dreaming-status", {"status": "Awaiting prompts."})
+        # The result replaces the previews, the redis copy expires with the job
+        for batchJob in jobs:
+            self.previews.drop(batchJob['uuid'])
+        if settings.previews.delete_intermediates and intermediates:
+            await asyncio.get_event_loop().run_in_executor(None, previewCache.removeFiles, intermediates)
+
+        canceled = set()
+        if len(jobs) > 1:
+            async with self.redis.redis.pipeline(transaction=False) as pipe:
+                for key in cancelKeys:
+                    pipe.exists(key)
+                canceled = {batchJob['uuid'] for batchJob, exists in zip(jobs, await pipe.execute()) if exists}
+
+        # The final state of every job and resetting the worker go in one round trip
+        async with self.redis.redis.pipeline(transaction=False) as pipe:
+            for job in jobs:
+                job['event'] = "done"
+                job['result'] = results[job['uuid']]
+                # Steps that weren't written yet go along
+                finalFields = ["event", "result", *(changed[job['uuid']] - {"event"})]
+
+                if settings.reporting.raw_events == "last":
+                    job['raw'] = list(promptBuffer)
+                    finalFields.append("raw")
+                elif settings.reporting.raw_events == "compressed":
+                    self.store.stageRaw(pipe, job['uuid'], list(promptBuffer), settings.reporting.raw_events_exp)
+                
+                if self.jobCanceled or job['uuid'] in canceled or not "url" in job['result']:
+                    logging.warn(f"Job failed or canceled: {job['prompt']} ({job['uuid']})")
+                    job['event'] = "canceled"
+
+                self.stageSave(pipe, job, finalFields, 3000) # Job result will expire in a hour
+                metrics.registry.inc("dreaming_jobs_total", initiator=job.get("initiator"), 
+                                     backend=self.name, event=job['event'])
+
+            # Set back to default
+            pipe.delete(self.workingKey, *cancelKeys)
+            pipe.set(self.statusKey, self.redis.codec.encode({"status": "Awaiting prompts."}))
+            await pipe.execute()
+
+        if stepTimes and not self.jobCanceled and "url" in results[jobs[0]['uuid']]:
+            # The median leaves out the gaps between the iterations of a batch
+            step = sorted(stepTimes)[len(stepTimes) // 2]
+            await self.costs.learn(jobs[0], overhead=max(0.0, firstStep - step), step=step, postprocess=upscaleTime)
+
+        for job in jobs:
+            if "fingerprint" in job:
+                if job['event'] == "done":
+                    await self.results.put(job['fingerprint'], job['result'])
+                await self.results.release(job['fingerprint'], job['uuid'])
         
-        if not "result" in job['result']:
-            return
+        for job in jobs:
+            if not "url" in job['result']:
+                continue
+
+            # Score the image in the background, so the next job can already start
+            task = asyncio.create_task(self.reportStats(job, self.client.currentJobTime / len(jobs)))
+            self.statsTasks.add(task)
+            task.add_done_callback(self.statsTasks.discard)
+
+            logging.info(f"[{self.name}] Finished working on: {job['prompt']} ({job['uuid']})")
+
+    async def gatherBatch(self, job) -> list:
+        """ Claim queued jobs that can run in the same request as job, waiting
+            up to batching.window for the batch to fill up """
+        jobs = [job]
+        if not settings.batching.enabled or not job.get("batch"):
+            return jobs
+
+        jobs += await self.queue.claim(self.name, job['batch'], settings.batching.max_size - len(jobs))
+        if len(jobs) < settings.batching.max_size and settings.batching.window > 0:
+            await asyncio.sleep(settings.batching.window)
+            jobs += await self.queue.claim(self.name, job['batch'], settings.batching.max_size - len(jobs))
+
+        if len(jobs) > 1:
+            logging.info(f"[{self.name}] Running {len(jobs)} jobs as one batch")
+        return jobs
 
+    async def reportStats(self, job, processtime):
         # detect skin if enabled
         skinAmount = 0
         if settings.reporting.calculate_skin == True:
-            skinAmount = skinDetector.skinDetect(image=os.path.join("/home/nurds/stable-diffusion/outputs/img-samples", os.path.basename(job['result']['url']))).detect()
-        
-        # Stats
-        statsJson = {
-            "skin": round(skinAmount, 3), 
-            "charlen": len(job['prompt']),
-            "processtime": round(self.client.currentJobTime, 3), 
-            }
+            if len(self.statsTasks) > settings.reporting.skin_max_pending:
+                logging.warning(f"[{self.name}] Skin detection can't keep up, skipping {job['uuid']}")
+            else:
+                try:
+                    with tracing.span("skin", uuid=job['uuid']):
+                        skinAmount = await asyncio.get_event_loop().run_in_executor(self.skinPool, skinDetector.detectSkin,
+                            os.path.join(settings.paths.outputs, os.path.basename(job['result']['url'])),
+                            settings.reporting.skin_max_size)
+                except Exception as e:
+                    logging.error(f"Skin detection failed for {job['uuid']}: {e}")
+                    capture_exception(e)
         
-        await self.redis.set("sd-stats", json.dumps(statsJson))
+        # Stats, /telegraf reports the last ones
+        metrics.registry.set("dreaming_last_skin", round(skinAmount, 3))
+        metrics.registry.set("dreaming_last_charlen", len(job['prompt']))
+        metrics.registry.set("dreaming_last_processtime_seconds", round(processtime, 3))
 
-        logging.info(f"Finished working on: {job['prompt']} ({job['uuid']})")
+    async def backoff(self, attempt, what, error, cap=None):
+        """ Wait before trying again after redis failed, longer every attempt """
+        delay = min(settings.workers.retry_backoff * 2 ** attempt, cap or settings.workers.retry_backoff_cap)
+        logging.error(f"[{self.name}] Failed to {what} ({error!r}), retrying in {delay}s")
+        await asyncio.sleep(delay)
 
-    async def nvidiaSmiTask(self):
-        logging.info("Starting nvidia-smi background task")
+    async def finish(self):
+        """ Forget the jobs of this worker in the queue. This has to succeed before
+            the next job is taken, or they would be put back in the queue later. """
+        attempt = 0
         while True:
-            self.smi = await asyncio.get_event_loop().run_in_executor(None, self.getNvidiaSmi)
-            await asyncio.sleep(1)
+            try:
+                return await self.queue.finish(self.name)
+            except aioredis.RedisError as e:
+                await self.backoff(attempt, "finish its jobs", e)
+                attempt += 1
 
     async def workerTask(self):
-        logging.info("Starting background worker task")
-        await self.redis.set("dreaming-status", {"status": "Awaiting prompts."})
+        logging.info(f"Starting background worker task for {self.name} ({self.client.url})")
 
-        # Grab a job from the queue
+        # Grab a job from the queue, waiting for one to arrive. Redis going
+        # away for a while only pauses the worker.
+        recovering = True
+        attempt = 0
         while True:
-            if job := await self.redis.rpop("sd-queue"):
+            try:
+                if recovering:
+                    await self.redis.set(self.statusKey, {"status": "Awaiting prompts."})
+                    # Jobs left unfinished by an earlier run, or taken just
+                    # before the connection broke, go back in the queue
+                    await self.queue.recover(self.name)
+                    recovering = False
+                job = await self.queue.take(self.name, settings.queue.block_timeout)
+                attempt = 0
+            except aioredis.RedisError as e:
+                recovering = True
+                await self.backoff(attempt, "take a job", e)
+                attempt += 1
+                continue
+
+            if job:
+                jobs = [job]
                 try:
-                    await self.execute(job)
+                    with tracing.jobTrace(job, "execute"):
+                        jobs = await self.gatherBatch(job)
+                        await self.execute(jobs)
                 except Exception as e:
                     import traceback
                     traceback.print_exc()
-                    logging.error(f"An exception occured in the background thread! {e}")
+                    logging.error(f"An exception occured in the background thread of {self.name}! {e}")
                     capture_exception(e)
+                    try:
+                        await self.fail(jobs, "The job failed on the worker")
+                    except Exception as e:
+                        logging.error(f"Failed to mark the jobs of {self.name} as failed ({e})")
                 finally:
                     self.working = False
                     self.workingUuid = ""
                     self.jobCanceled = False
-
-            await asyncio.sleep(0.100)
+                    await self.finish()
@@ -0,0 +1,76 @@
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# msgpack never uses this byte and json text can't start with it, so a
+# value starting with it is msgpack and anything else is json
+MSGPACK_MARKER = b"\xc1"
+
+def dumps(value) -> str:
+    """ Encode as json text, for http responses and streams """
+    if orjson:
+        return orjson.dumps(value).decode()
+    return json.dumps(value)
+
+def loads(data):
+    """ Decode json text, str or bytes """
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+class jsonCodec():
+    name = "json"
+
+    def encode(self, value):
+        return json.dumps(value)
+
+    def decode(self, data):
+        if isinstance(data, (bytes, bytearray)) and data[:1] == MSGPACK_MARKER:
+            if not msgpack:
+                raise ValueError("Found a msgpack value but msgpack isn't installed")
+            return msgpack.unpackb(data[1:], raw=False)
+        return json.loads(data)
+
+class orjsonCodec(jsonCodec):
+    name = "orjson"
+
+    def encode(self, value):
+        return orjson.dumps(value)
+
+    def decode(self, data):
+        if isinstance(data, (bytes, bytearray)) and data[:1] == MSGPACK_MARKER:
+            return super().decode(data)
+        return orjson.loads(data)
+
+class msgpackCodec(jsonCodec):
+    name = "msgpack"
+
+    def encode(self, value):
+        return MSGPACK_MARKER + msgpack.packb(value, use_bin_type=True)
+
+    def decode(self, data):
+        if isinstance(data, (bytes, bytearray)) and data[:1] == MSGPACK_MARKER:
+            return msgpack.unpackb(data[1:], raw=False)
+        return loads(data) # Written before the switch
+
+def createCodec(name="json"):
+    """ Returns the codec called name, falling back on json when its library
+        isn't installed. Every codec reads what the others wrote. """
+    if name == "orjson" and orjson:
+        return orjsonCodec()
+    if name == "msgpack" and msgpack:
+        return msgpackCodec()
+    if name != "json":
+        logging.warning(f"Codec {name} isn't available, using json")
+    return jsonCodec()
@@ -0,0 +1,102 @@
+import time
+import logging
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# lstein's default size, step costs are learned per step of this many pixels
+BASE_PIXELS = 512 * 512
+
+def parameters(job) -> tuple:
+    """ Returns what the cost of a job depends on: (steps, pixels, sampler, postprocessing) """
+    try:
+        steps = min(int(job.get("steps") or 50), settings.stableDiffusion.max_steps)
+        pixels = int(job.get("width") or 512) * int(job.get("height") or 512)
+    except (TypeError, ValueError):
+        steps, pixels = 50, BASE_PIXELS
+
+    # lstein upscales with esrgan and/or restores faces with gfpgan after the steps
+    try:
+        upscale = str(job.get("upscale_level") or 0).strip() or "0"
+        gfpgan = float(job.get("gfpgan_strength") or 0) > 0
+    except (TypeError, ValueError):
+        upscale, gfpgan = "0", False
+    postprocess = f"{upscale}-{int(gfpgan)}" if upscale != "0" or gfpgan else None
+
+    return steps, pixels, job.get("sampler_name") or "k_lms", postprocess
+
+class costModel():
+    """ Predicts how many seconds the backend needs for a job, learned from
+        the jobs the workers finish. Every part of a job (the overhead before
+        the first step, a step per sampler and the postprocessing) is kept
+        as an exponentially weighted mean in a redis hash, so every replica
+        predicts the same. Replicas only read it every costs.refresh_interval. """
+
+    def __init__(self, redis, key="dreaming-costs") -> None:
+        self.redis = redis
+        self.key = key
+        self.values = {}
+        self.workers = 1
+        self.fetched = 0
+
+    async def refresh(self):
+        if time.time() - self.fetched < settings.costs.refresh_interval:
+            return
+        self.fetched = time.time()
+        try:
+            self.values = {field.decode(): float(value) for field, value in
+                           (await self.redis.redis.hgetall(self.key)).items()}
+            self.workers = max(1, await self.redis.redis.scard("dreaming-workers"))
+        except Exception as e:
+            logging.error(f"Failed to read the cost model ({e})")
+
+    def predict(self, job) -> float:
+        """ Predicted seconds the backend takes for job """
+        steps, pixels, sampler, postprocess = parameters(job)
+        cost = self.values.get("overhead", settings.costs.default_overhead)
+        cost += steps * pixels / BASE_PIXELS * self.values.get(f"step-{sampler}",
+                    self.values.get("step", settings.costs.default_step))
+        if postprocess:
+            cost += self.values.get(f"postprocess-{postprocess}", settings.costs.default_postprocess)
+        return round(cost, 2)
+
+    def eta(self, rank, length, inflight, queued, cost) -> float:
+        """ Predicted seconds until a job with this position is done. Jobs in
+            front of it are taken to cost the average of the queue. """
+        if rank < 0:
+            return None
+        return round(self.wait(queued, length, inflight, rank) + cost, 1)
+
+    def wait(self, queued, length, inflight, rank=None) -> float:
+        """ Predicted seconds until a worker takes the job at rank, by default
+            a new job at the back of the queue """
+        average = queued / length if length else self.predict({})
+        ahead = queued if rank is None else rank * average
+        # Every worker is busy, on average halfway through a job
+        busy = average / 2 if inflight >= self.workers else 0
+        return ahead / self.workers + busy
+
+    async def learn(self, job, overhead=None, step=None, postprocess=None):
+        """ Fold what a finished job took into the model, step is the mean
+            seconds of one of its steps """
+        steps, pixels, sampler, kind = parameters(job)
+        samples = {}
+        if overhead is not None:
+            samples["overhead"] = overhead
+        if step is not None:
+            perStep = step * BASE_PIXELS / pixels
+            samples[f"step-{sampler}"] = perStep
+            samples["step"] = perStep
+        if postprocess is not None and kind:
+            samples[f"postprocess-{kind}"] = postprocess
+        if not samples:
+            return
+
+        # A lost update between two workers finishing at once doesn't matter for a mean
+        values = await self.redis.redis.hmget(self.key, list(samples))
+        alpha = settings.costs.alpha
+        update = {field: sample if value is None else (1 - alpha) * float(value) + alpha * sample
+                  for (field, sample), value in zip(samples.items(), values)}
+        await self.redis.redis.hset(self.key, mapping=update)
+        self.values.update(update)
@@ -0,0 +1,122 @@
+import time
+import math
+import random
+import asyncio
+import logging
+
+from typing import NamedTuple, Optional
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+class gpuStats(NamedTuple):
+    """ The GPU readings we actually use, everything else nvidia-smi knows is dropped """
+    temp: float # Celsius
+    power: float # Watt
+    util: float # Percent
+    tx_util: Optional[float] = None # KB/s
+    rx_util: Optional[float] = None # KB/s
+
+    def asDict(self) -> dict:
+        return {"temp": self.temp, "power": self.power, "util": self.util,
+                "pci": {"tx_util": self.tx_util, "rx_util": self.rx_util}}
+
+class nvmlSource():
+    """ Reads the GPU through NVML (pynvml), no subprocess needed """
+    def __init__(self, index=0):
+        import pynvml
+        self.nvml = pynvml
+        self.nvml.nvmlInit()
+        self.handle = self.nvml.nvmlDeviceGetHandleByIndex(index)
+
+    def readSync(self) -> gpuStats:
+        return gpuStats(
+            temp=self.nvml.nvmlDeviceGetTemperature(self.handle, self.nvml.NVML_TEMPERATURE_GPU),
+            power=round(self.nvml.nvmlDeviceGetPowerUsage(self.handle) / 1000, 2),
+            util=self.nvml.nvmlDeviceGetUtilizationRates(self.handle).gpu,
+            tx_util=self.nvml.nvmlDeviceGetPcieThroughput(self.handle, self.nvml.NVML_PCIE_UTIL_TX_BYTES),
+            rx_util=self.nvml.nvmlDeviceGetPcieThroughput(self.handle, self.nvml.NVML_PCIE_UTIL_RX_BYTES))
+
+    async def read(self) -> gpuStats:
+        # The PCIe counters take a few ms to sample
+        return await asyncio.get_event_loop().run_in_executor(None, self.readSync)
+
+class nvidiaSmiSource():
+    """ Asks nvidia-smi for just the fields we need, as csv instead of the full xml """
+    def __init__(self, index=0):
+        self.index = index
+
+    async def read(self) -> gpuStats:
+        proc = await asyncio.create_subprocess_exec(settings.telemetry.nvidia_smi,
+            "--query-gpu=temperature.gpu,power.draw,utilization.gpu", "--format=csv,noheader,nounits",
+            "-i", str(self.index), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        stdout, stderr = await proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError(stderr.decode().strip() or stdout.decode().strip())
+
+        temp, power, util = [value.strip() for value in stdout.decode().split(",")]
+        return gpuStats(temp=float(temp), power=float(power), util=float(util))
+
+class fakeSource():
+    """ Made up readings, for running without a GPU """
+    async def read(self) -> gpuStats:
+        return gpuStats(temp=random.randint(40, 80), power=round(random.uniform(30, 300), 2),
+                        util=random.randint(0, 100), tx_util=random.randint(0, 20000),
+                        rx_util=random.randint(0, 20000))
+
+def createSource(name, index=0):
+    """ Returns the telemetry source called name, or None when it is turned off """
+    if name == "off":
+        return None
+    if name == "fake":
+        return fakeSource()
+    if name == "nvidia-smi":
+        return nvidiaSmiSource(index)
+    if name == "nvml":
+        return nvmlSource(index)
+
+    # auto, prefer NVML and fall back on nvidia-smi
+    try:
+        return nvmlSource(index)
+    except Exception as e:
+        logging.info(f"NVML not available, using nvidia-smi for GPU telemetry ({e})")
+        return nvidiaSmiSource(index)
+
+class gpuTelemetry():
+    """ Polls a source and stores the readings of this host in redis, but only
+        writes when they change (or the key is about to expire). It polls
+        less often while isBusy() says no job is running. """
+
+    def __init__(self, redis, source, isBusy, host=settings.workers.name, prefix="dreaming-gpu"):
+        self.redis = redis
+        self.source = source
+        self.isBusy = isBusy
+        self.host = host
+        self.key = f"{prefix}-{host}"
+        self.hostsKey = f"{prefix}s"
+        self.last = None
+        self.written = 0
+
+    async def collect(self):
+        try:
+            stats = await self.source.read()
+        except Exception as e:
+            logging.error(f"Failed to read GPU telemetry! ({e})")
+            return
+
+        expire = max(1, math.ceil(settings.telemetry.idle_interval * 3))
+        if stats != self.last or time.time() - self.written > expire / 2:
+            try:
+                await self.redis.setex(self.key, stats.asDict(), expire)
+                await self.redis.redis.sadd(self.hostsKey, self.host)
+            except Exception as e:
+                logging.error(f"Failed to store GPU telemetry! ({e})")
+                return
+            self.last = stats
+            self.written = time.time()
+
+    async def task(self):
+        logging.info(f"Starting GPU telemetry task ({type(self.source).__name__})")
+        while True:
+            await self.collect()
+            await asyncio.sleep(settings.telemetry.interval if self.isBusy() else settings.telemetry.idle_interval)
@@ -0,0 +1,62 @@
+import io
+import os
+import asyncio
+import logging
+import api.tracing as tracing
+
+from PIL import Image
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+def encodeImage(path, format="jpeg", quality=75, size=None) -> bytes:
+    """ Open an image and encode it again, optionally shrunk to fit in size x size """
+    img = Image.open(path).convert("RGB")
+    if size:
+        img.thumbnail((size, size))
+    ioimg = io.BytesIO()
+    img.save(ioimg, format=format, quality=quality)
+    return ioimg.getvalue()
+
+class imageCache():
+    """ Keeps encoded variants of images in memory, dropping the least
+        recently used ones once they take up more than maxBytes.
+        Encoding happens in an executor so it never blocks the event loop. """
+
+    def __init__(self, maxBytes) -> None:
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.pending = {}
+
+    async def get(self, path, format="jpeg", quality=75, size=None) -> bytes:
+        # The modification time is part of the key, so a changed file is encoded again
+        key = (path, os.stat(path).st_mtime_ns, format, quality, size)
+
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        # Encoding runs in a task of its own, so a caller that goes away
+        # doesn't cancel it for the others waiting on the same image
+        if key not in self.pending:
+            task = asyncio.create_task(self.encode(key, path, format, quality, size))
+            self.pending[key] = task
+            task.add_done_callback(lambda _: self.pending.pop(key, None))
+        return await asyncio.shield(self.pending[key])
+
+    async def encode(self, key, path, format, quality, size) -> bytes:
+        with tracing.span("image.encode", format=format, size=size):
+            data = await asyncio.get_event_loop().run_in_executor(None, encodeImage, path, format, quality, size)
+        self.put(key, data)
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.maxBytes:
+            return
+
+        self.entries[key] = data
+        self.size += len(data)
+        while self.size > self.maxBytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
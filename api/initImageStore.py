@@ -0,0 +1,117 @@
+import os
+import re
+import time
+import base64
+import asyncio
+import hashlib
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+REFERENCE = re.compile(r"^sha256:([0-9a-f]{64})$")
+
+class imageTooLarge(Exception):
+    pass
+
+def mimeType(head) -> str:
+    """ The type of an image by its first bytes, lstein wants to know it in the data url """
+    if head.startswith(b"\x89PNG"):
+        return "image/png"
+    if head.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+def isReference(value) -> bool:
+    return isinstance(value, str) and REFERENCE.match(value) is not None
+
+class initImageStore():
+    """ Init images are written once to disk, named by the sha256 of their
+        contents, so a resubmitted image is stored only once. Jobs only
+        carry a "sha256:..." reference, the worker reads the image when it
+        sends the job to the backend. """
+
+    def __init__(self, path, maxSize) -> None:
+        self.path = path
+        self.maxSize = maxSize
+
+    def file(self, reference) -> str:
+        if not (match := REFERENCE.match(reference)):
+            raise ValueError(f"Not an init image reference: {reference!r}")
+        return os.path.join(self.path, match.group(1))
+
+    def touch(self, reference) -> bool:
+        """ An image is used again, keep it around longer. Returns False if it is gone. """
+        try:
+            os.utime(self.file(reference))
+            return True
+        except FileNotFoundError:
+            return False
+
+    async def save(self, chunks) -> str:
+        """ Write an image that arrives in chunks, returns its reference """
+        loop = asyncio.get_event_loop()
+        os.makedirs(self.path, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+
+        handle, temporary = tempfile.mkstemp(dir=self.path, prefix=".upload-")
+        try:
+            with os.fdopen(handle, "wb") as f:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.maxSize:
+                        raise imageTooLarge(f"Init images can't be larger than {self.maxSize} bytes")
+                    digest.update(chunk)
+                    await loop.run_in_executor(None, f.write, chunk)
+
+            reference = f"sha256:{digest.hexdigest()}"
+            if not self.touch(reference):
+                os.replace(temporary, self.file(reference))
+            return reference
+        finally:
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+
+    async def saveDataUrl(self, dataUrl) -> str:
+        """ Store an init image sent the old way, as a base64 data url """
+        data = await asyncio.get_event_loop().run_in_executor(None, base64.b64decode, dataUrl.split(",", 1)[-1])
+        async def chunks():
+            yield data
+        return await self.save(chunks())
+
+    async def load(self, reference) -> str:
+        """ Returns the image as the data url the backend takes, None if it is gone """
+        def read():
+            try:
+                with open(self.file(reference), "rb") as f:
+                    return f.read()
+            except FileNotFoundError:
+                return None
+
+        if (data := await asyncio.get_event_loop().run_in_executor(None, read)) is None:
+            return None
+        return f"data:{mimeType(data[:12])};base64,{base64.b64encode(data).decode()}"
+
+    def prune(self, maxAge) -> int:
+        """ Delete images no job used for maxAge seconds, returns how many """
+        if not os.path.isdir(self.path):
+            return 0
+        pruned = 0
+        for entry in os.scandir(self.path):
+            if entry.is_file() and time.time() - entry.stat().st_mtime > maxAge:
+                os.unlink(entry.path)
+                pruned += 1
+        return pruned
+
+    async def pruneTask(self, maxAge, interval=3600):
+        logging.info(f"Starting init image prune task ({self.path})")
+        while True:
+            try:
+                if pruned := await asyncio.get_event_loop().run_in_executor(None, self.prune, maxAge):
+                    logging.info(f"Pruned {pruned} unused init images")
+            except OSError as e:
+                logging.error(f"Failed to prune init images ({e})")
+            await asyncio.sleep(interval)
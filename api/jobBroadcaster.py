@@ -0,0 +1,155 @@
+import asyncio
+import logging
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+JOB_CHANNEL = "dreaming-job-events-"
+QUEUE_CHANNEL = "dreaming-queue-events"
+
+class feed(asyncio.Queue):
+    """ The queue of one client watching several jobs (or all of them) over
+        a single connection. Unlike a job stream it can't just skip old
+        updates, so a client that falls behind is dropped instead. """
+
+    def __init__(self, uuids=(), everything=False, queueEvents=False) -> None:
+        super().__init__(maxsize=settings.streaming.feed_queue_size)
+        self.uuids = set(uuids)
+        self.everything = everything
+        self.queueEvents = queueEvents
+        self.dropped = False
+
+class jobBroadcaster():
+    """ Listens on one shared redis pub/sub connection for job updates
+        and hands them out to every local stream that is watching that job.
+        The amount of redis connections stays the same no matter how many
+        clients are connected. """
+
+    def __init__(self, redis, annotate=None) -> None:
+        """ annotate(jobs) returns what streams show along with every job of
+            jobs (uuid: job, None when only the queue moved). It is called once
+            per update, however many streams watch the jobs. """
+        self.redis = redis
+        self.annotate = annotate
+        self.pubsub = None
+        self.task = None
+        self.subscribers = {}
+        # The last event of every watched job, jobs that left the queue need no position
+        self.events = {}
+        self.feeds = set()
+
+    async def init(self):
+        self.pubsub = self.redis.redis.pubsub()
+        await self.pubsub.psubscribe(f"{JOB_CHANNEL}*")
+        await self.pubsub.subscribe(QUEUE_CHANNEL)
+        self.task = asyncio.create_task(self.readerTask())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        if self.pubsub:
+            await self.pubsub.close()
+
+    def subscribe(self, uuid) -> asyncio.Queue:
+        """ Returns a queue that receives every update of job uuid """
+        queue = asyncio.Queue(maxsize=settings.streaming.queue_size)
+        self.subscribers.setdefault(uuid, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, uuid, queue):
+        if uuid in self.subscribers:
+            self.subscribers[uuid].discard(queue)
+            if not self.subscribers[uuid]:
+                self.subscribers.pop(uuid)
+                self.events.pop(uuid, None)
+
+    def seen(self, uuid, job):
+        """ A stream read job from the store, updates that came in since are newer """
+        if job and uuid in self.subscribers:
+            self.events.setdefault(uuid, job.get("event"))
+
+    def subscribeFeed(self, feed) -> feed:
+        """ Start delivering the updates feed asks for to it """
+        self.feeds.add(feed)
+        return feed
+
+    def unsubscribeFeed(self, feed):
+        self.feeds.discard(feed)
+
+    def deliver(self, queue, message):
+        """ Put a message in the queue, dropping the oldest one if the client can't keep up """
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(message)
+
+    def deliverFeed(self, feed, message):
+        """ Put a message in a feed, dropping the feed if its client can't keep up """
+        if feed.dropped:
+            return
+        if feed.full():
+            logging.warning(f"Dropping a job feed that is {feed.qsize()} updates behind")
+            feed.dropped = True
+            self.feeds.discard(feed)
+            # Wake up the client so it can tell it was dropped
+            while not feed.empty():
+                feed.get_nowait()
+            feed.put_nowait({"event": "dropped"})
+            return
+        feed.put_nowait(message)
+
+    async def extras(self, jobs) -> dict:
+        if not self.annotate or not jobs:
+            return {}
+        try:
+            return await self.annotate(jobs)
+        except Exception as e:
+            # The update itself still goes out
+            logging.error(f"Failed to annotate job updates ({e})")
+            return {}
+
+    async def dispatch(self, channel, message):
+        if channel == QUEUE_CHANNEL:
+            # The queue changed, every stream may have a new position
+            update = {"event": "queue", "queue": message}
+            for feed in list(self.feeds):
+                if feed.queueEvents:
+                    self.deliverFeed(feed, update)
+
+            extras = await self.extras({uuid: {"event": self.events[uuid]} if uuid in self.events else None
+                                        for uuid in self.subscribers})
+            for uuid, queues in list(self.subscribers.items()):
+                for queue in queues:
+                    self.deliver(queue, {**update, **extras.get(uuid, {})})
+            return
+
+        uuid = channel[len(JOB_CHANNEL):]
+        for feed in list(self.feeds):
+            if feed.everything or uuid in feed.uuids:
+                self.deliverFeed(feed, message)
+
+        if queues := self.subscribers.get(uuid):
+            self.events[uuid] = message.get("event")
+            message = {**message, **(await self.extras({uuid: message})).get(uuid, {})}
+            for queue in list(queues):
+                self.deliver(queue, message)
+
+    async def readerTask(self):
+        logging.info("Starting job broadcaster task")
+        while True:
+            try:
+                # Wait with a timeout shorter than the socket timeout of the pool
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if not message or message['type'] not in ("message", "pmessage"):
+                    continue
+
+                channel = message['channel']
+                if isinstance(channel, bytes):
+                    channel = channel.decode()
+                await self.dispatch(channel, self.redis.codec.decode(message['data']))
+
+            except asyncio.CancelledError:
+                return
+            except Exception as e:
+                logging.error(f"Job broadcaster lost its subscription, retrying ({e})")
+                await asyncio.sleep(1)
@@ -0,0 +1,593 @@
+import logging
+import collections
+
+import api.tracing as tracing
+
+from config import settings
+from api.jobBroadcaster import QUEUE_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+class queueLimitReached(Exception):
+    pass
+
+# Every script gets the keys of the queue first in KEYS, and the key prefix as its
+# first argument for the keys of flows, rings and batches it only finds out about
+# while it runs. All keys start with the prefix, a hash tag, so in Redis Cluster
+# they are in the same slot and a script can use them together.
+QUEUE_KEYS = """
+local jobsKey, metaKey, costKey, seqKey, weightsKey = KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5]
+local lengthsKey, readyKey, inflightKey, creditKey = KEYS[6], KEYS[7], KEYS[8], KEYS[9]
+"""
+
+# Take the predicted cost of a job that leaves the queue off the queue's total
+UNCOST = QUEUE_KEYS + """
+local function uncost(meta)
+    if meta[4] and tonumber(meta[4]) then
+        if tonumber(redis.call("INCRBYFLOAT", costKey, -tonumber(meta[4]))) < 0.001 then
+            redis.call("SET", costKey, 0)
+        end
+    end
+end
+"""
+
+# Add a job to the queue of its flow, or in front of it when it is put back
+QUEUE = QUEUE_KEYS + """
+local function enqueue(prefix, uuid, payload, lane, flow, weight, front, batch, cost)
+    local flowKey = prefix .. "-flow-" .. flow
+    local queued = redis.call("ZCARD", flowKey)
+
+    local seq
+    if front then
+        local head = redis.call("ZRANGE", flowKey, 0, 0, "WITHSCORES")
+        seq = head[2] and (tonumber(head[2]) - 1) or 0
+    else
+        seq = redis.call("INCR", seqKey)
+    end
+
+    redis.call("ZADD", flowKey, seq, uuid)
+    redis.call("HSET", jobsKey, uuid, payload)
+    redis.call("HSET", metaKey, uuid, cjson.encode({lane, flow, batch, cost}))
+    redis.call("INCRBYFLOAT", costKey, cost)
+    redis.call("HSET", weightsKey, flow, weight)
+    if batch ~= "" then
+        redis.call("ZADD", prefix .. "-batch-" .. batch, seq, uuid)
+    end
+    redis.call("HINCRBY", lengthsKey, lane, 1)
+
+    if queued == 0 then
+        local ring = prefix .. "-ring-" .. lane
+        if front then
+            -- The flow at the head loses the rest of its turn, only the head
+            -- of a ring can be halfway through one
+            local head = redis.call("LINDEX", ring, 0)
+            if head then
+                redis.call("HDEL", creditKey, head)
+            end
+            redis.call("LPUSH", ring, flow)
+        else
+            redis.call("RPUSH", ring, flow)
+        end
+    end
+
+    redis.call("RPUSH", readyKey, 1)
+end
+"""
+
+ENQUEUE = QUEUE + """
+local prefix, uuid, payload, lane, flow = ARGV[1], ARGV[2], ARGV[3], ARGV[4], ARGV[5]
+local weight, limit, front, batch, cost = tonumber(ARGV[6]), tonumber(ARGV[7]), ARGV[8] == "1", ARGV[9], ARGV[10]
+
+if limit > 0 and not front and redis.call("ZCARD", prefix .. "-flow-" .. flow) >= limit then
+    return -1
+end
+enqueue(prefix, uuid, payload, lane, flow, weight, front, batch, cost)
+return 1
+"""
+
+# Put the unfinished jobs of a worker back in front of the queue, every job
+# comes with its payload as it is in the processing list and where it goes
+RECOVER = QUEUE + """
+local prefix, processing, worker = ARGV[1], KEYS[10], ARGV[2]
+local recovered = 0
+for i = 3, #ARGV, 7 do
+    local uuid, payload, lane, flow = ARGV[i], ARGV[i + 1], ARGV[i + 2], ARGV[i + 3]
+    if redis.call("LREM", processing, 1, payload) > 0 then
+        enqueue(prefix, uuid, payload, lane, flow, tonumber(ARGV[i + 4]), true, ARGV[i + 5], ARGV[i + 6])
+        recovered = recovered + 1
+    end
+end
+if redis.call("LLEN", processing) == 0 then
+    redis.call("HDEL", inflightKey, worker)
+end
+return recovered
+"""
+
+DISPATCH = UNCOST + """
+local prefix, processing, worker = ARGV[1], KEYS[10], ARGV[2]
+
+for i = 3, #ARGV do
+    local lane = ARGV[i]
+    local ring = prefix .. "-ring-" .. lane
+    local flow = redis.call("LINDEX", ring, 0)
+
+    while flow do
+        local flowKey = prefix .. "-flow-" .. flow
+        local popped = redis.call("ZPOPMIN", flowKey)
+
+        if #popped == 0 then
+            redis.call("LPOP", ring)
+            redis.call("HDEL", creditKey, flow)
+        else
+            local uuid = popped[1]
+
+            -- A flow may take as many jobs in a row as its weight
+            local credit = tonumber(redis.call("HGET", creditKey, flow))
+            if not credit or credit <= 0 then
+                credit = tonumber(redis.call("HGET", weightsKey, flow) or "1")
+            end
+            credit = credit - 1
+
+            if redis.call("ZCARD", flowKey) == 0 then
+                redis.call("LPOP", ring)
+                redis.call("HDEL", creditKey, flow)
+            elseif credit <= 0 then
+                redis.call("LMOVE", ring, ring, "LEFT", "RIGHT")
+                redis.call("HDEL", creditKey, flow)
+            else
+                redis.call("HSET", creditKey, flow, credit)
+            end
+
+            local meta = redis.call("HGET", metaKey, uuid)
+            if meta then
+                meta = cjson.decode(meta)
+                if meta[3] and meta[3] ~= "" then
+                    redis.call("ZREM", prefix .. "-batch-" .. meta[3], uuid)
+                end
+                uncost(meta)
+            end
+
+            local job = redis.call("HGET", jobsKey, uuid)
+            redis.call("HDEL", jobsKey, uuid)
+            redis.call("HDEL", metaKey, uuid)
+            redis.call("HINCRBY", lengthsKey, lane, -1)
+
+            if job then
+                redis.call("LPUSH", processing, job)
+                redis.call("HSET", inflightKey, worker, uuid)
+                return job
+            end
+        end
+        flow = redis.call("LINDEX", ring, 0)
+    end
+end
+return false
+"""
+
+REMOVE = UNCOST + """
+local prefix, uuid = ARGV[1], ARGV[2]
+local meta = redis.call("HGET", metaKey, uuid)
+if not meta then
+    return 0
+end
+
+meta = cjson.decode(meta)
+local lane, flow, batch = meta[1], meta[2], meta[3]
+local flowKey = prefix .. "-flow-" .. flow
+
+if batch and batch ~= "" then
+    redis.call("ZREM", prefix .. "-batch-" .. batch, uuid)
+end
+uncost(meta)
+redis.call("ZREM", flowKey, uuid)
+redis.call("HDEL", jobsKey, uuid)
+redis.call("HDEL", metaKey, uuid)
+redis.call("HINCRBY", lengthsKey, lane, -1)
+
+if redis.call("ZCARD", flowKey) == 0 then
+    redis.call("LREM", prefix .. "-ring-" .. lane, 0, flow)
+    redis.call("HDEL", creditKey, flow)
+end
+return 1
+"""
+
+CLAIM = UNCOST + """
+local prefix, batch, processing, worker, count = ARGV[1], ARGV[2], KEYS[10], ARGV[3], tonumber(ARGV[4])
+local batchKey = prefix .. "-batch-" .. batch
+local claimed = {}
+
+while #claimed < count do
+    local popped = redis.call("ZPOPMIN", batchKey)
+    if #popped == 0 then
+        break
+    end
+
+    local uuid = popped[1]
+    local meta = redis.call("HGET", metaKey, uuid)
+    if meta then
+        meta = cjson.decode(meta)
+        local lane, flow = meta[1], meta[2]
+        local flowKey = prefix .. "-flow-" .. flow
+
+        uncost(meta)
+        redis.call("ZREM", flowKey, uuid)
+        if redis.call("ZCARD", flowKey) == 0 then
+            redis.call("LREM", prefix .. "-ring-" .. lane, 0, flow)
+            redis.call("HDEL", creditKey, flow)
+        end
+
+        local job = redis.call("HGET", jobsKey, uuid)
+        redis.call("HDEL", jobsKey, uuid)
+        redis.call("HDEL", metaKey, uuid)
+        redis.call("HINCRBY", lengthsKey, lane, -1)
+
+        if job then
+            redis.call("LPUSH", processing, job)
+            local running = redis.call("HGET", inflightKey, worker)
+            redis.call("HSET", inflightKey, worker, running and (running .. "," .. uuid) or uuid)
+            table.insert(claimed, job)
+        end
+    end
+end
+return claimed
+"""
+
+# Ranks of many jobs at once, the rings, weights and flow lengths they share
+# are read only once. ARGV is the prefix, the number of uuids, the uuids and
+# the lanes. Returns the totals and then the rank and cost of every uuid.
+POSITION = QUEUE_KEYS + """
+local prefix, count = ARGV[1], tonumber(ARGV[2])
+local lanes = {}
+for i = 3 + count, #ARGV do
+    table.insert(lanes, ARGV[i])
+end
+
+local total = 0
+local lengths = {}
+local raw = redis.call("HGETALL", lengthsKey)
+for i = 1, #raw, 2 do
+    lengths[raw[i]] = tonumber(raw[i + 1])
+    total = total + tonumber(raw[i + 1])
+end
+local inflight = redis.call("HLEN", inflightKey)
+-- Floats would be truncated on the way back, send the costs as strings
+local result = {total, inflight, redis.call("GET", costKey) or "0"}
+
+local weights, sizes, rings = {}, {}, {}
+local function weightOf(f)
+    if not weights[f] then
+        weights[f] = tonumber(redis.call("HGET", weightsKey, f) or "1")
+    end
+    return weights[f]
+end
+local function sizeOf(f)
+    if not sizes[f] then
+        sizes[f] = redis.call("ZCARD", prefix .. "-flow-" .. f)
+    end
+    return sizes[f]
+end
+local function ringOf(lane)
+    if not rings[lane] then
+        local ring = redis.call("LRANGE", prefix .. "-ring-" .. lane, 0, -1)
+        -- Only the flow at the head of the ring can be halfway its turn
+        local credit = ring[1] and tonumber(redis.call("HGET", creditKey, ring[1]))
+        rings[lane] = {flows = ring, credit = (credit and credit > 0) and credit or nil}
+    end
+    return rings[lane]
+end
+
+for n = 1, count do
+    local uuid = ARGV[2 + n]
+    local meta = redis.call("HGET", metaKey, uuid)
+    if not meta then
+        table.insert(result, -1)
+        table.insert(result, "0")
+    else
+        meta = cjson.decode(meta)
+        local lane, flow = meta[1], meta[2]
+        local ring = ringOf(lane)
+        local function firstTurnOf(index, f)
+            if index == 1 and ring.credit then
+                return ring.credit
+            end
+            return weightOf(f)
+        end
+
+        -- Everything in the lanes above goes first
+        local ahead = 0
+        for _, above in ipairs(lanes) do
+            if above == lane then
+                break
+            end
+            ahead = ahead + (lengths[above] or 0)
+        end
+
+        local position = 0
+        for index, f in ipairs(ring.flows) do
+            if f == flow then
+                position = index
+            end
+        end
+
+        -- In which of its turns this flow gets to our job
+        local rank = redis.call("ZRANK", prefix .. "-flow-" .. flow, uuid)
+        local first = firstTurnOf(position, flow)
+        local turn = 0
+        if rank >= first then
+            turn = 1 + math.floor((rank - first) / weightOf(flow))
+        end
+        ahead = ahead + rank
+
+        -- Every other flow gets as many turns before us, one more if it is in front of us
+        for index, f in ipairs(ring.flows) do
+            if f ~= flow then
+                local turns = turn
+                if index < position then
+                    turns = turn + 1
+                end
+                if turns > 0 then
+                    ahead = ahead + math.min(firstTurnOf(index, f) + (turns - 1) * weightOf(f), sizeOf(f))
+                end
+            end
+        end
+
+        table.insert(result, ahead)
+        table.insert(result, tostring(meta[4] or 0))
+    end
+end
+return result
+"""
+
+class fairOrder():
+    """ The dispatch script in python, used to list the queue in the order
+        it will be worked on and to simulate the scheduler. """
+
+    def __init__(self, lanes):
+        self.lanes = lanes
+        self.rings = {lane: collections.deque() for lane in lanes}
+        self.flows = {}
+        self.weights = {}
+        self.credit = {}
+
+    def push(self, lane, flow, item, weight=1):
+        if not self.flows.get(flow):
+            self.rings[lane].append(flow)
+            self.flows[flow] = collections.deque()
+        self.flows[flow].append(item)
+        self.weights[flow] = weight
+
+    def pop(self):
+        for lane in self.lanes:
+            ring = self.rings[lane]
+            while ring:
+                flow = ring[0]
+                if not self.flows[flow]:
+                    ring.popleft()
+                    self.credit.pop(flow, None)
+                    continue
+
+                item = self.flows[flow].popleft()
+                credit = self.credit.get(flow, 0)
+                if credit <= 0:
+                    credit = self.weights.get(flow, 1)
+                credit -= 1
+
+                if not self.flows[flow]:
+                    ring.popleft()
+                    self.credit.pop(flow, None)
+                elif credit <= 0:
+                    ring.rotate(-1)
+                    self.credit.pop(flow, None)
+                else:
+                    self.credit[flow] = credit
+                return item
+        return None
+
+    def __len__(self):
+        return sum(len(items) for items in self.flows.values())
+
+def flowOf(job) -> tuple:
+    """ Returns the (lane, flow, weight) a job is scheduled in. Every user of every
+        initiator is a flow of its own, flows in a lane take turns. """
+    initiator = job.get('initiator', "api")
+    flow = f"{initiator}:{job['user']}" if job.get('user') else initiator
+    # Only trusted clients get to pick a lane, see identify() in dreamingapi
+    lane = job.get('lane') or settings.scheduler.initiator_lanes.get(initiator, settings.scheduler.default_lane)
+    if lane not in settings.scheduler.lanes:
+        lane = settings.scheduler.default_lane
+    return lane, flow, settings.scheduler.weights.get(initiator, 1)
+
+class jobQueue():
+    """ The job queue schedules jobs fairly: every user (or initiator, for
+        jobs without a user) has a queue of its own, and within a priority
+        lane these flows take turns, as many jobs per turn as their weight.
+        Lanes are served strictly in order. All of it lives in redis and is
+        changed by lua scripts, so it stays consistent between replicas.
+
+        Workers take jobs by atomically moving them into their own processing
+        list, where they stay until the job is finished. Jobs left behind there
+        by a crashed worker are put back in front of the queue on startup.
+        Which worker runs which job is kept in the inflight hash, so every
+        API replica can see what is being worked on. """
+
+    def __init__(self, redis, key="sd-queue"):
+        self.redis = redis
+        # The plain list the queue used to be, see migrate()
+        self.key = key
+        # A hash tag, so every key of the queue is in the same Redis Cluster slot
+        self.prefix = f"{{{key}}}"
+        self.readyKey = f"{self.prefix}-ready"
+        self.inflightKey = f"{self.prefix}-inflight"
+        # In the order the scripts take them, see QUEUE_KEYS
+        self.keys = [f"{self.prefix}-{name}" for name in ("jobs", "meta", "cost", "seq", "weights", "lengths")]
+        self.keys += [self.readyKey, self.inflightKey, f"{self.prefix}-credit"]
+
+    async def init(self):
+        self.enqueueScript = self.redis.redis.register_script(ENQUEUE)
+        self.dispatchScript = self.redis.redis.register_script(DISPATCH)
+        self.removeScript = self.redis.redis.register_script(REMOVE)
+        self.claimScript = self.redis.redis.register_script(CLAIM)
+        self.positionScript = self.redis.redis.register_script(POSITION)
+        self.recoverScript = self.redis.redis.register_script(RECOVER)
+
+    def enqueueArgs(self, job, front) -> list:
+        lane, flow, weight = flowOf(job)
+        return [self.prefix, job['uuid'], self.redis.codec.encode(job), lane, flow, weight,
+                settings.scheduler.max_queued_per_user, int(front), job.get('batch') or "", job.get('cost') or 0]
+
+    def recoverArgs(self, payload) -> list:
+        job = self.redis.codec.decode(payload)
+        lane, flow, weight = flowOf(job)
+        return [job['uuid'], payload, lane, flow, weight, job.get('batch') or "", job.get('cost') or 0]
+
+    async def push(self, job, front=False):
+        """ Add a job to the queue, raises queueLimitReached when its user has too many queued """
+        if await self.enqueueScript(keys=self.keys, args=self.enqueueArgs(job, front)) == -1:
+            raise queueLimitReached(f"{flowOf(job)[1]} already has {settings.scheduler.max_queued_per_user} jobs queued")
+        await self.redis.publish(QUEUE_CHANNEL, {"event": "queued", "uuid": job['uuid']})
+
+    async def pushMany(self, jobs) -> list:
+        """ Add jobs to the queue in one transaction, returns for every job
+            whether it was added (False when its user had too many queued) """
+        async with self.redis.redis.pipeline(transaction=True) as pipe:
+            for job in jobs:
+                await self.enqueueScript(keys=self.keys, args=self.enqueueArgs(job, False), client=pipe)
+            added = [result != -1 for result in await pipe.execute()]
+
+        async with self.redis.redis.pipeline(transaction=False) as pipe:
+            for job in [job for job, ok in zip(jobs, added) if ok]:
+                pipe.publish(QUEUE_CHANNEL, self.redis.codec.encode({"event": "queued", "uuid": job['uuid']}))
+            await pipe.execute()
+        return added
+
+    async def remove(self, uuid) -> bool:
+        """ Take a job out of the queue, returns False if it wasn't queued """
+        if await self.removeScript(keys=self.keys, args=[self.prefix, uuid]):
+            await self.redis.publish(QUEUE_CHANNEL, {"event": "removed", "uuid": uuid})
+            return True
+        return False
+
+    def processingKey(self, worker):
+        return f"{self.prefix}-processing-{worker}"
+
+    async def take(self, worker, timeout):
+        """ Wait up to timeout seconds for a job and move the one that is next
+            in line into the processing list of worker. """
+        # The socket times out before a longer block would end
+        if settings.redisClient.socket_timeout:
+            timeout = min(timeout, settings.redisClient.socket_timeout / 2)
+
+        # Every queued job pushes a token, also look when none came to be safe
+        await self.redis.redis.blpop(self.readyKey, timeout)
+        return await self.dispatch(worker)
+
+    async def dispatch(self, worker):
+        """ Move the job that is next in line into the processing list of worker,
+            returns None when nothing is queued """
+        with tracing.span("queue.dispatch"):
+            job = await self.dispatchScript(keys=[*self.keys, self.processingKey(worker)],
+                                            args=[self.prefix, worker, *settings.scheduler.lanes])
+        if job:
+            job = self.redis.codec.decode(job)
+            await self.redis.publish(QUEUE_CHANNEL, {"event": "dequeued", "uuid": job['uuid']})
+            return job
+        return None
+
+    async def claim(self, worker, batch, count) -> list:
+        """ Move up to count queued jobs with the same batch key into the
+            processing list of worker, to run them along with its current job. """
+        jobs = [self.redis.codec.decode(job) for job in await self.claimScript(
+                keys=[*self.keys, self.processingKey(worker)], args=[self.prefix, batch, worker, count])]
+        for job in jobs:
+            await self.redis.publish(QUEUE_CHANNEL, {"event": "dequeued", "uuid": job['uuid']})
+        return jobs
+
+    async def finish(self, worker):
+        """ The job of worker is done (or failed), forget about it """
+        async with self.redis.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(self.processingKey(worker))
+            pipe.hdel(self.inflightKey, worker)
+            await pipe.execute()
+
+    async def recover(self, worker) -> int:
+        """ Put jobs that worker didn't finish back in front of the queue, the
+            oldest first. Returns how many. """
+        # Newest first, so every next one goes in front of the one before
+        payloads = await self.redis.redis.lrange(self.processingKey(worker), 0, -1)
+        args = [arg for payload in payloads for arg in self.recoverArgs(payload)]
+        if recovered := await self.recoverScript(keys=[*self.keys, self.processingKey(worker)],
+                                                 args=[self.prefix, worker, *args]):
+            logger.warning(f"Recovered {recovered} unfinished jobs of {worker}")
+            async with self.redis.redis.pipeline(transaction=False) as pipe:
+                for uuid in args[::7]:
+                    pipe.publish(QUEUE_CHANNEL, self.redis.codec.encode({"event": "queued", "uuid": uuid}))
+                await pipe.execute()
+        return recovered
+
+    async def inflight(self) -> dict:
+        """ Returns which worker is running which job uuids """
+        return {worker.decode(): uuids.decode().split(",") for worker, uuids in
+                (await self.redis.redis.hgetall(self.inflightKey)).items()}
+
+    async def position(self, uuid):
+        """ Returns a tuple of (rank, length, inflight, queued cost, cost), rank is -1 if 
+            uuid isn't queued. The rank is how many jobs will be taken before this one,
+            the costs are the predicted seconds of the whole queue and of this job. """
+        return (await self.positions([uuid]))[uuid]
+
+    async def positions(self, uuids) -> dict:
+        """ position() of many jobs, computed in one pass over the queue """
+        uuids = list(uuids)
+        length, inflight, queued, *ranks = await self.positionScript(
+            keys=self.keys, args=[self.prefix, len(uuids), *uuids, *settings.scheduler.lanes])
+        return {uuid: (rank, length, inflight, float(queued), float(cost))
+                for uuid, rank, cost in zip(uuids, ranks[::2], ranks[1::2])}
+
+    async def totals(self) -> tuple:
+        """ Returns (length, inflight, queued cost) in one round trip """
+        length, inflight, queued = await self.positionScript(keys=self.keys, args=[self.prefix, 0, *settings.scheduler.lanes])
+        return length, inflight, float(queued)
+
+    async def queuedCost(self) -> float:
+        """ The predicted seconds of every queued job together """
+        return float(await self.redis.redis.get(f"{self.prefix}-cost") or 0)
+
+    async def length(self):
+        return sum(int(length) for length in await self.redis.redis.hvals(f"{self.prefix}-lengths"))
+
+    async def lengths(self) -> dict:
+        """ Returns how many jobs are queued in every lane """
+        lengths = {lane.decode(): int(length) for lane, length in 
+                   (await self.redis.redis.hgetall(f"{self.prefix}-lengths")).items()}
+        return {lane: lengths.get(lane, 0) for lane in settings.scheduler.lanes}
+
+    async def list(self):
+        """ Returns all queued jobs, in the order they will be worked on """
+        order = fairOrder(settings.scheduler.lanes)
+        jobs = {uuid.decode(): self.redis.codec.decode(job) for uuid, job in (await self.redis.redis.hgetall(f"{self.prefix}-jobs")).items()}
+
+        for lane in settings.scheduler.lanes:
+            for flow in await self.redis.redis.lrange(f"{self.prefix}-ring-{lane}", 0, -1):
+                flow = flow.decode()
+                weight = int(await self.redis.redis.hget(f"{self.prefix}-weights", flow) or 1)
+                for uuid in await self.redis.redis.zrange(f"{self.prefix}-flow-{flow}", 0, -1):
+                    # Taken by a worker since the jobs were read
+                    if job := jobs.get(uuid.decode()):
+                        order.push(lane, flow, job, weight)
+
+        order.credit = {flow.decode(): int(credit) for flow, credit in
+                        (await self.redis.redis.hgetall(f"{self.prefix}-credit")).items()}
+        return [order.pop() for _ in range(len(order))]
+
+    async def migrate(self, store):
+        """ Move jobs from the plain list the queue used to be into the scheduler.
+            Their records in store are from that time too, so they are turned into
+            hashes first, or the worker couldn't write to them. """
+        if await self.redis.redis.type(self.key) != b"list":
+            return
+
+        while job := await self.redis.rpop(self.key):
+            await store.migrate([job['uuid']])
+            await self.push(job)
+            logger.warning(f"Moved {job['uuid']} from the old queue list into the scheduler")
+        await self.redis.delete(f"{self.key}-index")
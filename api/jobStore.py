@@ -0,0 +1,143 @@
+import zlib
+import logging
+import aioredis
+
+logger = logging.getLogger(__name__)
+
+class jobStore():
+    """ Jobs are stored as a redis hash with every field encoded on its
+        own, so progress updates only write the fields that changed and
+        readers can ask for just the fields they need. The base64 init image
+        is not kept here, jobs carry a reference to it (see initImageStore). """
+
+    def __init__(self, redis, prefix="dreaming-job-"):
+        self.redis = redis
+        self.prefix = prefix
+
+    def key(self, uuid) -> str:
+        return f"{self.prefix}{uuid}"
+
+    async def create(self, job, expire):
+        """ Store a new job """
+        return (await self.createMany([job], expire))[0]
+
+    async def createMany(self, jobs, expire) -> list:
+        """ Store new jobs in one transaction """
+        async with self.redis.redis.pipeline(transaction=True) as pipe:
+            for job in jobs:
+                pipe.delete(self.key(job['uuid']))
+                pipe.hset(self.key(job['uuid']), mapping={field: self.redis.codec.encode(value) for field, value in job.items()})
+                pipe.expire(self.key(job['uuid']), expire)
+            await pipe.execute()
+        return jobs
+
+    async def update(self, uuid, fields, expire=None):
+        """ Change some fields of a job, and optionally when it expires """
+        async with self.redis.redis.pipeline(transaction=True) as pipe:
+            self.stageUpdate(pipe, uuid, fields, expire)
+            await pipe.execute()
+
+    def stageUpdate(self, pipe, uuid, fields, expire=None):
+        """ Add an update() to a pipeline, to send it along with other commands """
+        pipe.hset(self.key(uuid), mapping={field: self.redis.codec.encode(value) for field, value in fields.items()})
+        if expire:
+            pipe.expire(self.key(uuid), expire)
+
+    async def get(self, uuid, fields=None) -> dict:
+        """ Returns the job (or only the given fields of it), None if it doesn't exist """
+        try:
+            if fields:
+                values = await self.redis.redis.hmget(self.key(uuid), fields)
+                if all(value is None for value in values):
+                    return None
+                return {field: self.redis.codec.decode(value) for field, value in zip(fields, values) if value is not None}
+
+            if job := await self.redis.redis.hgetall(self.key(uuid)):
+                return {field.decode(): self.redis.codec.decode(value) for field, value in job.items()}
+            return None
+
+        except aioredis.ResponseError:
+            # Stored as one json string before jobs became hashes
+            if job := await self.redis.get(self.key(uuid)):
+                return {field: value for field, value in job.items() if not fields or field in fields}
+            return None
+
+    async def migrate(self, uuids=None) -> int:
+        """ Turn jobs stored as one json string, before jobs became hashes, into
+            hashes so they can be updated. All of them unless uuids are given,
+            returns how many were converted. """
+        if uuids is None:
+            uuids = [key.decode()[len(self.prefix):] async for key in 
+                     self.redis.redis.scan_iter(match=f"{self.prefix}*", _type="string")]
+            # The raw events of a job are a string of their own
+            uuids = [uuid for uuid in uuids if not uuid.endswith("-raw")]
+
+        converted = 0
+        for uuid in uuids:
+            converted += await self.convert(uuid)
+        if converted:
+            logger.warning(f"Converted {converted} jobs stored as json strings into hashes")
+        return converted
+
+    async def convert(self, uuid) -> bool:
+        """ Turn one job stored as a json string into a hash, keeping when it expires """
+        key = self.key(uuid)
+        async with self.redis.redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(key)
+                    if await pipe.type(key) != b"string":
+                        return False
+                    job = self.redis.codec.decode(await pipe.get(key))
+                    expire = await pipe.pttl(key)
+
+                    pipe.multi()
+                    pipe.delete(key)
+                    pipe.hset(key, mapping={field: self.redis.codec.encode(value) for field, value in job.items()})
+                    if expire > 0:
+                        pipe.pexpire(key, expire)
+                    await pipe.execute()
+                    return True
+                except aioredis.WatchError:
+                    continue # Changed in the meantime, look again
+
+    async def getMany(self, uuids) -> dict:
+        """ Returns every job by uuid in one round trip, None for the ones that don't exist """
+        async with self.redis.redis.pipeline(transaction=False) as pipe:
+            for uuid in uuids:
+                pipe.hgetall(self.key(uuid))
+            values = await pipe.execute(raise_on_error=False)
+
+        jobs = {}
+        for uuid, job in zip(uuids, values):
+            if isinstance(job, aioredis.ResponseError):
+                jobs[uuid] = await self.get(uuid) # Stored the old way
+            else:
+                jobs[uuid] = {field.decode(): self.redis.codec.decode(value) for field, value in job.items()} or None
+        return jobs
+
+    def rawKey(self, uuid) -> str:
+        return f"{self.prefix}{uuid}-raw"
+
+    def encodeRaw(self, events) -> bytes:
+        data = self.redis.codec.encode(events)
+        return data.encode() if isinstance(data, str) else data
+
+    async def saveRaw(self, uuid, events, expire):
+        """ Store the raw backend events of a job compressed, next to the job """
+        await self.redis.redis.setex(self.rawKey(uuid), expire, zlib.compress(self.encodeRaw(events)))
+
+    def stageRaw(self, pipe, uuid, events, expire):
+        """ Add a saveRaw() to a pipeline """
+        pipe.setex(self.rawKey(uuid), expire, zlib.compress(self.encodeRaw(events)))
+
+    async def getRaw(self, uuid) -> list:
+        if raw := await self.redis.redis.get(self.rawKey(uuid)):
+            return self.redis.codec.decode(zlib.decompress(raw))
+        return None
+
+    async def exists(self, uuid) -> bool:
+        return await self.redis.redis.exists(self.key(uuid)) > 0
+
+    async def delete(self, uuid):
+        await self.redis.redis.delete(self.key(uuid), self.rawKey(uuid))
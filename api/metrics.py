@@ -0,0 +1,146 @@
+import re
+import time
+import asyncio
+import logging
+import collections
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Every metric we know of, as name: (type, help)
+METRICS = {
+    "dreaming_jobs_enqueued_total": ("counter", "Jobs submitted, by how they were handled"),
+    "dreaming_jobs_total": ("counter", "Jobs that left a worker, by how they ended"),
+    "dreaming_queue_wait_seconds": ("histogram", "Time a job spent queued before a worker took it"),
+    "dreaming_first_step_seconds": ("histogram", "Time from sending a job to the backend until its first step"),
+    "dreaming_step_seconds": ("histogram", "Time between two steps of the backend"),
+    "dreaming_generation_seconds": ("histogram", "Time the backend took for a whole job"),
+    "dreaming_image_serve_seconds": ("histogram", "Time to answer an image request"),
+    "dreaming_image_not_modified_total": ("counter", "Image requests answered with 304 Not Modified"),
+    "dreaming_initimg_save_seconds": ("histogram", "Time to write an init image to the init image store"),
+    "dreaming_redis_seconds": ("histogram", "Latency of redis commands"),
+    "dreaming_span_seconds": ("histogram", "Duration of the traced parts of a job"),
+    "dreaming_queue_depth": ("gauge", "Jobs waiting in the queue"),
+    "dreaming_jobs_inflight": ("gauge", "Jobs being worked on"),
+    "dreaming_last_skin": ("gauge", "Skin score of the last generated image"),
+    "dreaming_last_charlen": ("gauge", "Prompt length of the last generated image"),
+    "dreaming_last_processtime_seconds": ("gauge", "Processing time of the last generated image"),
+}
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def series(name, labels) -> str:
+    """ The series as it appears in the exposition format, like name{label="value"} """
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{key}="{escape(value)}"' for key, value in sorted(labels.items())) + "}"
+
+def sortKey(item) -> tuple:
+    """ Sorts series by their labels, and buckets by their bound instead of alphabetically """
+    field = item[0]
+    if bound := re.search(r'[{,]le="([^"]*)"', field):
+        return (field[:bound.start()] + field[bound.end():], float(bound.group(1)))
+    return (field, 0)
+
+def parseSeries(field) -> tuple:
+    """ Returns the metric name of a series and the name its type line goes by """
+    name = field.split("{", 1)[0]
+    for suffix in ("_bucket", "_sum", "_count"):
+        if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+            return name, name[:-len(suffix)]
+    return name, name
+
+class metricsRegistry():
+    """ Collects counters, histograms and gauges in process and adds them
+        to redis every metrics.flush_interval seconds, so every replica
+        (and every scrape) sees the totals of all of them. Reading never
+        resets anything, counters only go up. """
+
+    def __init__(self, key="dreaming-metrics") -> None:
+        self.key = key
+        self.gaugesKey = f"{key}-gauges"
+        self.pending = collections.Counter()
+        self.gauges = {}
+
+    def inc(self, name, value=1, **labels):
+        if settings.metrics.enabled:
+            self.pending[series(name, labels)] += value
+
+    def observe(self, name, value, **labels):
+        """ Add a sample to a histogram, buckets are cumulative like Prometheus wants them """
+        if not settings.metrics.enabled:
+            return
+        for bucket in settings.metrics.buckets:
+            # Empty buckets are added too, every series needs all of them
+            self.pending[series(f"{name}_bucket", {**labels, "le": bucket})] += int(value <= bucket)
+        self.pending[series(f"{name}_bucket", {**labels, "le": "+Inf"})] += 1
+        self.pending[series(f"{name}_sum", labels)] += value
+        self.pending[series(f"{name}_count", labels)] += 1
+
+    def set(self, name, value, **labels):
+        if settings.metrics.enabled:
+            self.gauges[series(name, labels)] = value
+
+    async def flush(self, redis):
+        pending, self.pending = self.pending, collections.Counter()
+        gauges, self.gauges = self.gauges, {}
+        if not pending and not gauges:
+            return
+
+        try:
+            async with redis.redis.pipeline(transaction=False) as pipe:
+                for field, value in pending.items():
+                    pipe.hincrbyfloat(self.key, field, value)
+                if gauges:
+                    pipe.hset(self.gaugesKey, mapping=gauges)
+                await pipe.execute()
+        except Exception as e:
+            # Keep them for the next try
+            self.pending.update(pending)
+            self.gauges = {**gauges, **self.gauges}
+            logging.error(f"Failed to flush metrics ({e})")
+
+    async def flushTask(self, redis):
+        logging.info("Starting metrics flush task")
+        while True:
+            await asyncio.sleep(settings.metrics.flush_interval)
+            await self.flush(redis)
+
+    async def read(self, redis) -> dict:
+        """ Returns every stored series and its value """
+        values = await redis.redis.hgetall(self.key)
+        values.update(await redis.redis.hgetall(self.gaugesKey))
+        return {field.decode(): float(value) for field, value in values.items()}
+
+    def render(self, values) -> str:
+        """ Format series in the Prometheus text exposition format """
+        families = collections.defaultdict(list)
+        for field, value in values.items():
+            families[parseSeries(field)[1]].append((field, value))
+
+        lines = []
+        for family in sorted(families):
+            if family in METRICS:
+                kind, description = METRICS[family]
+                lines.append(f"# HELP {family} {description}")
+                lines.append(f"# TYPE {family} {kind}")
+            for field, value in sorted(families[family], key=sortKey):
+                lines.append(f"{field} {int(value) if float(value).is_integer() else value}")
+        return "\n".join(lines) + "\n"
+
+registry = metricsRegistry()
+
+class timer():
+    """ Observes how long the block took, as in: with timer("name", label="x"): ... """
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        registry.observe(self.name, time.perf_counter() - self.start, **self.labels)
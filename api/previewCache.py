@@ -0,0 +1,74 @@
+import os
+import asyncio
+import logging
+import api.tracing as tracing
+
+from api.imageCache import encodeImage
+from collections import OrderedDict
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+def removeFiles(paths) -> int:
+    """ Delete files that may already be gone, returns how many were deleted """
+    removed = 0
+    for path in paths:
+        try:
+            os.unlink(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+class previewCache():
+    """ Keeps the latest downscaled progress image of running jobs. Workers
+        encode them from lstein's intermediate images in an executor and keep
+        them in memory, and in redis for replicas that don't run the worker.
+        Only the maxJobs most recently updated jobs stay in memory. """
+
+    def __init__(self, redis, maxJobs, prefix="dreaming-preview-") -> None:
+        self.redis = redis
+        self.maxJobs = maxJobs
+        self.prefix = prefix
+        self.entries = OrderedDict()
+
+    @property
+    def mediaType(self) -> str:
+        return f"image/{settings.previews.format}"
+
+    def key(self, uuid) -> str:
+        return f"{self.prefix}{uuid}"
+
+    def url(self, uuid, step) -> str:
+        """ Where clients fetch the preview, the step only makes the url change """
+        return f"job/preview?uuid={uuid}&step={step}"
+
+    async def render(self, path) -> bytes:
+        """ Encode the preview of an intermediate image, None when it can't be read """
+        options = settings.previews
+        try:
+            with tracing.span("preview.encode", format=options.format):
+                return await asyncio.get_event_loop().run_in_executor(
+                    None, encodeImage, path, options.format, options.quality, options.size)
+        except (OSError, ValueError, KeyError) as e: # KeyError when PIL lacks the format
+            logging.warning(f"Failed to make a preview of {path} ({e})")
+            return None
+
+    def put(self, uuid, data):
+        self.entries[uuid] = data
+        self.entries.move_to_end(uuid)
+        while len(self.entries) > self.maxJobs:
+            self.entries.popitem(last=False)
+
+    def stage(self, pipe, uuid, data, expire):
+        """ Keep a new preview, and add writing it to redis to a pipeline """
+        self.put(uuid, data)
+        pipe.setex(self.key(uuid), expire, data)
+
+    def drop(self, uuid):
+        self.entries.pop(uuid, None)
+
+    async def get(self, uuid) -> bytes:
+        if uuid in self.entries:
+            return self.entries[uuid]
+        return await self.redis.redis.get(self.key(uuid))
@@ -1,32 +1,83 @@
-import json
+import time
+import asyncio
 import logging
 import aioredis
+import api.codec as codec
+import api.metrics as metrics
 
 from config import settings
 from typing import Optional, List, Dict
 
 logger = logging.getLogger(__name__)
 
+# Commands that can safely be sent again when it isn't known whether redis got them
+READ_ONLY = {"GET", "MGET", "EXISTS", "HGET", "HMGET", "HGETALL", "HKEYS", "HVALS", "HLEN", 
+             "SMEMBERS", "SCARD", "LRANGE", "LLEN", "LINDEX", "ZRANGE", "ZCARD", "ZRANK", "KEYS", "PING"}
+
 class redisClass:
     
     def __init__(self):
         self.redis: Optional[aioredis.Redis] = None
+        self.codec = codec.createCodec(settings.redisClient.codec)
         
     async def init(self) -> None :
-        self.redis = await aioredis.from_url(settings.redis_url)
+        options = settings.redisClient
+        # Once every connection is in use, commands wait for one to be free
+        # instead of failing right away
+        pool = aioredis.BlockingConnectionPool.from_url(settings.redis_url, 
+            max_connections=options.max_connections,
+            timeout=options.pool_timeout or None,
+            socket_timeout=options.socket_timeout or None,
+            socket_connect_timeout=options.socket_connect_timeout or None,
+            socket_keepalive=True,
+            health_check_interval=options.health_check_interval)
+        self.redis = aioredis.Redis(connection_pool=pool)
+        self.redis.execute_command = self.timed(self.redis.execute_command)
+
+    def timed(self, execute):
+        """ Wraps execute_command to observe the latency of every command,
+            except the blocking ones that wait on purpose, and to retry read
+            only commands with an exponential backoff. Writes are never sent
+            twice, a write that failed halfway may have been done already. """
+        async def execute_command(*args, **options):
+            command = str(args[0]).upper()
+            retries = settings.redisClient.retries if command in READ_ONLY else 0
+            start = time.perf_counter()
+            try:
+                for attempt in range(retries + 1):
+                    try:
+                        return await execute(*args, **options)
+                    except (aioredis.ConnectionError, aioredis.TimeoutError) as e:
+                        if attempt == retries:
+                            raise
+                        backoff = min(settings.redisClient.retry_backoff * 2 ** attempt, 
+                                      settings.redisClient.retry_backoff_cap)
+                        logging.warning(f"Redis {command} failed ({e!r}), retrying in {backoff}s")
+                        await asyncio.sleep(backoff)
+            finally:
+                if not command.startswith("BL"):
+                    metrics.registry.observe("dreaming_redis_seconds", time.perf_counter() - start, command=command)
+        return execute_command
     
     async def close(self) -> None :
-        self.redis_cache.close()
-        await self.redis_cache.wait_closed()
+        if self.redis:
+            await self.redis.close()
+            await self.redis.connection_pool.disconnect()
+
+    def poolStats(self) -> dict:
+        """ How many connections of the pool are in use, the pool holds a
+            free slot (or idle connection) for every one that isn't """
+        pool = self.redis.connection_pool
+        return {"max": pool.max_connections, "in_use": pool.max_connections - pool.pool.qsize()}
 
     async def keys(self, pattern) -> List:
         return await self.redis.keys(pattern)
 
     async def set(self, key, value) -> Dict:
-        return await self.redis.set(key, json.dumps(value))
+        return await self.redis.set(key, self.codec.encode(value))
     
     async def setex(self, key, value, seconds=300000) -> Dict: 
-        return await self.redis.setex(key, seconds, json.dumps(value))
+        return await self.redis.setex(key, seconds, self.codec.encode(value))
 
     async def delete(self, key):
         await self.redis.delete(key)
@@ -34,23 +85,26 @@ class redisClass:
     async def get(self, key) -> Dict:
         resp = await self.redis.get(key)
         if resp:
-            return json.loads(resp)
+            return self.codec.decode(resp)
         return None
 
     async def lpop(self, key) -> Dict:
         resp = await self.redis.lpop(key)
         if resp:
-            return json.loads(resp)
+            return self.codec.decode(resp)
         return None
 
     async def rpop(self, key)  -> Dict :
         resp = await self.redis.rpop(key)
         if resp:
-            return json.loads(resp)
+            return self.codec.decode(resp)
         return None
     
     async def lpush(self, key, value)  -> Dict:
-        return await self.redis.lpush(key, json.dumps(value))
+        return await self.redis.lpush(key, self.codec.encode(value))
+
+    async def publish(self, channel, value) -> int:
+        return await self.redis.publish(channel, self.codec.encode(value))
 
     async def lrange(self, list) -> List: 
         return await self.redis.lrange(list, 0, -1)
\ No newline at end of file
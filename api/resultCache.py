@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import hashlib
+import logging
+
+from config import settings
+from api.stableDiffusionComunicator import normalizeOptions, backendOptions
+
+logger = logging.getLogger(__name__)
+
+# Options that don't change the image
+IGNORED = {"progress_images"}
+# Events of a job that will still produce a result
+ALIVE = ("queued", "generating", "upscaling-started", "upscaling-done")
+
+def canonical(value):
+    """ Numbers arrive as strings from forms and as numbers from json, treat them alike """
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return value
+
+def optionsHash(job, random):
+    """ Hash of the options the backend will get, for either only the jobs
+        with a random seed (leaving the seed out) or only those with a fixed
+        one. None if the job doesn't qualify. """
+    if "prompt" not in job:
+        return None
+
+    try:
+        options = normalizeOptions(**backendOptions(job))
+    except (ValueError, TypeError):
+        return None # The backend is going to refuse it anyway
+
+    if (str(options['seed']).strip() in ("-1", "None")) != random:
+        return None
+
+    if options['initimg']:
+        options['initimg'] = hashlib.sha256(options['initimg'].encode()).hexdigest()
+    if random:
+        options.pop('seed')
+    options = {key: canonical(value) for key, value in options.items() if key not in IGNORED}
+    return hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest()
+
+def batchKey(job) -> str:
+    """ Jobs with the same batch key only differ in their random seed, so
+        the backend can make them in one request as iterations of each other """
+    if not settings.batching.enabled or str(job.get("iterations", 1)).strip() not in ("", "1", "None"):
+        return None
+    return optionsHash(job, random=True)
+
+class resultCache():
+    """ Jobs that ask for exactly the same image share one run: while a job
+        is queued or running, identical jobs attach to it, and once it is done
+        its result is reused for a while. Only jobs with a fixed seed are
+        considered, a random seed never gives the same image twice. """
+
+    def __init__(self, redis, store):
+        self.redis = redis
+        self.store = store
+
+    def fingerprint(self, job) -> str:
+        """ Hash of the options the backend will get, None if the job isn't deterministic """
+        if not settings.resultCache.enabled:
+            return None
+        return optionsHash(job, random=False)
+
+    async def get(self, fingerprint) -> dict:
+        """ Returns the cached result of a fingerprint, if its image still exists """
+        if result := await self.redis.get(f"dreaming-result-{fingerprint}"):
+            if os.path.exists(os.path.join(settings.paths.outputs, os.path.basename(result['url']))):
+                return result
+            await self.forget(fingerprint)
+        return None
+
+    async def attach(self, fingerprint, uuid) -> str:
+        """ Returns the uuid of an identical job that is queued or running, or
+            registers uuid as the one running this fingerprint and returns None. """
+        key = f"dreaming-running-{fingerprint}"
+        if await self.redis.redis.set(key, uuid, nx=True, ex=settings.redisKeys.job_exp):
+            return None
+
+        if (running := await self.redis.redis.get(key)) and (running := running.decode()) != uuid:
+            if (job := await self.store.get(running, ["event"])) and job['event'] in ALIVE:
+                return running
+
+        await self.redis.redis.set(key, uuid, ex=settings.redisKeys.job_exp)
+        return None
+
+    async def release(self, fingerprint, uuid):
+        """ uuid is done, identical jobs can't attach to it anymore """
+        key = f"dreaming-running-{fingerprint}"
+        if (running := await self.redis.redis.get(key)) and running.decode() == uuid:
+            await self.redis.delete(key)
+
+    async def put(self, fingerprint, result):
+        """ Remember a result, forgetting the oldest ones beyond resultCache.max_entries """
+        await self.redis.setex(f"dreaming-result-{fingerprint}", result, settings.resultCache.ttl)
+        async with self.redis.redis.pipeline(transaction=True) as pipe:
+            pipe.zadd("dreaming-results", {fingerprint: time.time()})
+            pipe.zremrangebyscore("dreaming-results", 0, time.time() - settings.resultCache.ttl)
+            pipe.zcard("dreaming-results")
+            *_, count = await pipe.execute()
+
+        if count > settings.resultCache.max_entries:
+            evicted = await self.redis.redis.zpopmin("dreaming-results", count - settings.resultCache.max_entries)
+            await self.redis.redis.delete(*[f"dreaming-result-{fingerprint.decode()}" for fingerprint, _ in evicted])
+
+    async def forget(self, fingerprint):
+        await self.redis.delete(f"dreaming-result-{fingerprint}")
+        await self.redis.redis.zrem("dreaming-results", fingerprint)
@@ -3,8 +3,13 @@ import numpy as np
 
 class skinDetect():
     """ Based on https://github.com/CHEREF-Mehdi/SkinDetection/blob/master/SkinDetection.py """
-    def __init__(self, image):
+    def __init__(self, image, maxSize=None):
         self.img = cv2.imread(image)
+
+        # Scoring a smaller copy is a lot faster and barely changes the percentage
+        if maxSize and max(self.img.shape[:2]) > maxSize:
+            scale = maxSize / max(self.img.shape[:2])
+            self.img = cv2.resize(self.img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
     
     def detect(self):
         height, width, channels = self.img.shape
@@ -26,4 +31,8 @@ class skinDetect():
         global_mask = cv2.medianBlur(global_mask,3)
         global_mask = cv2.morphologyEx(global_mask, cv2.MORPH_OPEN, np.ones((4,4), np.uint8))
         
-        return np.sum(global_mask == 255)/(height * width)*100
\ No newline at end of file
+        return np.sum(global_mask == 255)/(height * width)*100
+
+def detectSkin(image, maxSize=None) -> float:
+    """ Entry point for running the detection in another process """
+    return skinDetect(image=image, maxSize=maxSize).detect()
@@ -1,80 +1,182 @@
-import json
 import time
-import logging
+import asyncio
+import inspect
 import logging
 import aiohttp
+import api.codec as codec
+import api.tracing as tracing
 
 from config import settings
 
 logger = logging.getLogger(__name__)
 
+async def readLines(stream, chunkSize=65536, maxLineSize=16777216):
+    """ Yield every newline terminated line of an aiohttp style stream,
+        reading it in chunks instead of byte by byte. """
+    buffer = bytearray()
+    while chunk := await stream.read(chunkSize):
+        scanFrom = len(buffer) # Only the new bytes can hold a newline
+        buffer += chunk
+
+        start = 0
+        while (end := buffer.find(b"\n", scanFrom)) != -1:
+            yield bytes(buffer[start:end + 1])
+            start = scanFrom = end + 1
+        del buffer[:start]
+
+        if len(buffer) > maxLineSize:
+            raise ValueError(f"Line longer than {maxLineSize} bytes")
+
+def normalizeOptions(prompt, sampler_name ="k_lms", width=512, height=512, initimg=None, 
+                     cfg_scale=7, steps=50, iterations=1, seed=-1, strength=0.75, variation_amount=0, 
+                     seamless=False, gfpgan_strength=0.8, upscale_level=2, upscale_strength=0.75, 
+                     fit="on", with_variations="", progress_images=False) -> dict:
+    """ Returns the options exactly as they will be sent to the backend """
+    options = locals()
+
+    # Limit steps and iterations as defined in config.py
+    if int(options['steps']) > settings.stableDiffusion.max_steps:
+        options['steps'] = settings.stableDiffusion.max_steps
+    
+    if int(options['iterations']) > settings.stableDiffusion.max_itterations:
+        options['iterations'] = settings.stableDiffusion.max_itterations
+
+    #if (not options['with_variations']):
+        # no variations picked, unset variation_amount , remove with_variations from options
+        # options['variation_amount'] = 0
+        # options.pop('with_variations')
+
+    if options['seamless'] == False:
+        options.pop('seamless')
+
+    if options['seed'] == "":
+        options['seed'] = "-1"
+    return options
+
+# What the backend takes, everything else in a job is ours
+OPTIONS = set(inspect.signature(normalizeOptions).parameters)
+
+def backendOptions(job) -> dict:
+    """ The options of a job that go to the backend """
+    return {key: value for key, value in job.items() if key in OPTIONS}
+
 class communicator():
-    responseTimes = []
-    currentJobTime = 0
+
+    def __init__(self, url=settings.sd_url):
+        self.url = url
+        self.responseTimes = []
+        self.currentJobTime = 0
+        self.requests = 0
 
     async def init(self):
-        self.client = aiohttp.ClientSession()
+        self.client = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=settings.backend.connections, 
+                                           keepalive_timeout=settings.backend.keepalive_timeout),
+            timeout=aiohttp.ClientTimeout(total=settings.backend.total_timeout or None,
+                                          connect=settings.backend.connect_timeout,
+                                          sock_read=settings.backend.read_timeout or None))
+
+    async def close(self):
+        await self.client.close()
+
+    def poolStats(self) -> dict:
+        """ How many requests to the backend are running, those beyond the
+            connection limit are waiting for a connection """
+        limit = self.client.connector.limit
+        return {"url": self.url, "limit": limit, "in_use": min(self.requests, limit) if limit else self.requests,
+                "waiting": max(0, self.requests - limit) if limit else 0}
+
+    async def post(self, options) -> aiohttp.ClientResponse:
+        """ Send a request to the backend, retrying with an exponential
+            backoff when no connection could be made. Generating isn't
+            idempotent, so it is never retried once it may have been sent. """
+        for attempt in range(settings.backend.retries + 1):
+            try:
+                return await self.client.post(self.url, json=options)
+            except aiohttp.ClientConnectorError as e:
+                if attempt == settings.backend.retries:
+                    raise
+                backoff = min(settings.backend.retry_backoff * 2 ** attempt, settings.backend.retry_backoff_cap)
+                logging.warning(f"Request to {self.url} failed ({e!r}), retrying in {backoff}s")
+                await asyncio.sleep(backoff)
 
     async def cancelJob(self):
-        async with self.client.get(settings.sd_url + "cancel") as resp:
-            if resp.status == 200:
-                return await resp.read()
+        self.requests += 1
+        try:
+            async with self.client.get(self.url + "cancel") as resp:
+                if resp.status == 200:
+                    return await resp.read()
+        finally:
+            self.requests -= 1
 
     async def generate(self, prompt, sampler_name ="k_lms", width=512, height=512, initimg=None, 
                       cfg_scale=7, steps=50, iterations=1, seed=-1, strength=0.75, variation_amount=0, 
                       seamless=False, gfpgan_strength=0.8, upscale_level=2, upscale_strength=0.75, 
-                      fit="on", with_variations="", progress_images=False):
-        
+                      fit="on", with_variations="", progress_images=False, batch=1):
+        """ Runs a job on the backend, yielding every event it sends. A batch
+            of more than one makes that many images as iterations of the
+            same request, whatever the iterations limit is. """
         options = locals()
         options.pop("self")
+        options.pop("batch")
+        options = normalizeOptions(**options)
+        if batch > 1:
+            options['iterations'] = batch
+                
+        self.requests += 1
+        try:
+            async for event in self.stream(options):
+                yield event
+        finally:
+            self.requests -= 1
 
-        # Limit steps and iterations as defined in config.py
-        if int(options['steps']) > settings.stableDiffusion.max_steps:
-            options['steps'] = settings.stableDiffusion.max_steps
-        
-        if int(options['iterations']) > settings.stableDiffusion.max_itterations:
-            options['iterations'] = settings.stableDiffusion.max_itterations
-
-        #if (not options['with_variations']):
-            # no variations picked, unset variation_amount , remove with_variations from options
-            # options['variation_amount'] = 0
-            # options.pop('with_variations')
-
-        if options['seamless'] == False:
-            options.pop('seamless')
+    async def stream(self, options):
+        """ Send the options to the backend, yielding every event it sends back """
+        try:
+            with tracing.span("backend.connect", url=self.url):
+                resp = await self.post(options)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            logging.error(f"Request to {self.url} failed! ({e!r})")
+            yield {"error": f"Stable Diffusion API end-point could not be reached ({e!r})"}
+            return
 
-        if options['seed'] == "":
-            options['seed'] = "-1"
-                
-        async with self.client.post(settings.sd_url, json=options) as resp:
+        async with resp:
             options.pop('initimg') # Don't print this into the log
-            logging.info(f"Request to {settings.sd_url} ({options})")
+            logging.info(f"Request to {self.url} ({options})")
 
             startTime = time.time()
 
             if resp.status == 200:
-                buffer = b""
                 """ The lstein Stable Diffusion fork returns a new status line in as a stream."""
-                while True:
-                    
-                    if resp.content.at_eof(): # End of line, job done
-                        self.responseTimes.append(time.time() - startTime)
-                        self.currentJobTime = time.time() - startTime
-                        logging.info(f"Job done! Took {self.currentJobTime} ms")
-
-                        if len(self.responseTimes) > 10:
-                            self.responseTimes.pop(0)
-                        return
-                    
-                    else:
-                        respBytes = await resp.content.read(1)
-                        buffer += respBytes
-
-                    if buffer.endswith(b"\n"):
-                          yield json.loads(buffer)
-                          buffer = b""
+                try:
+                    lastLine = None
+                    async for line in readLines(resp.content, settings.stableDiffusion.read_chunk_size,
+                                                settings.stableDiffusion.max_line_size):
+                        # Spans can't be kept open over a yield, time these by hand
+                        if lastLine is None:
+                            tracing.record("backend.first_byte", time.time() - startTime)
+                        else:
+                            tracing.record("backend.event", time.time() - lastLine)
+                        lastLine = time.time()
+                        yield codec.loads(line)
+                except ValueError as e:
+                    logging.error(f"Failed to read the response of {self.url} ({e})")
+                    yield {"error": f"Stable Diffusion API end-point returned an invalid response ({e})"}
+                    return
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logging.error(f"Lost the response of {self.url} ({e!r})")
+                    yield {"error": f"Stable Diffusion API end-point stopped responding ({e!r})"}
+                    return
+
+                # End of stream, job done
+                self.responseTimes.append(time.time() - startTime)
+                self.currentJobTime = time.time() - startTime
+                logging.info(f"Job done! Took {self.currentJobTime} ms")
+
+                if len(self.responseTimes) > 10:
+                    self.responseTimes.pop(0)
             else:
-                logging.error(f"Request to {settings.sd_url} failed! Got status code of {resp.status} ({options})")
+                logging.error(f"Request to {self.url} failed! Got status code of {resp.status} ({options})")
                 yield {"error": f"Stable Diffusion API end-point returned a http-status code of {resp.status}"}
 
             return
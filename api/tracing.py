@@ -0,0 +1,113 @@
+import time
+import uuid
+import random
+import asyncio
+import logging
+import contextvars
+import collections
+import sentry_sdk
+import api.metrics as metrics
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# The trace of the job being handled by the current task
+currentTrace = contextvars.ContextVar("currentTrace", default=None)
+
+class timings():
+    """ The last tracing.samples durations of every span name in this
+        process, for /debug/timings """
+
+    def __init__(self) -> None:
+        self.samples = {}
+
+    def add(self, name, seconds):
+        if name not in self.samples:
+            self.samples[name] = collections.deque(maxlen=settings.tracing.samples)
+        self.samples[name].append(seconds)
+
+    def summary(self) -> dict:
+        summary = {}
+        for name, samples in sorted(self.samples.items()):
+            ordered = sorted(samples)
+            summary[name] = {"count": len(ordered), "mean": round(sum(ordered) / len(ordered), 6),
+                             "p50": round(ordered[len(ordered) // 2], 6),
+                             "p99": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))], 6),
+                             "max": round(ordered[-1], 6)}
+        return summary
+
+recent = timings()
+
+def newTrace() -> dict:
+    """ Start the trace of a new job, whether it is sampled is decided once for the whole job """
+    return {"id": uuid.uuid4().hex, "sampled": random.random() < settings.tracing.sample_rate}
+
+def sentryEnabled() -> bool:
+    return sentry_sdk.Hub.current.client is not None
+
+def record(name, seconds):
+    """ Add a duration that was measured by hand, for time spans across yields or tasks """
+    if not settings.tracing.enabled:
+        return
+    recent.add(name, seconds)
+    metrics.registry.observe("dreaming_span_seconds", seconds, span=name)
+
+async def loopLagTask():
+    """ Measures how late the event loop wakes up a sleeping task, anything
+        blocking the loop shows up here as loop.lag """
+    interval = settings.tracing.loop_lag_interval
+    logging.info("Starting event loop lag monitor")
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        record("loop.lag", max(0.0, time.perf_counter() - start - interval))
+
+class span():
+    """ Times a block, as in: with span("job.save", uuid=uuid): ...
+        Always counted in the local timings and the span histogram, only
+        sent to Sentry when the current trace is sampled. """
+
+    def __init__(self, name, **tags):
+        self.name = name
+        self.tags = tags
+        self.sentrySpan = None
+
+    def __enter__(self):
+        trace = currentTrace.get()
+        if settings.tracing.enabled and trace and trace['sampled'] and sentryEnabled():
+            self.sentrySpan = sentry_sdk.start_span(op=self.name)
+            for key, value in self.tags.items():
+                self.sentrySpan.set_tag(key, value)
+            self.sentrySpan.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start)
+        if self.sentrySpan:
+            self.sentrySpan.__exit__(*exc)
+
+class jobTrace():
+    """ Makes the trace of a job current for every span in the block, and
+        wraps them in a Sentry transaction when it is sampled """
+
+    def __init__(self, job, name):
+        self.trace = job.get("trace") or newTrace()
+        self.name = name
+        self.uuid = job.get("uuid")
+        self.transaction = None
+
+    def __enter__(self):
+        self.token = currentTrace.set(self.trace)
+        if settings.tracing.enabled and self.trace['sampled'] and sentryEnabled():
+            self.transaction = sentry_sdk.start_transaction(op="job", name=self.name,
+                trace_id=self.trace['id'], sampled=True)
+            self.transaction.set_tag("uuid", self.uuid)
+            self.transaction.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        if self.transaction:
+            self.transaction.__exit__(*exc)
+        currentTrace.reset(self.token)
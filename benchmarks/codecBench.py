@@ -0,0 +1,47 @@
+""" Compares the cost of encoding and decoding jobs with every codec that
+    is installed, on a queued job, a job halfway and a finished job.
+
+    python -m benchmarks.codecBench [rounds]
+"""
+import sys
+import time
+
+from api import codec
+from benchmarks.rawEvents import fakeJob
+
+def payloads() -> dict:
+    job, events = fakeJob(50)
+    queued = {key: value for key, value in job.items() if key not in ("result", "step")}
+    queued['event'] = "queued"
+    return {"queued": queued, 
+            "generating": dict(queued, event="generating", step=25, url="000042.1234567.25.png"),
+            "done": dict(job, raw=events[-3:])}
+
+def measure(instance, payload, rounds) -> tuple:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        data = instance.encode(payload)
+    encode = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        instance.decode(data)
+    decode = time.perf_counter() - start
+    return encode / rounds * 1e6, decode / rounds * 1e6, len(data)
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    codecs = [codec.jsonCodec()]
+    if codec.orjson:
+        codecs.append(codec.orjsonCodec())
+    if codec.msgpack:
+        codecs.append(codec.msgpackCodec())
+
+    print(f"{'payload':>10} {'codec':>8} {'encode':>10} {'decode':>10} {'bytes':>7}")
+    for name, payload in payloads().items():
+        for instance in codecs:
+            encode, decode, size = measure(instance, payload, rounds)
+            print(f"{name:>10} {instance.name:>8} {encode:8.2f}us {decode:8.2f}us {size:7}")
+
+if __name__ == "__main__":
+    main()
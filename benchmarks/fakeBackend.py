@@ -0,0 +1,109 @@
+""" A stand-in for lstein's Stable Diffusion server, for running (and load
+    testing) the API without a GPU. It streams step, upscaling and result
+    events like lstein does, writes small dummy images where the API looks
+    for them, and stops a job on /cancel.
+
+    python -m benchmarks.fakeBackend [--port 9090] [--step-time 0.05] [--outputs DIR]
+
+    Point sd_url (or sd_urls) at it and paths.outputs at the same DIR.
+"""
+import os
+import io
+import json
+import random
+import asyncio
+import argparse
+
+from aiohttp import web
+from PIL import Image
+
+class fakeBackend():
+    def __init__(self, outputs, stepTime, upscaleTime, imageSize, concurrency):
+        self.outputs = outputs
+        self.stepTime = stepTime
+        self.upscaleTime = upscaleTime
+        self.imageSize = imageSize
+        # lstein runs one job at a time on its GPU
+        self.gpu = asyncio.Semaphore(concurrency)
+        self.canceled = False
+        self.counter = 0
+        os.makedirs(os.path.join(outputs, "intermediates"), exist_ok=True)
+
+    def writeImage(self, path, seed):
+        """ A flat colored png, picked by the seed so images differ """
+        rng = random.Random(seed)
+        image = Image.new("RGB", (self.imageSize, self.imageSize),
+                          (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)))
+        buffer = io.BytesIO()
+        image.save(buffer, format="png")
+        with open(path, "wb") as f:
+            f.write(buffer.getvalue())
+
+    async def send(self, response, event):
+        await response.write(json.dumps(event).encode() + b"\n")
+
+    async def generate(self, request):
+        options = await request.json()
+        steps = int(options.get("steps", 50))
+        iterations = int(options.get("iterations", 1))
+        seed = int(options.get("seed", -1))
+
+        response = web.StreamResponse(headers={"Content-Type": "application/json"})
+        await response.prepare(request)
+
+        async with self.gpu:
+            self.canceled = False
+            for iteration in range(iterations):
+                self.counter += 1
+                imageSeed = seed if seed != -1 and iteration == 0 else random.randint(0, 2**32 - 1)
+                prefix = f"{self.counter:06}.{imageSeed}"
+
+                for step in range(1, steps + 1):
+                    await asyncio.sleep(self.stepTime)
+                    if self.canceled:
+                        await response.write_eof()
+                        return response
+
+                    url = None
+                    if options.get("progress_images"):
+                        path = os.path.join(self.outputs, "intermediates", f"{prefix}.{step}.png")
+                        self.writeImage(path, imageSeed + step)
+                        url = f"outputs/img-samples/intermediates/{prefix}.{step}.png"
+                    await self.send(response, {"event": "step", "step": step, "url": url})
+
+                if float(options.get("upscale_level") or 0) or float(options.get("gfpgan_strength") or 0):
+                    await self.send(response, {"event": "upscaling-started", "processed_file_cnt": 1})
+                    await asyncio.sleep(self.upscaleTime)
+                    await self.send(response, {"event": "upscaling-done"})
+
+                self.writeImage(os.path.join(self.outputs, f"{prefix}.png"), imageSeed)
+                config = {key: value for key, value in options.items() if key != "initimg"}
+                await self.send(response, {"event": "result", "url": f"outputs/img-samples/{prefix}.png",
+                                           "seed": imageSeed, "config": dict(config, seed=imageSeed)})
+
+        await response.write_eof()
+        return response
+
+    async def cancel(self, request):
+        self.canceled = True
+        return web.Response(text="canceled")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=9090)
+    parser.add_argument("--outputs", default="/tmp/dreaming-fake-outputs")
+    parser.add_argument("--step-time", type=float, default=0.05, help="seconds per step")
+    parser.add_argument("--upscale-time", type=float, default=0.5, help="seconds per upscale")
+    parser.add_argument("--image-size", type=int, default=512)
+    parser.add_argument("--concurrency", type=int, default=1, help="jobs generated at the same time")
+    args = parser.parse_args()
+
+    backend = fakeBackend(args.outputs, args.step_time, args.upscale_time, args.image_size, args.concurrency)
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post("/", backend.generate)
+    app.router.add_get("/cancel", backend.cancel)
+    print(f"Fake backend writing images to {args.outputs}")
+    web.run_app(app, port=args.port)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+""" Drives a running API with N concurrent clients and reports throughput,
+    p50/p99 latency per endpoint and the event loop lag of both sides.
+    Every client submits jobs through / (streamed, like the web interface)
+    or /dream (then polling /job/get), and fetches the result through the
+    image endpoints. Run it against the fake backend to measure the API
+    without a GPU:
+
+    python -m benchmarks.fakeBackend --step-time 0.02 &
+    python -m benchmarks.loadTest [--url http://localhost:8000] [--clients 20] [--jobs 10]
+"""
+import json
+import time
+import random
+import asyncio
+import argparse
+import collections
+
+import aiohttp
+
+def percentile(samples, fraction) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+class loadTest():
+    def __init__(self, url, steps):
+        self.url = url.rstrip("/")
+        self.steps = steps
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.lag = []
+
+    def job(self) -> dict:
+        return {"prompt": f"a load test of the dreaming api {random.randint(0, 1000)}", "steps": self.steps,
+                "cfg_scale": 7.5, "sampler_name": "k_lms", "width": 512, "height": 512, "seed": -1,
+                "strength": 0.75, "gfpgan_strength": 0, "upscale_level": "", "upscale_strength": 0.75,
+                "fit": "on", "progress_images": "off", "initimg_name": ""}
+
+    async def timed(self, name, request):
+        """ Time a request until its whole body is read """
+        start = time.perf_counter()
+        try:
+            async with request as response:
+                body = await response.read()
+                if response.status >= 400:
+                    self.errors[f"{name} {response.status}"] += 1
+                    return None
+                return body
+        except aiohttp.ClientError as e:
+            self.errors[f"{name} {type(e).__name__}"] += 1
+            return None
+        finally:
+            self.latencies[name].append(time.perf_counter() - start)
+
+    async def streamed(self, session) -> str:
+        """ Submit like the web interface does, reading the stream until the result """
+        start = time.perf_counter()
+        uuid = None
+        async with session.post(f"{self.url}/", json=self.job()) as response:
+            async for line in response.content:
+                if line.strip():
+                    uuid = json.loads(line).get("uuid", uuid)
+        self.latencies["/ (until done)"].append(time.perf_counter() - start)
+        return uuid
+
+    async def polled(self, session) -> str:
+        """ Submit like the bots do, polling /job/get once a second """
+        body = await self.timed("/dream", session.post(f"{self.url}/dream", json=self.job()))
+        if not body:
+            return None
+        uuid = json.loads(body)['uuid']
+        while True:
+            await asyncio.sleep(1)
+            body = await self.timed("/job/get", session.get(f"{self.url}/job/get", params={"uuid": uuid}))
+            if not body or json.loads(body)['event'] in ("done", "canceled"):
+                return uuid
+
+    async def client(self, session, jobs):
+        for _ in range(jobs):
+            start = time.perf_counter()
+            uuid = await (self.streamed(session) if random.random() < 0.5 else self.polled(session))
+            if not uuid:
+                continue
+            await self.timed("/job/image", session.get(f"{self.url}/job/image", params={"uuid": uuid}))
+            await self.timed("/job/image?size=256", session.get(f"{self.url}/job/image",
+                             params={"uuid": uuid, "size": 256}))
+            await self.timed("/job/jpg", session.get(f"{self.url}/job/jpg", params={"uuid": uuid}))
+            self.latencies["job"].append(time.perf_counter() - start)
+
+    async def lagMonitor(self, interval=0.1):
+        """ How late the load test's own loop wakes up, a busy client skews the numbers """
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.lag.append(time.perf_counter() - start - interval)
+
+    async def run(self, clients, jobs):
+        monitor = asyncio.create_task(self.lagMonitor())
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=600)
+        async with aiohttp.ClientSession(timeout=timeout, connector=aiohttp.TCPConnector(limit=0)) as session:
+            start = time.perf_counter()
+            await asyncio.gather(*[self.client(session, jobs) for _ in range(clients)])
+            took = time.perf_counter() - start
+
+            async with session.get(f"{self.url}/debug/timings") as response:
+                timings = await response.json() if response.status == 200 else {}
+        monitor.cancel()
+        self.report(took, timings)
+
+    def report(self, took, timings):
+        done = len(self.latencies["job"])
+        print(f"{done} jobs in {took:.1f}s, {done / took:.2f} jobs/s")
+        print(f"{'endpoint':>22} {'requests':>9} {'req/s':>8} {'p50':>9} {'p99':>9}")
+        for name, samples in sorted(self.latencies.items()):
+            print(f"{name:>22} {len(samples):9} {len(samples) / took:8.2f} "
+                  f"{percentile(samples, 0.5) * 1000:7.1f}ms {percentile(samples, 0.99) * 1000:7.1f}ms")
+        for error, count in self.errors.items():
+            print(f"error {error}: {count}")
+
+        if self.lag:
+            print(f"load test loop lag: p50 {percentile(self.lag, 0.5) * 1000:.1f}ms "
+                  f"p99 {percentile(self.lag, 0.99) * 1000:.1f}ms max {max(self.lag) * 1000:.1f}ms")
+        if lag := timings.get("loop.lag"):
+            print(f"api loop lag: p50 {lag['p50'] * 1000:.1f}ms p99 {lag['p99'] * 1000:.1f}ms max {lag['max'] * 1000:.1f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--jobs", type=int, default=10, help="jobs per client")
+    parser.add_argument("--steps", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(loadTest(args.url, args.steps).run(args.clients, args.jobs))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+""" Estimates how many bytes 1000 finished jobs take in redis for every
+    reporting.raw_events mode, by encoding them the way jobStore does.
+
+    python -m benchmarks.rawEvents [steps]
+"""
+import sys
+import json
+import zlib
+import uuid
+
+def fakeJob(steps):
+    job = {"prompt": "a photograph of an astronaut riding a horse, trending on artstation",
+           "steps": steps, "cfg_scale": 7.5, "sampler_name": "k_lms", "width": 512, "height": 512,
+           "seed": -1, "uuid": str(uuid.uuid1()), "initiator": "web", "event": "done", "step": steps}
+    events = [{"event": "step", "step": step, "url": None} for step in range(1, steps + 1)]
+    events += [{"event": "upscaling-started", "processed_file_cnt": 1}, {"event": "upscaling-done"}]
+    result = {"event": "result", "url": "outputs/img-samples/000042.1234567.png", "seed": 1234567, 
+              "config": {key: job[key] for key in ("prompt", "steps", "cfg_scale", "sampler_name", "width", "height")}}
+    events.append(result)
+    job['result'] = result
+    return job, events
+
+def hashSize(job) -> int:
+    return sum(len(field) + len(json.dumps(value)) for field, value in job.items())
+
+def main():
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    sizes = {"off": 0, "last": 0, "compressed": 0, "everything (old)": 0}
+
+    for _ in range(1000):
+        job, events = fakeJob(steps)
+        sizes["off"] += hashSize(job)
+        sizes["last"] += hashSize(dict(job, raw=events[-3:]))
+        sizes["compressed"] += hashSize(job) + len(zlib.compress(json.dumps(events).encode()))
+        sizes["everything (old)"] += len(json.dumps(dict(job, raw=events)))
+
+    for mode, size in sizes.items():
+        print(f"{mode:>17}: {size / 1024:10.1f} KiB per 1000 jobs")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+""" Measures the time the worker spends waiting on redis for the progress
+    writes of a 50 step job, against the redis in redis_url. It compares one
+    await per command (as the worker used to write), one pipeline per event
+    (flushProgress) and pipelines with steps coalesced by
+    workers.min_update_interval. Events are replayed as fast as redis takes
+    them, the step time only decides which steps are coalesced. Only keys of
+    the "dreaming-bench-" jobs and worker are written.
+
+    python -m benchmarks.redisWrites [--jobs 20] [--step-time 0.1]
+"""
+import time
+import asyncio
+import argparse
+
+import api.jobStore as jobStore
+import api.redisClass as redisClass
+import api.backgroundWorker as backgroundWorker
+
+from api.jobBroadcaster import JOB_CHANNEL
+from benchmarks.rawEvents import fakeJob
+from config import settings
+
+STEPS = 50
+
+def events(stepTime):
+    """ (time, event) as lstein sends them """
+    timeline = [(step * stepTime, {"event": "step", "step": step, "url": None}) for step in range(1, STEPS + 1)]
+    end = STEPS * stepTime
+    timeline += [(end + 0.5, {"event": "upscaling-started"}), (end + 2.5, {"event": "upscaling-done"}),
+                 (end + 2.6, {"event": "result", "url": "outputs/img-samples/000001.1.png", "seed": 1})]
+    return timeline
+
+class benchmark():
+    def __init__(self, redis, worker, store, stepTime):
+        self.redis = redis
+        self.worker = worker
+        self.store = store
+        self.stepTime = stepTime
+        self.trips = 0
+
+    async def unpipelined(self, job, respLine, fields, cancelKey):
+        """ Every command awaited on its own """
+        await self.redis.redis.setex(self.worker.statusKey, settings.redisKeys.working_exp,
+                                     self.redis.codec.encode({"uuid": job['uuid'], "status": respLine}))
+        if fields:
+            await self.store.update(job['uuid'], {field: job[field] for field in fields}, settings.redisKeys.job_exp)
+            await self.redis.redis.publish(f"{JOB_CHANNEL}{job['uuid']}", self.redis.codec.encode(job))
+            self.trips += 2
+        await self.redis.redis.exists(cancelKey)
+        self.trips += 2
+
+    async def run(self, index, mode) -> float:
+        """ Replays one job, returns the seconds spent waiting on redis """
+        job, _ = fakeJob(STEPS)
+        job.update({"uuid": f"dreaming-bench-{mode}-{index}", "event": "queued", "progress_images": False})
+        job.pop("result", None)
+        await self.store.create(job, 600)
+        cancelKeys = [f"dreaming-cancel-{job['uuid']}"]
+        changed = {job['uuid']: set()}
+        interval = settings.workers.min_update_interval if mode == "pipelined, coalesced" else 0
+
+        waited = 0.0
+        lastFlush = float("-inf")
+        for arrival, respLine in events(self.stepTime):
+            changed[job['uuid']].update(self.worker.jobprocessRespline(respLine, job))
+            if respLine['event'] != "step" or arrival - lastFlush >= interval:
+                start = time.perf_counter()
+                if mode == "one await per command":
+                    await self.unpipelined(job, respLine, changed[job['uuid']], cancelKeys[0])
+                    changed[job['uuid']] = set()
+                else:
+                    await self.worker.flushProgress([job], respLine, changed, cancelKeys)
+                    self.trips += 1
+                waited += time.perf_counter() - start
+                lastFlush = arrival
+
+        # The final state of the job and resetting the worker
+        job.update({"event": "done", "result": respLine})
+        start = time.perf_counter()
+        if mode == "one await per command":
+            await self.store.update(job['uuid'], {"event": job['event'], "result": job['result']}, 3000)
+            await self.redis.redis.publish(f"{JOB_CHANNEL}{job['uuid']}", self.redis.codec.encode(job))
+            await self.redis.redis.delete(self.worker.workingKey)
+            await self.redis.redis.set(self.worker.statusKey, self.redis.codec.encode({"status": "Awaiting prompts."}))
+            self.trips += 4
+        else:
+            async with self.redis.redis.pipeline(transaction=False) as pipe:
+                self.worker.stageSave(pipe, job, ["event", "result"], 3000)
+                pipe.delete(self.worker.workingKey)
+                pipe.set(self.worker.statusKey, self.redis.codec.encode({"status": "Awaiting prompts."}))
+                await pipe.execute()
+            self.trips += 1
+        waited += time.perf_counter() - start
+
+        await self.store.delete(job['uuid'])
+        return waited
+
+async def main(jobs, stepTime):
+    redis = redisClass.redisClass()
+    await redis.init()
+    store = jobStore.jobStore(redis=redis)
+    worker = backgroundWorker.backendWorker(name="dreaming-bench", url=settings.sd_url, redis=redis, queue=None,
+                                            store=store, results=None, costs=None, initImages=None,
+                                            previews=None, skinPool=None)
+    bench = benchmark(redis, worker, store, stepTime)
+
+    print(f"{jobs} jobs of {STEPS} steps of {stepTime}s against {settings.redis_url}")
+    print(f"{'mode':>22} {'round trips':>12} {'redis/job':>10} {'p50':>9} {'max':>9}")
+    for mode in ("one await per command", "pipelined", "pipelined, coalesced"):
+        await bench.run(0, mode) # Warm up the connection
+        bench.trips = 0
+        waited = sorted([await bench.run(index, mode) for index in range(jobs)])
+        print(f"{mode:>22} {bench.trips / jobs:12.0f} {sum(waited) / jobs * 1000:8.1f}ms "
+              f"{waited[jobs // 2] * 1000:7.1f}ms {waited[-1] * 1000:7.1f}ms")
+    await redis.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--step-time", type=float, default=0.1, help="seconds between two steps of the backend")
+    args = parser.parse_args()
+    asyncio.run(main(args.jobs, args.step_time))
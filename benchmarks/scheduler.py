@@ -0,0 +1,71 @@
+""" Simulates one busy hour of the queue with the old FIFO list and with the
+    fair scheduler, and prints the wait time distribution of every group.
+
+    python -m benchmarks.scheduler [workers]
+"""
+import sys
+import random
+import collections
+
+from api.jobQueue import fairOrder
+
+JOB_TIME = 12 # seconds per job, roughly a 50 step 512x512 job
+
+def arrivals(seed=42):
+    """ (time, initiator, user) of every job. One discord user floods the queue,
+        a handful of bot users and a steady stream of web users don't. """
+    rng = random.Random(seed)
+    jobs = [(rng.uniform(0, 30), "discord", "spammer") for _ in range(50)]
+    jobs += [(rng.uniform(0, 1800), "irc", f"irc{rng.randint(0, 5)}") for _ in range(30)]
+    jobs += [(rng.uniform(0, 1800), "web", f"10.0.0.{n}") for n in range(60)]
+    return sorted(jobs)
+
+class fifo():
+    def __init__(self):
+        self.items = collections.deque()
+
+    def push(self, lane, flow, item, weight=1):
+        self.items.append(item)
+
+    def pop(self):
+        return self.items.popleft() if self.items else None
+
+def simulate(queue, jobs, workers):
+    waits = collections.defaultdict(list)
+    free = [0.0] * workers
+    pending = collections.deque(jobs)
+    queued = 0
+
+    while pending or queued:
+        worker = min(range(workers), key=lambda index: free[index])
+        now = free[worker]
+        if not queued and pending and pending[0][0] > now:
+            now = pending[0][0]
+
+        while pending and pending[0][0] <= now:
+            arrived, initiator, user = pending.popleft()
+            queue.push("normal", f"{initiator}:{user}", (arrived, initiator))
+            queued += 1
+
+        arrived, initiator = queue.pop()
+        queued -= 1
+        waits[initiator].append(now - arrived)
+        free[worker] = now + JOB_TIME * random.uniform(0.8, 1.2)
+    return waits
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    for name, queue in (("fifo", fifo()), ("fair", fairOrder(["normal"]))):
+        random.seed(1)
+        waits = simulate(queue, arrivals(), workers)
+        print(f"{name} ({workers} worker(s)), wait in seconds")
+        for initiator, values in sorted(waits.items()):
+            print(f"  {initiator:>8}: n={len(values):3} p50={percentile(values, 0.5):7.1f} "
+                  f"p90={percentile(values, 0.9):7.1f} p99={percentile(values, 0.99):7.1f} max={max(values):7.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+""" Compares skin detection on the full image against downscaled copies,
+    printing the time per image and how far the score is off.
+
+    python -m benchmarks.skinDetector image.png [image.png ...]
+"""
+import sys
+import time
+
+from api.skinDetector import detectSkin
+
+SIZES = [0, 1024, 768, 512, 384, 256]
+
+def main():
+    images = sys.argv[1:]
+    if not images:
+        print(__doc__)
+        return
+
+    results = {size: [] for size in SIZES}
+    for image in images:
+        for size in SIZES:
+            start = time.perf_counter()
+            score = detectSkin(image, size)
+            results[size].append((score, time.perf_counter() - start))
+
+    print(f"{'max size':>9} {'ms/image':>9} {'mean abs error':>15} {'max abs error':>14}")
+    for size in SIZES:
+        errors = [abs(score - full[0]) for (score, _), full in zip(results[size], results[0])]
+        took = sum(took for _, took in results[size]) / len(images) * 1000
+        print(f"{size or 'full':>9} {took:9.1f} {sum(errors) / len(errors):15.3f} {max(errors):14.3f}")
+
+if __name__ == "__main__":
+    main()
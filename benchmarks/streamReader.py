@@ -0,0 +1,70 @@
+""" Replays a (recorded) lstein response stream through the old byte by byte
+    reader and the chunked readLines, and prints the bytes/sec of both.
+
+    python -m benchmarks.streamReader [recording.jsonl]
+"""
+import sys
+import json
+import time
+import random
+import asyncio
+
+from api.stableDiffusionComunicator import readLines
+
+class replayStream():
+    """ Stands in for aiohttp's StreamReader, serving a recording from memory """
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def at_eof(self):
+        return self.offset >= len(self.data)
+
+    async def read(self, n=-1):
+        chunk = self.data[self.offset:self.offset + n]
+        self.offset += len(chunk)
+        return chunk
+
+def fakeRecording(steps=50, progressImages=True) -> bytes:
+    """ Something that looks like what lstein streams back for one job """
+    lines = []
+    for step in range(1, steps + 1):
+        url = f"outputs/img-samples/intermediates/000042.{random.randint(0, 2**32)}.{step}.png" if progressImages else None
+        lines.append({"event": "step", "step": step, "url": url})
+    lines.append({"event": "upscaling-started", "processed_file_cnt": 1})
+    lines.append({"event": "upscaling-done"})
+    lines.append({"event": "result", "url": "outputs/img-samples/000042.1234567.png", "seed": 1234567,
+                  "config": {"prompt": "a photograph of an astronaut riding a horse " * 4,
+                             "initimg": "data:image/png;base64," + "A" * 400000, "steps": steps}})
+    return b"".join(json.dumps(line).encode() + b"\n" for line in lines)
+
+async def oldReader(stream):
+    buffer = b""
+    while True:
+        if stream.at_eof():
+            return
+        buffer += await stream.read(1)
+        if buffer.endswith(b"\n"):
+            yield buffer
+            buffer = b""
+
+async def measure(name, reader, data, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        lines = [line async for line in reader(replayStream(data))]
+    took = time.perf_counter() - start
+    print(f"{name:>10}: {len(lines)} lines, {len(data) * rounds / took / 1e6:10.2f} MB/s")
+
+async def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "rb") as f:
+            data = f.read()
+    else:
+        data = fakeRecording()
+
+    print(f"Replaying {len(data)} bytes")
+    await measure("byte-wise", oldReader, data, 1)
+    await measure("chunked", readLines, data, 50)
+
+if __name__ == "__main__":
+    asyncio.run(main())
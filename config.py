@@ -1,3 +1,6 @@
+import socket
+
+from typing import List, Dict
 from pydantic import BaseSettings
 
 #TODO add documentation
@@ -5,9 +8,27 @@ from pydantic import BaseSettings
 class StableDiffusion(BaseSettings):
         max_steps: int = 85
         max_itterations: int = 1
+        # How many bytes to read from the response stream at once
+        read_chunk_size: int = 65536
+        # Give up on a response line that grows beyond this many bytes
+        max_line_size: int = 16777216
 
 class Reporting(BaseSettings):
         calculate_skin: bool = True
+        # Processes used for skin detection, so it never blocks the worker
+        skin_workers: int = 1
+        # Skip skin detection when this many jobs are already waiting for it
+        skin_max_pending: int = 8
+        # Score a copy that is at most this many pixels wide/high, 0 scores the
+        # full image. Downscaling is much faster but changes the reported skin
+        # value a little, so it is off unless asked for.
+        skin_max_size: int = 0
+        # What to keep of the raw events lstein sent for a job: nothing (off),
+        # the last raw_events_last in the job (last) or all of them compressed
+        # in a separate key that expires after raw_events_exp seconds (compressed)
+        raw_events: str = "off"
+        raw_events_last: int = 3
+        raw_events_exp: int = 600
 
 class RedisKeys(BaseSettings):
         # The experation time of 'dreaming-working', 
@@ -18,14 +39,235 @@ class RedisKeys(BaseSettings):
         job_exp:int = 3600 
 
 
+class RedisClient(BaseSettings):
+        # Connections in the pool, every waiting worker and the job
+        # broadcaster hold one of their own.
+        max_connections: int = 64
+        # How long (in seconds) a command waits for a free connection when
+        # all of them are in use, before it fails. 0 waits forever.
+        pool_timeout: float = 10
+        # Seconds, 0 means no timeout. socket_timeout has to be longer
+        # than queue.block_timeout.
+        socket_timeout: float = 10
+        socket_connect_timeout: float = 5
+        health_check_interval: int = 30
+        # Retry a failed read only command this many times, waiting an
+        # exponentially growing time starting at retry_backoff seconds.
+        # Writes are never retried.
+        retries: int = 3
+        retry_backoff: float = 0.05
+        retry_backoff_cap: float = 2
+        # How values are encoded in redis: "json", "orjson" or "msgpack".
+        # Every codec reads what the others wrote, switch json to orjson
+        # first and only use msgpack once every replica has the library.
+        codec: str = "json"
+
+class Backend(BaseSettings):
+        # Connections per Stable Diffusion backend
+        connections: int = 4
+        keepalive_timeout: float = 60
+        # Seconds, 0 means no timeout. read_timeout is the longest the
+        # backend may stay silent in the middle of a job.
+        connect_timeout: float = 10
+        read_timeout: float = 300
+        total_timeout: float = 0
+        # Retry a request this many times when the backend can't be reached
+        retries: int = 3
+        retry_backoff: float = 0.5
+        retry_backoff_cap: float = 10
+
+class Paths(BaseSettings):
+        # Where lstein's Stable Diffusion writes its images
+        outputs: str = "/home/nurds/stable-diffusion/outputs/img-samples"
+        # Where uploaded init images are kept, named by their sha256. Every
+        # replica running workers has to see the same directory.
+        init_images: str = "/home/nurds/dreaming/init-images"
+
+class InitImages(BaseSettings):
+        # Largest init image that can be uploaded, in bytes
+        max_size: int = 16777216
+        # Delete init images no job used for this long (in seconds),
+        # keep it longer than jobs can stay queued
+        max_age: int = 172800
+
+class Images(BaseSettings):
+        # How many bytes of converted (jpeg/thumbnail) images to keep in memory
+        cache_size: int = 67108864
+        jpeg_quality: int = 75
+        max_thumbnail_size: int = 1024
+        # How long (in seconds) clients may cache served images
+        max_age: int = 86400
+
+class Previews(BaseSettings):
+        # Turn lstein's intermediate images into small previews on the job stream
+        enabled: bool = True
+        # webp or jpeg
+        format: str = "webp"
+        quality: int = 60
+        size: int = 256
+        # How many jobs keep their latest preview in memory
+        cache_jobs: int = 256
+        # Delete intermediate images once a newer one (or the result) replaced them
+        delete_intermediates: bool = True
+
+class Queue(BaseSettings):
+        # How long (in seconds) a worker blocks waiting for a job before
+        # asking again, keep it below the redis socket timeout.
+        block_timeout: float = 5
+        # Most jobs /jobs/batch takes in one request
+        max_batch: int = 100
+        # Most jobs /jobs/status looks up in one request
+        max_status: int = 1000
+
+class Workers(BaseSettings):
+        # Whether this instance takes jobs from the queue, turn it off
+        # on replicas that should only serve the API.
+        enabled: bool = True
+        # Prefix of the worker names, has to be unique for every replica
+        name: str = socket.gethostname()
+        # How often (in seconds) workers let redis know they are alive
+        heartbeat: int = 5
+        # How often (in seconds) to look for workers without a heartbeat,
+        # whose unfinished jobs are put back in the queue
+        reap_interval: int = 30
+        # Least time (in seconds) between two progress writes of a job,
+        # steps in between are written together. Results, upscaling and
+        # errors are always written right away.
+        min_update_interval: float = 0.25
+        # When redis can't be reached, workers try again after this many
+        # seconds, doubling every attempt up to retry_backoff_cap
+        retry_backoff: float = 0.5
+        retry_backoff_cap: float = 10
+
+class Telemetry(BaseSettings):
+        # Where GPU readings come from: auto (nvml, falling back on
+        # nvidia-smi), nvml, nvidia-smi, fake or off
+        source: str = "auto"
+        nvidia_smi: str = "/usr/bin/nvidia-smi"
+        gpu_index: int = 0
+        # Seconds between readings while a job runs, and while idle
+        interval: float = 1
+        idle_interval: float = 10
+
+class Scheduler(BaseSettings):
+        # Priority lanes, highest first. A lane only gets a turn when
+        # every lane above it is empty.
+        lanes: List[str] = ["high", "normal", "low"]
+        default_lane: str = "normal"
+        # Lane of the jobs of an initiator (web, api, irc, discord, ...)
+        initiator_lanes: Dict[str, str] = {}
+        # Tokens of trusted clients (the irc and discord bots) and the initiator
+        # they are. Only a client sending one in the X-Dreaming-Token header
+        # names the user (and optionally the lane) of its jobs, everyone else
+        # is "api" or "web" and scheduled by address.
+        trusted_tokens: Dict[str, str] = {}
+        # Addresses of the load balancers in front of the API, for requests
+        # from them the client address is taken from X-Forwarded-For
+        trusted_proxies: List[str] = []
+        # How many jobs in a row a user of an initiator gets per turn, 1 if not set
+        weights: Dict[str, int] = {}
+        # Most jobs a single user can have queued, 0 for no limit
+        max_queued_per_user: int = 0
+
+class ResultCache(BaseSettings):
+        # Attach jobs with a fixed seed to an identical queued or running
+        # job, and answer them from earlier results
+        enabled: bool = True
+        # How long (in seconds) results are reused
+        ttl: int = 86400
+        # Most results to remember, the oldest are forgotten first
+        max_entries: int = 10000
+
+class Batching(BaseSettings):
+        # Run queued jobs that only differ in their random seed as one
+        # backend request, the backend makes them as iterations of it.
+        enabled: bool = False
+        # Most jobs in one request
+        max_size: int = 4
+        # How long (in seconds) a worker waits for more jobs to join a
+        # batch that isn't full yet
+        window: float = 0.25
+
+class Metrics(BaseSettings):
+        # Collect counters and latency histograms, served on /metrics
+        enabled: bool = True
+        # How often (in seconds) a replica adds what it collected to redis
+        flush_interval: int = 5
+        # Upper bounds (in seconds) of the histogram buckets
+        buckets: List[float] = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+class Tracing(BaseSettings):
+        # Time the parts of every job, see /debug/timings
+        enabled: bool = True
+        # Share of the jobs that is also sent to Sentry (when it is set up)
+        sample_rate: float = 0.1
+        # How many of the last durations of every span /debug/timings is about
+        samples: int = 1000
+        # How often (in seconds) the event loop lag is measured, 0 to turn it off
+        loop_lag_interval: float = 0.5
+
+class Costs(BaseSettings):
+        # Weight of a new job in the learned means, higher adapts faster
+        alpha: float = 0.1
+        # How often (in seconds) a replica reads the learned costs
+        refresh_interval: int = 30
+        # Used until the first jobs are done: seconds before the first step,
+        # per step of 512x512 and for upscaling/face restoration
+        default_overhead: float = 2.0
+        default_step: float = 0.2
+        default_postprocess: float = 3.0
+
+class Admission(BaseSettings):
+        # What happens to a new job when the predicted wait is over max_wait:
+        # "off", "reject" (429 with Retry-After) or "degrade" (cap its steps)
+        mode: str = "off"
+        # Seconds
+        max_wait: int = 900
+        degraded_steps: int = 20
+
+class Streaming(BaseSettings):
+        # "pubsub" pushes job updates to the web streams as the worker
+        # publishes them, "poll" reads every job from redis once a second.
+        mode: str = "pubsub"
+        # Resend the job to the client at least this often (in seconds)
+        # even when nothing changed, this also refreshes the GPU info.
+        keepalive: int = 10
+        # How many unsent events a client can have before old ones are dropped
+        queue_size: int = 32
+        # How many unsent events a /jobs/events client can have before it is
+        # disconnected, a feed can't skip updates of other jobs
+        feed_queue_size: int = 256
+        # Most jobs a /jobs/events client can watch by uuid
+        feed_max_uuids: int = 1000
+
 class Settings(BaseSettings):
    sentry_sdk: str = ""
    redis_url: str = "redis://localhost:6379/0?encoding=utf-8"
    sd_url: str= "http://localhost:9090/"
+   # Run jobs on several Stable Diffusion backends at once, one worker 
+   # per url. When empty only sd_url is used.
+   sd_urls: List[str] = []
    
    redisKeys = RedisKeys()
    stableDiffusion = StableDiffusion()
    reporting = Reporting()
+   streaming = Streaming()
+   queue = Queue()
+   workers = Workers()
+   scheduler = Scheduler()
+   resultCache = ResultCache()
+   batching = Batching()
+   metrics = Metrics()
+   tracing = Tracing()
+   costs = Costs()
+   admission = Admission()
+   paths = Paths()
+   images = Images()
+   previews = Previews()
+   initImages = InitImages()
+   telemetry = Telemetry()
+   redisClient = RedisClient()
+   backend = Backend()
 
    class Config:
         env_file = ".env"
@@ -1,23 +1,36 @@
 import os
-import io
+import hmac
+import math
 import uuid
-import json
+import secrets
 import time
 import asyncio
 import logging
 import sentry_sdk
 import coloredlogs
 
+import api.codec as codec
+import api.metrics as metrics
+import api.tracing as tracing
+import api.jobQueue as jobQueue
+import api.costModel as costModel
+import api.jobStore as jobStore
+import api.resultCache as resultCache
+import api.imageCache as imageCache
+import api.initImageStore as initImageStore
+import api.previewCache as previewCache
+import api.jobBroadcaster as jobBroadcaster
 import api.redisClass as redisClass
 import api.backgroundWorker as backgroundWorker
-import api.stableDiffusionComunicator as stableDiffusionComunicator
 
-from PIL import Image
 from config import settings
+from email.utils import formatdate
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import FastAPI, HTTPException, Response, Request, Form
-from fastapi.responses import StreamingResponse, PlainTextResponse, HTMLResponse
+from starlette.datastructures import UploadFile
+from typing import List
+from fastapi import FastAPI, HTTPException, Response, Request, Form, Query
+from fastapi.responses import StreamingResponse, PlainTextResponse, HTMLResponse, FileResponse, JSONResponse, ORJSONResponse
 
 # Setup logging
 logging.config.fileConfig('logging.conf', disable_existing_loggers=False)
@@ -27,15 +40,24 @@ coloredlogs.install(level='INFO', logger=logger)
 
 # Setup classes
 redis = redisClass.redisClass()
-client = stableDiffusionComunicator.communicator()
-background = backgroundWorker.backgroundWorkerClass(redis=redis, client=client)
+queue = jobQueue.jobQueue(redis=redis)
+store = jobStore.jobStore(redis=redis)
+results = resultCache.resultCache(redis=redis, store=store)
+costs = costModel.costModel(redis=redis)
+initImages = initImageStore.initImageStore(path=settings.paths.init_images, maxSize=settings.initImages.max_size)
+previews = previewCache.previewCache(redis=redis, maxJobs=settings.previews.cache_jobs)
+background = backgroundWorker.backgroundWorkerClass(redis=redis, queue=queue, store=store, results=results, 
+                                                    costs=costs, initImages=initImages, previews=previews)
+broadcaster = jobBroadcaster.jobBroadcaster(redis=redis, annotate=lambda jobs: streamInfo(jobs))
+images = imageCache.imageCache(maxBytes=settings.images.cache_size)
 
 # Setup sentry, if enabled
 if settings.sentry_sdk != "":
-    sentry_sdk.init(settings.sentry_sdk, traces_sample_rate=1.0)
+    sentry_sdk.init(settings.sentry_sdk, traces_sample_rate=settings.tracing.sample_rate)
 
 # Setup fastapi
-app = FastAPI()
+# orjson encodes responses several times faster, when it is installed
+app = FastAPI(default_response_class=ORJSONResponse if codec.orjson else JSONResponse)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 app.add_middleware( CORSMiddleware, allow_origins=["*"], 
         allow_credentials=True, allow_methods=["*"], 
@@ -44,18 +66,59 @@ app.add_middleware( CORSMiddleware, allow_origins=["*"],
 async def getJobPos(uuid:str) -> dict:
     """ Return the job position of uid, as well as the total items
         in the queue and if we are currently working on something. """
-    matchingJobPos = -1
-    pos = 0
-    queue = [json.loads(job) for job in await redis.lrange("sd-queue")]
-
-    for job in reversed(queue):
-        if job['uuid'] == uuid:
-            matchingJobPos = pos
-        pos += 1
-
-    if len(queue) >= 1:
-        return {"pos": matchingJobPos + 1, "total": len(queue) + 1, "working": background.working}
-    return {"pos": 0, "total": 0, "working": background.working}
+    await costs.refresh()
+    return formatJobPos(*await queue.position(uuid))
+
+def formatJobPos(rank, length, inflight, queued=0, cost=0) -> dict:
+    """ eta is the predicted seconds until the job is done, None when it isn't queued """
+    if length >= 1:
+        return {"pos": rank + 1, "total": length + inflight, "working": inflight > 0, "inflight": inflight,
+                "eta": costs.eta(rank, length, inflight, queued, cost)}
+    return {"pos": 0, "total": 0, "working": inflight > 0, "inflight": inflight, "eta": None}
+
+# The position of a job that left the queue, no need to look at the queue for it
+NOT_QUEUED = formatJobPos(-1, 0, 1)
+
+async def streamInfo(jobs: dict) -> dict:
+    """ What web streams show along with every job of jobs (uuid: job, None when it
+        isn't known): the position of those that may be queued, found in one pass
+        over the queue, and the GPU info. """
+    maybeQueued = [uuid for uuid, job in jobs.items() if not job or job.get("event") == "queued"]
+    positions = {}
+    if maybeQueued:
+        await costs.refresh()
+        positions = {uuid: formatJobPos(*position) for uuid, position in (await queue.positions(maybeQueued)).items()}
+    gpu = await background.getGpu()
+    return {uuid: {"jobpos": positions.get(uuid, NOT_QUEUED), "gpu": gpu} for uuid in jobs}
+
+async def streamLine(uuid, job) -> tuple:
+    """ Turn a job into a line for the web interface, returns 
+        the line and whether the job is finished. """
+    job = dict(job)
+
+    # Add GPU info to the output, updates from the broadcaster come with it
+    if "jobpos" not in job:
+        job.update((await streamInfo({uuid: job}))[uuid])
+    
+    if "initimg" in job:
+        job.pop("initimg") # Don't send back base64 data to the client
+
+    if job['event'] == "canceled": 
+        return codec.dumps(job) + "\n", True
+
+    if job['event'] == "done": 
+        # Make the response into something how
+        # the web interface wants it
+        job['event'] = "result"
+        job.update(job['result'])
+        job.pop('result') # Remove result and raw, the client does not like a lot of data at once
+        job.pop('raw', None)
+        return codec.dumps(job) + "\n", True
+
+    if job['event'] == "generating":
+        job['event'] = "step"
+    
+    return codec.dumps(job) + "\n", False
 
 async def interfaceStreamer(uuid):
     """ Stream every event as a new line, in json format. 
@@ -63,102 +126,183 @@ async def interfaceStreamer(uuid):
         So that we can just use that with minimial modding instead
         of making our own.
     """
-    while True:
-        job = await redis.get(f"dreaming-job-{uuid}")
-        if not job:
-            yield json.dumps({"event": "error", "message": f"Failed to find uuid {uuid}"}) + "\n"
-            return
-
-        # Add GPU info to the output
-        job.update({"jobpos": await getJobPos(uuid),
-            "gpu": {
-                "temp": background.smi['nvidia_smi_log']['gpu']['temperature']['gpu_temp'],
-                "power": background.smi['nvidia_smi_log']['gpu']['power_readings']['power_draw'],
-                "util": background.smi['nvidia_smi_log']['gpu']['utilization']['gpu_util'],
-                "pci": {
-                    "tx_util": background.smi['nvidia_smi_log']['gpu']['pci']['tx_util'],
-                    "rx_util": background.smi['nvidia_smi_log']['gpu']['pci']['rx_util'],
-                }
-            }})
-        
-        if "initimg" in job:
-            job.pop("initimg") # Don't send back base64 data to the client
-
-        if job['event'] == "canceled": 
-            yield json.dumps(job) + "\n"
-            break
-
-        if job['event'] == "done": 
-            # Make the response into something how
-            # the web interface wants it
-            job['event'] = "result"
-            job.update(job['result'])
-            job.pop('result') # Remove result and raw, the client does not like a lot of data at once
-            job.pop('raw')
-            yield json.dumps(job) + "\n"
-            break
-        else:
-            if job['event'] == "generating":
-                job['event'] = "step"
-            
-            yield json.dumps(job) + "\n"
-        await asyncio.sleep(1.00)
-
-def calculateResponseTimes() -> float:
-    """ Calculates the average response times """
-    responseTime = 0
-    for resptimeEntry in client.responseTimes:
-        responseTime += resptimeEntry
-    
-    if responseTime == 0:
-        return 0.0
-    
-    return round((responseTime / len(client.responseTimes)), 3)
-
-def imageAsJpeg(image_path: str) -> io.BytesIO:
-    """ Convert an image in-memory to jpeg and return a bytesio"""
-    img = Image.open(image_path).convert("RGB")
-    ioimg = io.BytesIO()
-    img.save(ioimg, format="jpeg")
-    ioimg.seek(0)
-    return ioimg
+    if settings.streaming.mode == "poll":
+        while True:
+            job = await store.get(uuid)
+            if not job:
+                yield codec.dumps({"event": "error", "message": f"Failed to find uuid {uuid}"}) + "\n"
+                return
+
+            line, finished = await streamLine(uuid, job)
+            yield line
+            if finished:
+                return
+            await asyncio.sleep(1.00)
+
+    # Subscribe before reading the job, so no update can slip in between
+    events = broadcaster.subscribe(uuid)
+    try:
+        job = await store.get(uuid)
+        broadcaster.seen(uuid, job)
+        while True:
+            if not job:
+                yield codec.dumps({"event": "error", "message": f"Failed to find uuid {uuid}"}) + "\n"
+                return
+
+            line, finished = await streamLine(uuid, job)
+            yield line
+            if finished:
+                return
+
+            # The broadcaster adds the position and GPU info to every update,
+            # once for all the streams watching
+            try:
+                update = await asyncio.wait_for(events.get(), timeout=settings.streaming.keepalive)
+            except asyncio.TimeoutError:
+                # Nothing happened, resend the job with fresh GPU info
+                job = {**job, "gpu": await background.getGpu()}
+                continue
+
+            if update['event'] == "deleted":
+                job = None
+            elif update['event'] == "queue":
+                # The queue moved, only the position changed
+                job = {**job, **{key: update[key] for key in ("jobpos", "gpu") if key in update}}
+            else:
+                job = update
+    finally:
+        broadcaster.unsubscribe(uuid, events)
+
+def serverSentEvent(event, data) -> str:
+    return f"event: {event}\ndata: {codec.dumps(data)}\n\n"
+
+async def eventFeed(feed):
+    """ Stream the updates a feed asks for as server-sent events, starting
+        with the current state of every job it watches by uuid. """
+    broadcaster.subscribeFeed(feed)
+    try:
+        for uuid in feed.uuids:
+            if job := await store.get(uuid):
+                job.pop("initimg", None)
+                job.pop("raw", None)
+                yield serverSentEvent("job", job)
+            else:
+                yield serverSentEvent("error", {"uuid": uuid, "message": f"Failed to find uuid {uuid}"})
+
+        while True:
+            try:
+                update = await asyncio.wait_for(feed.get(), timeout=settings.streaming.keepalive)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+
+            if update['event'] == "dropped":
+                yield serverSentEvent("dropped", {"message": "Too far behind, reconnect to continue"})
+                return
+            yield serverSentEvent("queue" if update['event'] == "queue" else "job", update)
+    finally:
+        broadcaster.unsubscribeFeed(feed)
+
+def imageHeaders(imagePath: str, variant: str = "") -> dict:
+    """ Caching headers of an image, generated images never change """
+    stat = os.stat(imagePath)
+    return {"ETag": f'"{stat.st_mtime_ns:x}-{stat.st_size:x}{variant}"',
+            "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+            "Cache-Control": f"public, max-age={settings.images.max_age}"}
+
+async def serveImage(request: Request, imagePath: str, jpeg: bool = False, size: int | None = None) -> Response:
+    """ Serve an image from disk, or a (cached) jpeg version of it """
+    if not os.path.exists(imagePath):
+        raise HTTPException(status_code=404, detail="Failed to find generate image locally.")
+
+    if size:
+        size = min(size, settings.images.max_thumbnail_size)
+    headers = imageHeaders(imagePath, f"-jpeg{size or ''}" if jpeg or size else "")
+
+    if request.headers.get("if-none-match") == headers['ETag']:
+        metrics.registry.inc("dreaming_image_not_modified_total")
+        return Response(status_code=304, headers=headers)
+
+    if jpeg or size:
+        with metrics.timer("dreaming_image_serve_seconds", kind="thumbnail" if size else "jpeg"):
+            image = await images.get(imagePath, quality=settings.images.jpeg_quality, size=size)
+        return Response(image, media_type="image/jpeg", headers=headers)
+    return FileResponse(imagePath, media_type="image/png", headers=headers)
 
 @app.on_event('startup')
 async def startup_event():
     """ Initialize async functions on startup"""
     await redis.init()
-    await client.init()
+    await queue.init()
+    # Before any worker can write to a job stored the old way
+    await store.migrate()
     await background.init()
+    if settings.streaming.mode == "pubsub":
+        await broadcaster.init()
+    if settings.metrics.enabled:
+        asyncio.create_task(metrics.registry.flushTask(redis))
+    if settings.tracing.enabled and settings.tracing.loop_lag_interval:
+        asyncio.create_task(tracing.loopLagTask())
+    asyncio.create_task(initImages.pruneTask(settings.initImages.max_age))
 
 @app.on_event('shutdown')
 async def shutdown_event():
-    """ Initialize async functions on startup"""
+    """ Wait for the local workers and close connections on shutdown"""
     if background.working:
         print("Waiting for job to finish...")
         while background.working:
             await asyncio.sleep(0.10)
 
-    await client.client.close()
+    await broadcaster.close()
+    await background.close()
+    await metrics.registry.flush(redis)
+    await redis.close()
     logging.warning("Gracefully exiting... Good-bye!")
 
 @app.get("/job/get")
 async def get_job(uuid: str):
     """ Returns the job straight from Redis """
-    if job := await redis.get(f"dreaming-job-{uuid}"):
+    if job := await store.get(uuid):
         if job['event'] == "queued":
             job['queue'] = await getJobPos(uuid)
         return job
     raise HTTPException(status_code=404, detail="UUID not found")
 
+@app.get("/jobs/status")
+async def get_jobs(uuid: List[str] = Query([])):
+    """ Returns many jobs at once by uuid, null for the ones that don't exist.
+        Raw events are left out, see /job/raw. """
+    if len(uuid) > settings.queue.max_status:
+        raise HTTPException(status_code=400, detail=f"Can't look up more than {settings.queue.max_status} jobs")
+
+    jobs = await store.getMany(uuid)
+    await costs.refresh()
+    positions = await queue.positions([key for key, job in jobs.items() if job and job['event'] == "queued"])
+    for key, job in jobs.items():
+        if job:
+            job.pop("raw", None)
+            if key in positions:
+                job['queue'] = formatJobPos(*positions[key])
+    return jobs
+
+@app.get("/job/raw")
+async def get_job_raw(uuid: str):
+    """ Returns the raw events lstein sent for a job, if they were kept """
+    if raw := await store.getRaw(uuid):
+        return raw
+    if job := await store.get(uuid, ["event", "raw"]):
+        return job.get("raw", [])
+    raise HTTPException(status_code=404, detail="UUID not found")
+
 @app.get("/job/cancel")
 async def get_job(uuid: str):
     """ Returns the job straight from Redis """
     
-    if job := await redis.get(f"dreaming-job-{uuid}"):
-        if background.workingUuid == uuid:
-            background.jobCanceled = True
-        else:
-            await redis.delete(f"dreaming-job-{uuid}")
+    if await store.exists(uuid):
+        if not await background.cancel(uuid):
+            await queue.remove(uuid)
+            await store.delete(uuid)
+            await redis.publish(f"{jobBroadcaster.JOB_CHANNEL}{uuid}", {"event": "deleted", "uuid": uuid})
         return {"status": f"OK"}
     
     raise HTTPException(status_code=404, detail="UUID not found")
@@ -167,81 +311,339 @@ async def get_job(uuid: str):
 @app.get("/job/delete")
 async def delete_job(uuid: str):
     """ Remove a job from the queue"""
-    await redis.delete(f"dreaming-job-{uuid}")
+    await queue.remove(uuid)
+    await store.delete(uuid)
+    await redis.publish(f"{jobBroadcaster.JOB_CHANNEL}{uuid}", {"event": "deleted", "uuid": uuid})
     return {"status": f"OK"}
 
+@app.get("/jobs/events")
+async def job_events(uuid: List[str] = Query([]), all: bool = False, queue: bool = False):
+    """ Server-sent events for every given uuid, or for every job when all is set, 
+        over one connection. Queue changes are sent too when queue is set. """
+    if settings.streaming.mode != "pubsub":
+        raise HTTPException(status_code=503, detail="Job feeds need streaming.mode pubsub")
+    if len(uuid) > settings.streaming.feed_max_uuids:
+        raise HTTPException(status_code=400, detail=f"Can't watch more than {settings.streaming.feed_max_uuids} jobs")
+    if not uuid and not all and not queue:
+        raise HTTPException(status_code=400, detail="Give at least one uuid, all or queue")
+
+    feed = jobBroadcaster.feed(uuids=uuid, everything=all, queueEvents=queue)
+    return StreamingResponse(eventFeed(feed), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.get("/job/list")
 async def list_jobs():
     """ List all jobs in the qeueue """
-    jobs = []
-    for pos, job in enumerate(await redis.lrange("sd-queue")):
-        jobs.append({"job": json.loads(job), "pos": pos})
-    return jobs
+    return [{"job": job, "pos": pos} for pos, job in enumerate(await queue.list())]
 
 @app.get("/status")
 async def list_jobs():
     """ Return some status information """
-    return {"status": await redis.get("dreaming-status"), 
-            "working": await redis.get("dreaming-working"),
-            "nvidia": background.smi, "queuesize": len(await redis.lrange('sd-queue'))}
+    workers = await background.status()
+    return {"status": {worker['name']: worker['status'] for worker in workers}, 
+            "working": [worker['uuid'] for worker in workers if worker['uuid']],
+            "workers": workers,
+            "nvidia": await background.getGpu(), "gpus": await background.getGpus(),
+            "queuesize": await queue.length()}
+
+@app.get("/debug/pools")
+async def pool_stats():
+    """ Return how saturated the redis and backend connection pools of this process are """
+    return {"redis": redis.poolStats(), "backends": [worker.client.poolStats() for worker in background.workers]}
+
+@app.get("/debug/timings")
+async def debug_timings():
+    """ Return how long the traced parts of a job took lately in this process, in seconds """
+    return tracing.recent.summary()
 
 @app.get("/gpu") #TODO change path
-async def gpu_info():
-    """ Return nvidia-smi data as json"""
-    return background.smi
+async def gpu_info(host: str | None = None):
+    """ Return GPU telemetry as json, of this replica (or any) unless a host is given """
+    if gpu := await background.getGpu(host):
+        return gpu
+    raise HTTPException(status_code=503, detail="No GPU telemetry available (yet)")
+
+async def currentMetrics() -> dict:
+    """ Everything the replicas collected, plus the queue as it is right now """
+    values = await metrics.registry.read(redis)
+    for lane, length in (await queue.lengths()).items():
+        values[metrics.series("dreaming_queue_depth", {"lane": lane})] = length
+    values["dreaming_jobs_inflight"] = len(await background.workingUuids())
+    return values
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """ Return all metrics in the Prometheus text format, reading them doesn't reset them """
+    return PlainTextResponse(metrics.registry.render(await currentMetrics()), 
+                             media_type="text/plain; version=0.0.4")
 
 @app.get("/telegraf", response_class=PlainTextResponse)
 async def telegraf():
-    """ Return a influxDB status line for Telegraf. """
-    stats = await redis.get("sd-stats")
-    await redis.delete("sd-stats")
-    if stats:
-        stats = json.loads(stats)
-        return f"dreaming skin={stats['skin']},charlen={stats['charlen']},processtime={stats['processtime']},queuesize={len(await redis.lrange('sd-queue'))}"
-    return f"dreaming skin=0.0,charlen=0,processtime=0,queuesize=0"
+    """ Return a influxDB status line for Telegraf, about the last generated image. """
+    values = await currentMetrics()
+    return (f"dreaming skin={values.get('dreaming_last_skin', 0.0)},"
+            f"charlen={int(values.get('dreaming_last_charlen', 0))},"
+            f"processtime={values.get('dreaming_last_processtime_seconds', 0.0)},"
+            f"queuesize={await queue.length()}")
 
 @app.get("/job/image")
-async def job_image(uuid: str, jpeg: bool | None = False):
-    """ Return a generatd image based on the uuid, if jpeg is set to true it will return it as jpeg """
+async def job_image(request: Request, uuid: str, jpeg: bool | None = False, size: int | None = None):
+    """ Return a generatd image based on the uuid, if jpeg is set to true it will return it as jpeg.
+        Size returns a jpeg thumbnail that fits in size x size. """
     # For the time being, we can only handle single files
-    if job := await redis.get(f"dreaming-job-{uuid}"):
+    if job := await store.get(uuid, ["event", "result"]):
         if not "result" in job:
             raise HTTPException(status_code=404, detail="Job is likely still being generated. Please see /job/get")
         
-        # throw error if image doesn't exist
-        imagePath = os.path.join("/home/nurds/stable-diffusion/outputs/img-samples", os.path.basename(job['result']['url']))
-    
-        if not os.path.exists(imagePath):
-            raise HTTPException(status_code=404, detail="Failed to find generate image locally.")
-        
-        if jpeg:
-            return Response(imageAsJpeg(imagePath).read(), media_type="Image/Jpeg")
-        else:
-            with open(imagePath, "rb") as f:
-                return Response(f.read(), media_type="Image/PNG")
+        imagePath = os.path.join(settings.paths.outputs, os.path.basename(job['result']['url']))
+        return await serveImage(request, imagePath, jpeg=jpeg, size=size)
     
     return {"error": f"Couldn't find a job with uuid {uuid}"} #change to 404
 
 #TODO code me better
 @app.get("/job/image/intermediates")
-async def job_image_inter(image):
-    imagePath = os.path.join("/home/nurds/stable-diffusion/outputs/img-samples/intermediates/", image)
-    with open(imagePath, "rb") as f:
-            return Response(f.read(), media_type="Image/PNG")
+async def job_image_inter(request: Request, image):
+    imagePath = os.path.join(settings.paths.outputs, "intermediates", os.path.basename(image))
+    return await serveImage(request, imagePath)
+
+@app.get("/job/preview")
+async def job_preview(uuid: str, step: int | None = None):
+    """ The latest downscaled progress image of a job, as linked by the preview field
+        of its updates. The step in those links only makes them change every update. """
+    if data := await previews.get(uuid):
+        return Response(data, media_type=previews.mediaType, headers={"Cache-Control": "private, max-age=3600"})
+    raise HTTPException(status_code=404, detail="No preview of this job (yet)")
 
 @app.get("/job/jpg")
-async def job_image(uuid: str):
+async def job_image(request: Request, uuid: str):
     # For the time being, we can only handle single files
-    if job := await redis.get(f"dreaming-job-{uuid}"):
+    if job := await store.get(uuid, ["event", "result"]):
         if not "result" in job:
             return {"error": "Job is likely still being generated. Please see /job/get"}
-        # throw error if image doesn't exist
-        imagePath = os.path.join("/home/nurds/stable-diffusion/outputs/img-samples", os.path.basename(job['result']['url']))
-    
-        if not os.path.exists(imagePath):
-            return Response(status_code=404)
-        
-        return Response(imageAsJpeg(imagePath).read(), media_type="Image/Jpeg")
+
+        imagePath = os.path.join(settings.paths.outputs, os.path.basename(job['result']['url']))
+        return await serveImage(request, imagePath, jpeg=True)
+
+async def admit(job: dict, pendingCost: float = 0, pendingJobs: int = 0):
+    """ Predict the cost of a new job and apply admission control: when the predicted
+        wait is over admission.max_wait the job is refused, or its steps are capped.
+        Jobs admitted along with this one that aren't queued yet are the pending ones. """
+    await costs.refresh()
+    job['cost'] = costs.predict(job)
+    if settings.admission.mode == "off":
+        return
+
+    length, inflight, queued = await queue.totals()
+    wait = costs.wait(queued + pendingCost, length + pendingJobs, inflight)
+    if wait <= settings.admission.max_wait:
+        return
+
+    if settings.admission.mode == "degrade":
+        if int(job.get("steps") or 50) > settings.admission.degraded_steps:
+            job.update({"steps": settings.admission.degraded_steps, "degraded": True})
+            job['cost'] = costs.predict(job)
+            # It isn't the image that was asked for anymore
+            if fingerprint := job.pop("fingerprint", None):
+                await results.release(fingerprint, job['uuid'])
+            # Nor can it run along with the jobs that still have all their steps
+            if job.get("batch"):
+                job['batch'] = resultCache.batchKey(job)
+        return
+
+    metrics.registry.inc("dreaming_jobs_enqueued_total", initiator=job.get("initiator"), outcome="overloaded")
+    retry = math.ceil(wait - settings.admission.max_wait)
+    raise HTTPException(status_code=429, headers={"Retry-After": str(retry)},
+                        detail=f"The queue is too long, try again in {retry} seconds")
+
+async def storeInitImage(job: dict):
+    """ Jobs only carry a reference to their init image. An image sent inline
+        as a base64 data url is written to the init image store first. """
+    initimg = job.get("initimg")
+    if not initimg:
+        return
+    if initImageStore.isReference(initimg):
+        # Jobs keep using an image, so it isn't pruned while they are queued
+        if not initImages.touch(initimg):
+            raise HTTPException(status_code=400, detail="Unknown init image, upload it to /initimg first")
+        return
+    if not isinstance(initimg, str):
+        raise HTTPException(status_code=400, detail="initimg must be a data url or a reference from /initimg")
+
+    try:
+        with metrics.timer("dreaming_initimg_save_seconds", kind="inline"):
+            job['initimg'] = await initImages.saveDataUrl(initimg)
+    except initImageStore.imageTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="initimg isn't valid base64")
+
+def trustedInitiator(request: Request) -> str:
+    """ The initiator a trusted client is, by its token. None for everyone else. """
+    if token := request.headers.get("x-dreaming-token"):
+        for trusted, initiator in settings.scheduler.trusted_tokens.items():
+            if hmac.compare_digest(token.encode(), trusted.encode()):
+                return initiator
+    return None
+
+# Fields of a job only the server sets, a client sending them could pass its job off
+# as another one (a forged fingerprint would put its image in the result cache, a
+# forged batch would run it in the request of someone else's jobs)
+SERVER_FIELDS = ("fingerprint", "batch", "cached", "result", "cost", "degraded", "trace", "error", "raw", "url", "step", "preview")
+
+def dropServerFields(job: dict):
+    """ Forget whatever a client sent in the fields the server sets, see identify() for the user """
+    for field in SERVER_FIELDS:
+        job.pop(field, None)
+
+def clientAddress(request: Request) -> str:
+    """ The address of the client. Behind the proxies in scheduler.trusted_proxies
+        it is the last address X-Forwarded-For names that isn't one of them. """
+    address = request.client.host if request.client else None
+    if address in settings.scheduler.trusted_proxies:
+        forwarded = [hop.strip() for header in request.headers.getlist("x-forwarded-for") 
+                     for hop in header.split(",") if hop.strip()]
+        for hop in reversed(forwarded):
+            address = hop
+            if hop not in settings.scheduler.trusted_proxies:
+                break
+    return address
+
+addressKey = None
+
+async def anonymize(address: str) -> str:
+    """ A client address as jobs keep it, hashed with a key every replica shares.
+        It tells clients apart for scheduling, but doesn't show their address. """
+    global addressKey
+    if not addressKey:
+        await redis.redis.set("dreaming-address-key", secrets.token_hex(32), nx=True)
+        addressKey = await redis.redis.get("dreaming-address-key")
+    return hmac.new(addressKey, address.encode(), "sha256").hexdigest()[:16]
+
+async def identify(request: Request, job: dict):
+    """ Decide whom a job is scheduled for. Trusted clients name the initiator by
+        their token and send the user and lane, the initiator the endpoint set and
+        the (anonymized) client address are used for everyone else. """
+    if initiator := trustedInitiator(request):
+        job['initiator'] = initiator
+        return
+    job.pop("lane", None)
+    address = clientAddress(request)
+    job['user'] = await anonymize(address) if address else None
+
+async def enqueueJob(request: Request, job: dict) -> dict:
+    """ Store a new job and queue it, see identify() for whom it is scheduled.
+        A job identical to one that is queued, running or recently done returns that
+        job (or a copy of its result) instead. """
+    dropServerFields(job)
+    await identify(request, job)
+    job['trace'] = tracing.newTrace()
+
+    with tracing.jobTrace(job, "enqueue"), tracing.span("enqueue", initiator=job.get("initiator")):
+        await storeInitImage(job)
+        if fingerprint := results.fingerprint(job):
+            job['fingerprint'] = fingerprint
+            with tracing.span("enqueue.results"):
+                if result := await results.get(fingerprint):
+                    job.update({"event": "done", "result": result, "cached": True})
+                    metrics.registry.inc("dreaming_jobs_enqueued_total", initiator=job.get("initiator"), outcome="cached")
+                    return await store.create(job, 3000)
+
+                if running := await results.attach(fingerprint, job['uuid']):
+                    if existing := await store.get(running):
+                        metrics.registry.inc("dreaming_jobs_enqueued_total", initiator=job.get("initiator"), outcome="attached")
+                        return existing
+
+        elif batch := resultCache.batchKey(job):
+            job['batch'] = batch
+
+        await admit(job)
+        with tracing.span("enqueue.store"):
+            job = await store.create(job, 12000)
+        try:
+            with tracing.span("enqueue.push"):
+                await queue.push(job)
+        except jobQueue.queueLimitReached as e:
+            await store.delete(job['uuid'])
+            if fingerprint:
+                await results.release(fingerprint, job['uuid'])
+            metrics.registry.inc("dreaming_jobs_enqueued_total", initiator=job.get("initiator"), outcome="rejected")
+            raise HTTPException(status_code=429, detail=f"Too many queued jobs, try again later ({e})")
+        metrics.registry.inc("dreaming_jobs_enqueued_total", initiator=job.get("initiator"), outcome="queued")
+        return job
+
+async def enqueueJobs(request: Request, jobs: list) -> list:
+    """ Store and queue many jobs in one transaction each. Jobs that may be
+        answered by the result cache go through enqueueJob one by one. Returns
+        every job, or an error in its place when its user has too many queued. """
+    done = {}
+    fresh = []
+    pendingCost = 0
+    for job in jobs:
+        dropServerFields(job)
+        await identify(request, job)
+        job['trace'] = tracing.newTrace()
+        try:
+            await storeInitImage(job)
+        except HTTPException as e:
+            done[job['uuid']] = {"uuid": job['uuid'], "error": e.detail}
+            continue
+
+        if results.fingerprint(job):
+            try:
+                done[job['uuid']] = await enqueueJob(request, job)
+            except HTTPException as e:
+                done[job['uuid']] = {"uuid": job['uuid'], "error": e.detail}
+            continue
+
+        if batch := resultCache.batchKey(job):
+            job['batch'] = batch
+        try:
+            # The jobs admitted before this one are going to be in front of it
+            await admit(job, pendingCost, len(fresh))
+        except HTTPException as e:
+            done[job['uuid']] = {"uuid": job['uuid'], "error": e.detail}
+            continue
+        pendingCost += job['cost']
+        fresh.append(job)
+
+    with tracing.span("enqueue.bulk", jobs=len(fresh)):
+        stored = await store.createMany(fresh, 12000)
+        added = await queue.pushMany(stored)
+
+    for job, ok in zip(stored, added):
+        if ok:
+            done[job['uuid']] = job
+        else:
+            await store.delete(job['uuid'])
+            done[job['uuid']] = {"uuid": job['uuid'], "error": "Too many queued jobs, try again later"}
+        metrics.registry.inc("dreaming_jobs_enqueued_total", initiator=job.get("initiator"),
+                             outcome="queued" if ok else "rejected")
+    return [done[job['uuid']] for job in jobs]
+
+async def uploadChunks(upload, size=65536):
+    """ Read an uploaded file in chunks, starlette keeps large ones on disk """
+    while chunk := await upload.read(size):
+        yield chunk
+
+@app.post("/initimg")
+async def upload_init_image(request: Request):
+    """ Upload an init image without base64, either as the raw request body or as
+        the initimg file of a multipart form. Returns the reference to send as
+        initimg, an image uploaded before returns the same one. """
+    if int(request.headers.get("content-length") or 0) > settings.initImages.max_size:
+        raise HTTPException(status_code=413, detail=f"Init images can't be larger than {settings.initImages.max_size} bytes")
+    try:
+        with metrics.timer("dreaming_initimg_save_seconds", kind="upload"):
+            if request.headers.get("content-type", "").startswith("multipart/form-data"):
+                async with request.form() as form:
+                    if not isinstance(upload := form.get("initimg"), UploadFile):
+                        raise HTTPException(status_code=400, detail="Send the init image as the initimg file of the form")
+                    reference = await initImages.save(uploadChunks(upload))
+            else:
+                reference = await initImages.save(request.stream())
+    except initImageStore.imageTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    return {"initimg": reference}
 
 def parseStringToBool(input: str) -> bool:
     if input == 'on':
@@ -256,15 +658,37 @@ async def do_dream(request: Request):
     
     job.update({"uuid": jobuuid, "initiator": "api", "event": "queued", "timestamp": time.time()})
     
-    await redis.setex(f"dreaming-job-{job['uuid']}", job, 12000)
-    await redis.lpush("sd-queue", job)
+    job = await enqueueJob(request, job)
     
-    job.update({"queuepos": await getJobPos(jobuuid)})
+    job.update({"queuepos": await getJobPos(job['uuid'])})
     return {"status": "OK", "uuid": job['uuid'], "job": job}
 
+@app.post("/jobs/batch")
+async def do_dream_batch(request: Request):
+    """ Queue many jobs at once, send a list of jobs (or {"jobs": [...]}) like /dream takes them.
+        Returns the uuid and queue position of every job, in the same order. """
+    jobs = await request.json()
+    if isinstance(jobs, dict):
+        jobs = jobs.get("jobs", [])
+    if not isinstance(jobs, list) or not all(isinstance(job, dict) for job in jobs):
+        raise HTTPException(status_code=400, detail="Expected a list of jobs")
+    if len(jobs) > settings.queue.max_batch:
+        raise HTTPException(status_code=400, detail=f"Can't queue more than {settings.queue.max_batch} jobs at once")
+
+    for job in jobs:
+        job.update({"uuid": str(uuid.uuid1()), "initiator": "api", "event": "queued", "timestamp": time.time()})
+    jobs = await enqueueJobs(request, jobs)
+
+    await costs.refresh()
+    positions = await queue.positions([job['uuid'] for job in jobs if job.get("event") == "queued"])
+    for job in jobs:
+        if job['uuid'] in positions:
+            job['queuepos'] = formatJobPos(*positions[job['uuid']])
+    return {"status": "OK", "jobs": jobs}
+
 # TODO refactor
 @app.post("/dreamSIMPLE", response_class=HTMLResponse)
-async def do_dreamSIMPLE(prompt: str = Form(), cfg_scale: str = Form(), steps: str = Form(), seed: str = Form(), 
+async def do_dreamSIMPLE(request: Request, prompt: str = Form(), cfg_scale: str = Form(), steps: str = Form(), seed: str = Form(), 
                          sampler_name: str = Form(), strength: str = Form(), gfpgan_strength: str = Form(), 
                          upscale_level: str = Form(), upscale_strength: str = Form()):
     fakejson = {}
@@ -283,10 +707,9 @@ async def do_dreamSIMPLE(prompt: str = Form(), cfg_scale: str = Form(), steps: s
     
     job.update({"uuid": jobuuid, "initiator": "api", "event": "queued", "timestamp": time.time()})
     
-    await redis.setex(f"dreaming-job-{job['uuid']}", job, 12000)
-    await redis.lpush("sd-queue", job)
+    job = await enqueueJob(request, job)
     
-    job.update({"queuepos": await getJobPos(jobuuid)})
+    job.update({"queuepos": await getJobPos(job['uuid'])})
     returntxt = """
         <a href="http://10.208.30.24:8000/job/jpg?uuid={0}">click in about 1 minute</a>
         <a href="http://10.208.30.24:8000/job/get?uuid={0}">or check on status here</a>
@@ -304,8 +727,7 @@ async def dreamStreaming(request: Request):
     if "progress_images" in job:
         job['progress_images'] = parseStringToBool(job['progress_images'])
 
-    await redis.setex(f"dreaming-job-{job['uuid']}", job, 12000)
-    await redis.lpush("sd-queue", job)
+    job = await enqueueJob(request, job)
     
     return StreamingResponse(interfaceStreamer(uuid=job['uuid']))
 
@@ -141,7 +141,9 @@ async function generateSubmit(form) {
                     document.getElementById("queued-message").style.display = "none";
                     progressEle.setAttribute('value', data.step);
                     progressTextEle.innerHTML = data.step +  "/" + totalSteps
-                    if (data.url) {
+                    if (data.preview) {
+                        progressImageEle.src = data.preview;
+                    } else if (data.url) {
                         progressImageEle.src = "job/image/intermediates?image=" + data.url;
                     }
                 } else if (data.event === 'canceled') {
@@ -173,11 +175,12 @@ async function generateSubmit(form) {
 async function processStatus() {
     const response = await fetch('/status');
     const status = await response.json();
-    const gpu = status.nvidia.nvidia_smi_log.gpu
+    const gpu = status.nvidia
     console.log(status);
     let statusSection = document.querySelector('#status-section');
     
-    updateString = "<span><i><b>GPU</b>: " + gpu.utilization.gpu_util + " ( " + gpu.temperature.gpu_temp + " / " + gpu.power_readings.power_draw + " )" 
+    updateString = "<span><i><b>GPU</b>: " 
+    updateString += gpu ? gpu.util + " % ( " + gpu.temp + " C / " + gpu.power + " W )" : "unknown"
     updateString += "<br><b>Queue size</b>: " + status.queuesize 
     statusSection.innerHTML = updateString + "</span>"
 }   
@@ -0,0 +1,57 @@
+""" The tests that need redis run against fakeredis, with lupa for the lua
+    scripts, instead of a redis server: pip install pytest "fakeredis[lua]" """
+import os
+import sys
+import asyncio
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+def importRedis():
+    """ The modules that import aioredis, aioredis 2.0.1 doesn't import on python 3.11+ """
+    pytest.importorskip("lupa")
+    fakeredis = pytest.importorskip("fakeredis")
+    try:
+        import api.redisClass as redisClass
+        import api.jobStore as jobStore
+    except (ImportError, TypeError) as e:
+        pytest.skip(f"aioredis can't be imported ({e})")
+    return fakeredis, redisClass, jobStore
+
+@pytest.fixture
+def redis():
+    """ A redisClass on a fresh fakeredis, which speaks the same asyncio API as aioredis """
+    fakeredis, redisClass, _ = importRedis()
+    redis = redisClass.redisClass()
+    redis.redis = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+    return redis
+
+@pytest.fixture
+def store(redis):
+    _, _, jobStore = importRedis()
+    return jobStore.jobStore(redis=redis)
+
+@pytest.fixture
+def api(redis, monkeypatch):
+    """ The dreamingapi module on fakeredis. Its startup doesn't run, so there
+        are no workers, no broadcaster and no background tasks. """
+    import logging.config # uvicorn imports it before dreamingapi needs it
+    pytest.importorskip("httpx")
+    monkeypatch.chdir(ROOT)
+    try:
+        import dreamingapi
+    except RuntimeError as e: # python-multipart, for the form of /dreamSIMPLE
+        pytest.skip(str(e))
+    monkeypatch.setattr(dreamingapi.redis, "redis", redis.redis)
+    run(dreamingapi.queue.init())
+    return dreamingapi
+
+def client(api):
+    """ An http client that talks to the app directly """
+    import httpx
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url="http://dreaming")
@@ -0,0 +1,179 @@
+import io
+import asyncio
+
+import pytest
+
+from PIL import Image
+
+import api.jobQueue as jobQueue
+import api.costModel as costModel
+import api.resultCache as resultCache
+import api.previewCache as previewCache
+import api.initImageStore as initImageStore
+import api.stableDiffusionComunicator as stableDiffusionComunicator
+
+from config import settings
+from conftest import run
+
+class stubCommunicator(stableDiffusionComunicator.communicator):
+    """ Answers every request like lstein's backend would, without one """
+
+    def __init__(self, steps=3):
+        super().__init__(url="http://backend/")
+        self.steps = steps
+        self.sent = []
+
+    async def stream(self, options):
+        self.sent.append(dict(options))
+        for step in range(1, self.steps + 1):
+            yield {"event": "step", "step": step, "url": None}
+        for iteration in range(options['iterations']):
+            yield {"event": "result", "url": f"outputs/img-samples/00000{iteration}.png", "seed": iteration}
+
+@pytest.fixture(autouse=True)
+def configure(monkeypatch):
+    monkeypatch.setattr(settings.reporting, "calculate_skin", False)
+    monkeypatch.setattr(settings.previews, "enabled", False)
+    monkeypatch.setattr(settings.workers, "min_update_interval", 0)
+    monkeypatch.setattr(settings.workers, "retry_backoff", 0.01)
+    monkeypatch.setattr(settings.queue, "block_timeout", 0.05)
+
+@pytest.fixture
+def worker(redis, store, tmp_path):
+    import api.backgroundWorker as backgroundWorker
+    worker = backgroundWorker.backendWorker(name="test", url="http://backend/", redis=redis, 
+                                            queue=jobQueue.jobQueue(redis=redis),
+                                            store=store, results=resultCache.resultCache(redis, store),
+                                            costs=costModel.costModel(redis),
+                                            initImages=initImageStore.initImageStore(str(tmp_path), 1024),
+                                            previews=previewCache.previewCache(redis, 8), skinPool=None)
+    worker.client = stubCommunicator()
+    return worker
+
+def job(uuid, **fields):
+    return dict({"uuid": uuid, "prompt": "a lighthouse", "steps": 3, "seed": 1, "initiator": "api",
+                 "user": "someone", "event": "queued"}, **fields)
+
+async def execute(worker, store, jobs):
+    for queued in jobs:
+        await store.create(queued, 600)
+    await worker.execute(jobs)
+    return [await store.get(queued['uuid']) for queued in jobs]
+
+def test_only_backend_options_are_sent(worker, store):
+    queued = job("a", cost=12.5, degraded=True, preview="job/preview?uuid=a&step=1", lane="low", batch="key")
+    saved, = run(execute(worker, store, [queued]))
+
+    assert saved['event'] == "done"
+    assert saved['result']['url'] == "outputs/img-samples/000000.png"
+    sent, = worker.client.sent
+    assert set(sent) <= stableDiffusionComunicator.OPTIONS
+    assert (sent['prompt'], sent['steps'], sent['seed']) == ("a lighthouse", 3, 1)
+
+def test_batch_gets_one_result_per_job(worker, store):
+    saved = run(execute(worker, store, [job("a", seed=1), job("b", seed=2)]))
+
+    assert worker.client.sent[0]['iterations'] == 2
+    assert [(done['event'], done['result']['seed']) for done in saved] == [("done", 0), ("done", 1)]
+
+def test_init_image_is_read_from_the_store(worker, store):
+    async def main():
+        reference = await worker.initImages.saveDataUrl("data:image/png;base64,iVBORw0KGgo=")
+        return await execute(worker, store, [job("a", initimg=reference)])
+
+    saved, = run(main())
+    assert saved['event'] == "done"
+    assert worker.client.sent[0]['initimg'] == "data:image/png;base64,iVBORw0KGgo="
+
+def test_missing_init_image_fails_the_job(worker, store):
+    saved, = run(execute(worker, store, [job("a", initimg="sha256:" + "0" * 64)]))
+
+    assert saved['event'] == "canceled"
+    assert saved['error']
+    assert worker.client.sent == []
+
+class paintingCommunicator(stubCommunicator):
+    """ Writes an intermediate image every step, as lstein does for progress_images """
+
+    def __init__(self, outputs, steps=3):
+        super().__init__(steps=steps)
+        self.outputs = outputs
+
+    async def stream(self, options):
+        async for line in super().stream(options):
+            if line['event'] == "step":
+                line['url'] = f"outputs/img-samples/intermediates/000000.{line['step']}.png"
+                Image.new("RGB", (512, 384), "red").save(self.outputs / "intermediates" / f"000000.{line['step']}.png")
+            yield line
+
+def test_only_the_newest_intermediate_becomes_a_preview(worker, store, monkeypatch, tmp_path):
+    (tmp_path / "intermediates").mkdir()
+    monkeypatch.setattr(settings.paths, "outputs", str(tmp_path))
+    monkeypatch.setattr(settings.previews, "enabled", True)
+    monkeypatch.setattr(settings.workers, "min_update_interval", 60)
+    worker.client = paintingCommunicator(tmp_path)
+    rendered = []
+    render = worker.previews.render
+    async def counting(path):
+        rendered.append(path.rsplit(".", 2)[1])
+        return await render(path)
+    monkeypatch.setattr(worker.previews, "render", counting)
+
+    async def main():
+        saved, = await execute(worker, store, [job("a", progress_images=True)])
+        return saved, await worker.previews.get("a")
+
+    saved, preview = run(main())
+    # The first step is written right away, the next ones only with the result
+    assert rendered == ["1", "3"]
+    assert saved['preview'] == "job/preview?uuid=a&step=3"
+    assert Image.open(io.BytesIO(preview)).size == (256, 192)
+    assert "a" not in worker.previews.entries # Only the redis copy outlives the job
+    assert not list((tmp_path / "intermediates").iterdir())
+
+def flaky(method, failures):
+    """ method, raising a connection error the first failures calls """
+    import aioredis
+    async def call(*args, **kwargs):
+        if failures:
+            failures.pop()
+            raise aioredis.ConnectionError("Connection reset by peer")
+        return await method(*args, **kwargs)
+    return call
+
+def test_worker_survives_redis_going_away(worker, store, monkeypatch):
+    monkeypatch.setattr(worker.queue, "take", flaky(worker.queue.take, [1, 1]))
+    monkeypatch.setattr(worker.queue, "finish", flaky(worker.queue.finish, [1]))
+
+    async def main():
+        await worker.queue.init()
+        task = asyncio.create_task(worker.workerTask())
+        saved = []
+        for uuid in ("a", "b"):
+            await store.create(job(uuid), 600)
+            await worker.queue.push(job(uuid))
+            while (await store.get(uuid))['event'] != "done":
+                await asyncio.sleep(0.01)
+            saved.append(await store.get(uuid))
+        while await worker.queue.inflight():
+            await asyncio.sleep(0.01)
+        task.cancel()
+        return saved, await worker.queue.inflight(), await worker.queue.length()
+
+    saved, inflight, length = run(asyncio.wait_for(main(), 10))
+    assert [done['event'] for done in saved] == ["done", "done"]
+    assert len(worker.client.sent) == 2
+    assert (inflight, length) == ({}, 0)
+
+def test_heartbeat_survives_redis_going_away(worker, monkeypatch):
+    monkeypatch.setattr(settings.workers, "heartbeat", 1)
+    monkeypatch.setattr(worker.redis, "setex", flaky(worker.redis.setex, [1, 1, 1]))
+
+    async def main():
+        task = asyncio.create_task(worker.heartbeatTask())
+        while not await worker.redis.get(worker.heartbeatKey):
+            await asyncio.sleep(0.01)
+        task.cancel()
+        return await worker.redis.redis.ttl(worker.heartbeatKey)
+
+    assert run(asyncio.wait_for(main(), 0.5)) in (2, 3)
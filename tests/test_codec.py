@@ -0,0 +1,32 @@
+import pytest
+
+import api.codec as codec
+
+JOB = {"uuid": "a", "prompt": "a lighthouse", "steps": 50, "result": {"url": "000001.1.png", "seed": 1.5}}
+
+def test_json_reads_json():
+    assert codec.jsonCodec().decode(codec.jsonCodec().encode(JOB).encode()) == JOB
+
+def test_orjson_and_json_read_each_other():
+    pytest.importorskip("orjson")
+    assert codec.jsonCodec().decode(codec.orjsonCodec().encode(JOB)) == JOB
+    assert codec.orjsonCodec().decode(codec.jsonCodec().encode(JOB).encode()) == JOB
+
+def test_every_codec_reads_msgpack():
+    pytest.importorskip("msgpack")
+    data = codec.msgpackCodec().encode(JOB)
+    assert data[:1] == codec.MSGPACK_MARKER
+    assert codec.jsonCodec().decode(data) == JOB
+    assert codec.msgpackCodec().decode(codec.jsonCodec().encode(JOB).encode()) == JOB
+    if codec.orjson:
+        assert codec.orjsonCodec().decode(data) == JOB
+
+def test_msgpack_value_without_msgpack(monkeypatch):
+    monkeypatch.setattr(codec, "msgpack", None)
+    with pytest.raises(ValueError):
+        codec.jsonCodec().decode(codec.MSGPACK_MARKER + b"\x80")
+
+def test_unavailable_codec_falls_back_on_json(monkeypatch):
+    monkeypatch.setattr(codec, "msgpack", None)
+    assert codec.createCodec("msgpack").name == "json"
+    assert codec.createCodec("json").name == "json"
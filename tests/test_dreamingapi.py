@@ -0,0 +1,156 @@
+import os
+import time
+
+import pytest
+
+import api.resultCache as resultCache
+
+from config import settings
+from conftest import run, client
+
+KITTEN = {"prompt": "a harmless kitten", "steps": 5, "seed": 1234}
+
+@pytest.fixture(autouse=True)
+def configure(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings.paths, "outputs", str(tmp_path))
+    monkeypatch.setattr(settings.resultCache, "enabled", True)
+    monkeypatch.setattr(settings.admission, "mode", "off")
+
+async def finish(api, uuid, url):
+    """ What a worker does with the result of a job """
+    job = await api.store.get(uuid)
+    if "fingerprint" in job:
+        await api.results.put(job['fingerprint'], {"url": url, "seed": job['seed']})
+        await api.results.release(job['fingerprint'], uuid)
+    await api.store.update(uuid, {"event": "done"})
+
+def test_forged_fingerprint_is_ignored(api, tmp_path):
+    # A random seed has no fingerprint, so one sent along would have been kept
+    forged = resultCache.optionsHash(KITTEN, random=False)
+
+    async def main():
+        async with client(api) as http:
+            nasty = (await http.post("/dream", json={"prompt": "something nasty", "steps": 5, "seed": -1,
+                                                     "fingerprint": forged, "cached": True})).json()
+            (tmp_path / "nasty.png").touch()
+            await finish(api, nasty['uuid'], "outputs/nasty.png")
+            kitten = (await http.post("/dream", json=KITTEN)).json()
+            return nasty['job'], kitten['job']
+
+    nasty, kitten = run(main())
+    assert "fingerprint" not in nasty and "cached" not in nasty
+    assert kitten['event'] == "queued"
+    assert kitten['fingerprint'] == forged
+
+def test_identical_job_gets_the_cached_result(api, tmp_path):
+    async def main():
+        async with client(api) as http:
+            first = (await http.post("/dream", json=KITTEN)).json()
+            (tmp_path / "kitten.png").touch()
+            await finish(api, first['uuid'], "outputs/kitten.png")
+            return (await http.post("/dream", json=KITTEN)).json()['job']
+
+    again = run(main())
+    assert again['cached'] is True
+    assert again['result']['url'] == "outputs/kitten.png"
+
+def test_jobs_are_scheduled_by_anonymized_address(api, monkeypatch):
+    async def main(proxies):
+        monkeypatch.setattr(settings.scheduler, "trusted_proxies", proxies)
+        async with client(api) as http:
+            return [(await http.post("/dream", json={"prompt": "a lighthouse", "user": "someone else"},
+                                     headers={"X-Forwarded-For": f"10.0.0.{host}"})).json()['job']
+                    for host in (1, 2, 1)]
+
+    direct = run(main([]))
+    assert len({job['user'] for job in direct}) == 1
+    assert direct[0]['user'] not in ("someone else", "127.0.0.1")
+
+    proxied = run(main(["127.0.0.1"]))
+    assert [job['user'] for job in proxied] == [proxied[0]['user'], proxied[1]['user'], proxied[0]['user']]
+    assert proxied[0]['user'] != proxied[1]['user']
+    assert not any(job['user'].startswith("10.0.0.") for job in proxied)
+
+def test_trusted_clients_name_their_user(api, monkeypatch):
+    monkeypatch.setattr(settings.scheduler, "trusted_tokens", {"secret": "discord"})
+
+    async def main():
+        async with client(api) as http:
+            return [(await http.post("/dream", json={"prompt": "a lighthouse", "user": "someone"},
+                                     headers={"X-Dreaming-Token": token})).json()['job'] for token in ("secret", "guess")]
+
+    trusted, guessed = run(main())
+    assert (trusted['initiator'], trusted['user']) == ("discord", "someone")
+    assert (guessed['initiator'], guessed['user']) != ("discord", "someone")
+
+def test_forged_batch_is_ignored(api, monkeypatch):
+    monkeypatch.setattr(settings.batching, "enabled", True)
+    other = resultCache.batchKey({"prompt": "someone else's prompt", "seed": -1})
+
+    async def main():
+        async with client(api) as http:
+            return [(await http.post("/dream", json=dict(fields, batch=other))).json()['job']
+                    for fields in (KITTEN, {"prompt": "a lighthouse", "seed": -1})]
+
+    fixed, random = run(main())
+    assert "batch" not in fixed
+    assert random['batch'] == resultCache.batchKey(random) != other
+
+def test_init_images_of_new_jobs_are_not_pruned(api, monkeypatch, tmp_path):
+    monkeypatch.setattr(api.initImages, "path", str(tmp_path / "initimg"))
+
+    async def main():
+        async with client(api) as http:
+            reference = (await http.post("/initimg", content=b"\x89PNG old image")).json()['initimg']
+            lastWeek = time.time() - 7 * 24 * 3600
+            os.utime(api.initImages.file(reference), (lastWeek, lastWeek))
+            await http.post("/dream", json={"prompt": "a lighthouse", "initimg": reference})
+            return reference
+
+    reference = run(main())
+    assert api.initImages.prune(maxAge=3600) == 0
+    assert os.path.exists(api.initImages.file(reference))
+
+def test_init_images_upload_as_multipart_form(api, monkeypatch, tmp_path):
+    monkeypatch.setattr(api.initImages, "path", str(tmp_path / "initimg"))
+
+    async def main():
+        async with client(api) as http:
+            raw = (await http.post("/initimg", content=b"\x89PNG an image")).json()
+            form = (await http.post("/initimg", files={"initimg": ("image.png", b"\x89PNG an image")})).json()
+            missing = await http.post("/initimg", files={"image": ("image.png", b"\x89PNG an image")})
+            return raw, form, missing.status_code
+
+    raw, form, missing = run(main())
+    assert form == raw
+    assert missing == 400
+    assert len(os.listdir(tmp_path / "initimg")) == 1
+
+def test_jobs_status_has_its_own_limit(api, monkeypatch):
+    monkeypatch.setattr(settings.queue, "max_status", 2)
+    monkeypatch.setattr(settings.streaming, "feed_max_uuids", 1)
+
+    async def main():
+        async with client(api) as http:
+            uuid = (await http.post("/dream", json=KITTEN)).json()['uuid']
+            found = (await http.get("/jobs/status", params={"uuid": [uuid, "missing"]})).json()
+            tooMany = await http.get("/jobs/status", params={"uuid": [uuid, "missing", "more"]})
+            return uuid, found, tooMany.status_code
+
+    uuid, found, tooMany = run(main())
+    assert found[uuid]['event'] == "queued" and found['missing'] is None
+    assert tooMany == 400
+
+def test_previews_are_served_from_redis_on_any_replica(api):
+    async def main():
+        async with client(api) as http:
+            missing = await http.get("/job/preview", params={"uuid": "a", "step": 1})
+            # What the worker of another replica wrote
+            await api.redis.redis.setex(api.previews.key("a"), 600, b"RIFF preview")
+            found = await http.get("/job/preview", params={"uuid": "a", "step": 2})
+            return missing, found
+
+    missing, found = run(main())
+    assert missing.status_code == 404
+    assert found.content == b"RIFF preview"
+    assert found.headers['content-type'] == api.previews.mediaType
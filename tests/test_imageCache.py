@@ -0,0 +1,90 @@
+import io
+import os
+import asyncio
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+import api.imageCache as imageCache
+
+from config import settings
+from conftest import run, client
+
+def writeImage(path, size=(64, 48), color="red"):
+    Image.new("RGB", size, color).save(path)
+    return str(path)
+
+@pytest.fixture
+def encodings(monkeypatch):
+    """ Counts how often images are encoded """
+    calls = []
+    encode = imageCache.encodeImage
+    def counting(path, *args):
+        calls.append(path)
+        return encode(path, *args)
+    monkeypatch.setattr(imageCache, "encodeImage", counting)
+    return calls
+
+def test_an_image_is_encoded_once_for_everyone_waiting(tmp_path, encodings):
+    path = writeImage(tmp_path / "image.png")
+
+    async def main():
+        cache = imageCache.imageCache(maxBytes=1 << 20)
+        first = await asyncio.gather(*[cache.get(path) for _ in range(10)])
+        return first, await cache.get(path), await cache.get(path, size=16)
+
+    first, again, thumbnail = run(main())
+    assert len(set(first)) == 1 and again == first[0]
+    assert encodings == [path, path]
+    assert Image.open(io.BytesIO(thumbnail)).size == (16, 12)
+
+def test_changed_images_are_encoded_again(tmp_path, encodings):
+    path = writeImage(tmp_path / "image.png")
+
+    async def main():
+        cache = imageCache.imageCache(maxBytes=1 << 20)
+        await cache.get(path)
+        writeImage(path, color="blue")
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1000))
+        await cache.get(path)
+
+    run(main())
+    assert len(encodings) == 2
+
+def test_least_recently_used_images_are_dropped(tmp_path):
+    paths = [writeImage(tmp_path / f"{index}.png") for index in range(3)]
+
+    async def main():
+        cache = imageCache.imageCache(maxBytes=1 << 20)
+        size = len(await cache.get(paths[0]))
+        cache = imageCache.imageCache(maxBytes=2 * size)
+        for path in (paths[0], paths[1], paths[0], paths[2]):
+            await cache.get(path)
+        return cache
+
+    cache = run(main())
+    assert [key[0] for key in cache.entries] == [paths[0], paths[2]]
+    assert cache.size <= cache.maxBytes
+
+def test_images_are_not_sent_again_when_unchanged(api, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings.paths, "outputs", str(tmp_path))
+    writeImage(tmp_path / "image.png")
+
+    async def main():
+        async with client(api) as http:
+            uuid = (await http.post("/dream", json={"prompt": "a lighthouse"})).json()['uuid']
+            await api.store.update(uuid, {"event": "done", "result": {"url": "outputs/image.png"}})
+            png = await http.get("/job/image", params={"uuid": uuid})
+            jpeg = await http.get("/job/image", params={"uuid": uuid, "jpeg": True})
+            again = await http.get("/job/image", params={"uuid": uuid}, headers={"If-None-Match": png.headers['etag']})
+            other = await http.get("/job/image", params={"uuid": uuid, "jpeg": True},
+                                   headers={"If-None-Match": png.headers['etag']})
+            return png, jpeg, again, other
+
+    png, jpeg, again, other = run(main())
+    assert png.status_code == 200 and png.headers['content-type'] == "image/png"
+    assert jpeg.headers['content-type'] == "image/jpeg" and jpeg.headers['etag'] != png.headers['etag']
+    assert again.status_code == 304 and again.content == b""
+    assert again.headers['etag'] == png.headers['etag']
+    assert other.status_code == 200 and other.content == jpeg.content
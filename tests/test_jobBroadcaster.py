@@ -0,0 +1,142 @@
+import json
+
+import pytest
+
+import api.jobBroadcaster as jobBroadcaster
+
+from config import settings
+from conftest import run, client
+
+QUEUE = jobBroadcaster.QUEUE_CHANNEL
+JOB = jobBroadcaster.JOB_CHANNEL
+
+@pytest.fixture(autouse=True)
+def configure(monkeypatch):
+    monkeypatch.setattr(settings.streaming, "mode", "pubsub")
+    monkeypatch.setattr(settings.admission, "mode", "off")
+
+def counting(calls):
+    async def annotate(jobs):
+        calls.append(dict(jobs))
+        return {uuid: {"jobpos": {"pos": index + 1}} for index, uuid in enumerate(jobs)}
+    return annotate
+
+def test_queue_update_is_annotated_once_for_every_stream():
+    async def main():
+        calls = []
+        broadcaster = jobBroadcaster.jobBroadcaster(redis=None, annotate=counting(calls))
+        streams = [broadcaster.subscribe(f"job{index % 5}") for index in range(20)]
+        await broadcaster.dispatch(QUEUE, {"length": 5})
+        return calls, [stream.get_nowait() for stream in streams]
+
+    calls, updates = run(main())
+    assert len(calls) == 1
+    assert calls[0] == {f"job{index}": None for index in range(5)}
+    assert updates[0] == {"event": "queue", "queue": {"length": 5}, "jobpos": {"pos": 1}}
+    assert updates[7]['jobpos'] == {"pos": 3}
+
+def test_job_update_is_annotated_with_the_last_event():
+    async def main():
+        calls = []
+        broadcaster = jobBroadcaster.jobBroadcaster(redis=None, annotate=counting(calls))
+        first, second = broadcaster.subscribe("job"), broadcaster.subscribe("job")
+        await broadcaster.dispatch(JOB + "job", {"event": "generating", "step": 1})
+        await broadcaster.dispatch(QUEUE, {"length": 0})
+        await broadcaster.dispatch(JOB + "other", {"event": "queued"})
+        return calls, first.get_nowait(), second.get_nowait()
+
+    calls, first, second = run(main())
+    assert calls == [{"job": {"event": "generating", "step": 1}}, {"job": {"event": "generating"}}]
+    assert first == second == {"event": "generating", "step": 1, "jobpos": {"pos": 1}}
+
+def test_updates_go_out_when_annotating_fails():
+    async def annotate(jobs):
+        raise ConnectionError("redis went away")
+
+    async def main():
+        broadcaster = jobBroadcaster.jobBroadcaster(redis=None, annotate=annotate)
+        stream = broadcaster.subscribe("job")
+        await broadcaster.dispatch(JOB + "job", {"event": "queued"})
+        return stream.get_nowait()
+
+    assert run(main()) == {"event": "queued"}
+
+def test_streams_look_up_positions_once_and_only_for_queued_jobs(api, monkeypatch):
+    calls = []
+    positions = api.queue.positions
+    async def counted(uuids):
+        calls.append(list(uuids))
+        return await positions(uuids)
+    monkeypatch.setattr(api.queue, "positions", counted)
+
+    async def main():
+        async with client(api) as http:
+            running, queued = [(await http.post("/dream", json={"prompt": f"a lighthouse {index}"})).json()['uuid']
+                               for index in range(2)]
+        await api.store.update(running, {"event": "generating"})
+        streams = [api.interfaceStreamer(uuid) for uuid in (running, queued) * 10]
+        for stream in streams:
+            await stream.__anext__()
+
+        calls.clear()
+        await api.broadcaster.dispatch(QUEUE, {"length": 1})
+        lines = [json.loads(await stream.__anext__()) for stream in streams]
+        for stream in streams:
+            await stream.aclose()
+        return running, queued, lines
+
+    running, queued, lines = run(main())
+    assert calls == [[queued]]
+    assert lines[0]['event'] == "step" and lines[0]['jobpos']['pos'] == 0
+    assert lines[1]['event'] == "queued" and lines[1]['jobpos']['pos'] == 2
+    assert not api.broadcaster.subscribers
+
+def test_feeds_get_the_updates_they_ask_for():
+    async def main():
+        broadcaster = jobBroadcaster.jobBroadcaster(redis=None)
+        watching = broadcaster.subscribeFeed(jobBroadcaster.feed(uuids=["a"]))
+        everything = broadcaster.subscribeFeed(jobBroadcaster.feed(everything=True, queueEvents=True))
+        await broadcaster.dispatch(JOB + "a", {"event": "queued", "uuid": "a"})
+        await broadcaster.dispatch(JOB + "b", {"event": "queued", "uuid": "b"})
+        await broadcaster.dispatch(QUEUE, {"event": "dequeued", "uuid": "a"})
+        return [[feed.get_nowait() for _ in range(feed.qsize())] for feed in (watching, everything)]
+
+    watching, everything = run(main())
+    assert watching == [{"event": "queued", "uuid": "a"}]
+    assert [update['event'] for update in everything] == ["queued", "queued", "queue"]
+
+def test_feeds_that_fall_behind_are_dropped(monkeypatch):
+    monkeypatch.setattr(settings.streaming, "feed_queue_size", 2)
+
+    async def main():
+        broadcaster = jobBroadcaster.jobBroadcaster(redis=None)
+        feed = broadcaster.subscribeFeed(jobBroadcaster.feed(everything=True))
+        for step in range(3):
+            await broadcaster.dispatch(JOB + "a", {"event": "generating", "step": step})
+        return feed, [feed.get_nowait() for _ in range(feed.qsize())], broadcaster.feeds
+
+    feed, updates, feeds = run(main())
+    assert feed.dropped and not feeds
+    assert updates == [{"event": "dropped"}]
+
+def test_event_feed_starts_with_the_jobs_and_streams_their_updates(api):
+    async def main():
+        async with client(api) as http:
+            uuid = (await http.post("/dream", json={"prompt": "a lighthouse"})).json()['uuid']
+        events = api.eventFeed(jobBroadcaster.feed(uuids=[uuid, "missing"]))
+        lines = [await events.__anext__(), await events.__anext__()]
+        await api.broadcaster.dispatch(JOB + uuid, {"event": "generating", "uuid": uuid, "step": 1})
+        lines.append(await events.__anext__())
+        for feed in list(api.broadcaster.feeds):
+            api.broadcaster.deliverFeed(feed, {"event": "dropped"})
+        lines.append(await events.__anext__())
+        with pytest.raises(StopAsyncIteration):
+            await events.__anext__()
+        return uuid, lines
+
+    uuid, lines = run(main())
+    kinds = [line.split("\n")[0] for line in lines]
+    assert kinds == ["event: job", "event: error", "event: job", "event: dropped"]
+    assert json.loads(lines[0].split("data: ")[1])['uuid'] == uuid
+    assert json.loads(lines[2].split("data: ")[1])['step'] == 1
+    assert not api.broadcaster.feeds
@@ -0,0 +1,219 @@
+import random
+
+import pytest
+
+import api.jobQueue as jobQueue
+
+from config import settings
+from conftest import run
+
+LANES = ["high", "normal", "low"]
+
+@pytest.fixture(autouse=True)
+def scheduler(monkeypatch):
+    monkeypatch.setattr(settings.scheduler, "lanes", LANES)
+    monkeypatch.setattr(settings.scheduler, "default_lane", "normal")
+    monkeypatch.setattr(settings.scheduler, "initiator_lanes", {"irc": "high"})
+    monkeypatch.setattr(settings.scheduler, "weights", {"discord": 2, "irc": 3})
+    monkeypatch.setattr(settings.scheduler, "max_queued_per_user", 0)
+    monkeypatch.setattr(settings.redisClient, "socket_timeout", 0)
+
+def job(uuid, initiator="api", user="someone", **fields):
+    return dict(fields, uuid=uuid, initiator=initiator, user=user, event="queued")
+
+async def createQueue(redis):
+    queue = jobQueue.jobQueue(redis=redis)
+    await queue.init()
+    return queue
+
+async def dispatch(queue, worker="worker"):
+    """ Take the next job without waiting for the ready list """
+    if job := await queue.dispatch(worker):
+        return job['uuid']
+    return None
+
+async def drain(queue, worker="drain"):
+    order = []
+    while uuid := await dispatch(queue, worker):
+        order.append(uuid)
+    return order
+
+def test_flows_take_turns_by_weight(redis):
+    async def main():
+        queue = await createQueue(redis)
+        for index in range(4):
+            await queue.push(job(f"a{index}", user="alice"))
+        for index in range(4):
+            await queue.push(job(f"b{index}", initiator="discord", user="bob"))
+        await queue.push(job("irc", initiator="irc", user="carol"))
+        return await drain(queue)
+
+    # The high lane goes first, then alice gets one job per turn and bob two
+    assert run(main()) == ["irc", "a0", "b0", "b1", "a1", "b2", "b3", "a2", "a3"]
+
+def test_list_is_in_dispatch_order(redis):
+    async def main():
+        queue = await createQueue(redis)
+        rng = random.Random(1)
+        for index in range(20):
+            await queue.push(job(f"j{index}", initiator=rng.choice(["api", "discord", "irc"]), user=rng.choice("xyz")))
+        await dispatch(queue) # Leave a flow halfway through its turn
+        listed = [queued['uuid'] for queued in await queue.list()]
+        return listed, await drain(queue)
+
+    listed, order = run(main())
+    assert listed == order
+
+def test_max_queued_per_user(redis, monkeypatch):
+    monkeypatch.setattr(settings.scheduler, "max_queued_per_user", 2)
+
+    async def main():
+        queue = await createQueue(redis)
+        await queue.push(job("a"))
+        await queue.push(job("b"))
+        with pytest.raises(jobQueue.queueLimitReached):
+            await queue.push(job("c"))
+        await queue.push(job("d", user="someone else"))
+        return await queue.length()
+
+    assert run(main()) == 3
+
+def test_positions_agree_with_dispatch(redis):
+    """ Random histories of pushes, front pushes (as recover does), removes
+        and dispatches. The ranks POSITION gives have to be the order DISPATCH
+        takes the jobs in, for one uuid at a time and for many at once. """
+    async def scenario(queue, rng, prefix):
+        uuids = []
+        for step in range(rng.randint(3, 25)):
+            action = rng.random()
+            if action < 0.55:
+                uuids.append(f"{prefix}-{step}")
+                await queue.push(job(uuids[-1], initiator=rng.choice(["api", "discord", "irc"]), user=rng.choice("xy")),
+                                 front=rng.random() < 0.3)
+            elif action < 0.65 and uuids:
+                await queue.remove(rng.choice(uuids))
+            else:
+                await dispatch(queue)
+
+        positions = await queue.positions(uuids)
+        single = {uuid: await queue.position(uuid) for uuid in uuids}
+        order = await drain(queue)
+        return positions, single, order
+
+    async def main():
+        queue = await createQueue(redis)
+        rng = random.Random(7)
+        for index in range(150):
+            positions, single, order = await scenario(queue, rng, f"s{index}")
+            assert positions == single
+            assert {uuid: rank for uuid, (rank, *_) in positions.items() if rank >= 0} == \
+                   {uuid: rank for rank, uuid in enumerate(order)}
+            assert all(length == len(order) for _, length, *_ in positions.values())
+
+    run(main())
+
+def test_position_costs(redis):
+    async def main():
+        queue = await createQueue(redis)
+        await queue.push(job("a", cost=10.5))
+        await queue.push(job("b", cost=2.25))
+        first = await queue.position("b")
+        await dispatch(queue)
+        return first, await queue.position("b"), await queue.position("missing"), await queue.totals()
+
+    first, second, missing, totals = run(main())
+    assert first == (1, 2, 0, 12.75, 2.25)
+    assert second == (0, 1, 1, 2.25, 2.25)
+    assert missing[0] == -1
+    assert totals == (1, 1, 2.25)
+
+def test_recover_puts_unfinished_jobs_back_in_front(redis):
+    async def main():
+        queue = await createQueue(redis)
+        for uuid in ("a", "b", "c", "d"):
+            await queue.push(job(uuid, cost=1))
+        await dispatch(queue, "crashed")
+        await dispatch(queue, "crashed")
+        inflight = await queue.inflight()
+
+        recovered = await queue.recover("crashed")
+        # Nothing is left to recover a second time
+        again = await queue.recover("crashed")
+        return inflight, recovered, again, await queue.inflight(), await queue.totals(), await drain(queue)
+
+    inflight, recovered, again, after, totals, order = run(main())
+    assert inflight == {"crashed": ["b"]}
+    assert (recovered, again) == (2, 0)
+    assert after == {}
+    assert totals == (4, 0, 4.0)
+    assert order == ["a", "b", "c", "d"]
+
+def test_claim_takes_jobs_of_the_same_batch(redis):
+    async def main():
+        queue = await createQueue(redis)
+        await queue.push(job("a", batch="same"))
+        await queue.push(job("b", user="other", batch="different"))
+        await queue.push(job("c", user="third", batch="same"))
+        await queue.push(job("d", batch="same"))
+        await dispatch(queue, "worker")
+        claimed = [claimed['uuid'] for claimed in await queue.claim("worker", "same", 4)]
+        return claimed, await queue.inflight(), await drain(queue)
+
+    claimed, inflight, order = run(main())
+    assert claimed == ["c", "d"]
+    assert inflight == {"worker": ["a", "c", "d"]}
+    assert order == ["b"]
+
+def test_remove(redis):
+    async def main():
+        queue = await createQueue(redis)
+        await queue.push(job("a", cost=3))
+        await queue.push(job("b", cost=4))
+        removed = await queue.remove("a"), await queue.remove("a")
+        return removed, await queue.totals(), await drain(queue)
+
+    removed, totals, order = run(main())
+    assert removed == (True, False)
+    assert totals == (1, 0, 4.0)
+    assert order == ["b"]
+
+def test_list_skips_jobs_taken_meanwhile(redis):
+    async def main():
+        queue = await createQueue(redis)
+        for uuid in ("a", "b"):
+            await queue.push(job(uuid))
+        # As if a worker took it between reading the jobs and the flows
+        await redis.redis.hdel(f"{queue.prefix}-jobs", "a")
+        return [job['uuid'] for job in await queue.list()]
+
+    assert run(main()) == ["b"]
+
+def test_every_key_of_the_queue_is_in_one_cluster_slot(redis):
+    async def main():
+        queue = await createQueue(redis)
+        await queue.push(job("a", batch="same"))
+        await queue.push(job("b", batch="same", user="someone else"))
+        await queue.push(job("c", initiator="irc"))
+        await dispatch(queue)
+        await queue.claim("worker", "same", 1)
+        return [key.decode() async for key in redis.redis.scan_iter()]
+
+    keys = run(main())
+    assert any("-flow-" in key for key in keys) and any("-processing-" in key for key in keys)
+    assert all(key.startswith("{sd-queue}-") for key in keys)
+
+def test_migrate_the_old_queue_and_its_jobs(redis, store):
+    async def main():
+        queue = await createQueue(redis)
+        for uuid in ("first", "second"):
+            # As the queue and the jobs used to be stored
+            await redis.setex(store.key(uuid), job(uuid, prompt=uuid), 12000)
+            await redis.lpush(queue.key, job(uuid, prompt=uuid))
+        await queue.migrate(store)
+        kinds = [await redis.redis.type(store.key(uuid)) for uuid in ("first", "second")]
+        return kinds, await redis.redis.type(queue.key), await drain(queue)
+
+    kinds, old, order = run(main())
+    assert kinds == [b"hash", b"hash"]
+    assert old == b"none"
+    assert order == ["first", "second"]
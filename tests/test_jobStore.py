@@ -0,0 +1,41 @@
+from conftest import run
+
+OLD = {"uuid": "old", "prompt": "a lighthouse", "event": "queued", "steps": 50, "initiator": "web"}
+
+def test_update_only_changes_the_given_fields(store):
+    async def main():
+        await store.create({"uuid": "a", "event": "queued", "steps": 50}, 600)
+        await store.update("a", {"event": "generating", "step": 3})
+        return await store.get("a"), await store.get("a", ["step", "missing"]), await store.get("b")
+
+    job, fields, missing = run(main())
+    assert job == {"uuid": "a", "event": "generating", "steps": 50, "step": 3}
+    assert fields == {"step": 3}
+    assert missing is None
+
+def test_jobs_stored_as_json_strings_are_converted(store):
+    async def main():
+        await store.redis.setex(store.key("old"), OLD, 12000)
+        await store.redis.redis.set(store.rawKey("old"), b"compressed")
+        before = await store.redis.redis.type(store.key("old"))
+
+        converted = await store.migrate(), await store.migrate()
+        # The worker can write to it now
+        await store.update("old", {"event": "done"}, 3000)
+        return before, converted, await store.get("old"), await store.redis.redis.get(store.rawKey("old"))
+
+    before, converted, after, raw = run(main())
+    assert before == b"string"
+    assert converted == (1, 0)
+    assert after == dict(OLD, event="done")
+    assert raw == b"compressed"
+
+def test_conversion_keeps_the_expiry(store):
+    async def main():
+        await store.redis.setex(store.key("old"), OLD, 12000)
+        await store.migrate(["old", "unknown"])
+        return await store.redis.redis.type(store.key("old")), await store.redis.redis.ttl(store.key("old"))
+
+    kind, ttl = run(main())
+    assert kind == b"hash"
+    assert 11990 < ttl <= 12000
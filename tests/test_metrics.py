@@ -0,0 +1,58 @@
+import pytest
+
+import api.metrics as metrics
+
+from config import settings
+from conftest import run, client
+
+@pytest.fixture(autouse=True)
+def configure(monkeypatch):
+    monkeypatch.setattr(settings.metrics, "enabled", True)
+    monkeypatch.setattr(settings.metrics, "buckets", [0.1, 1])
+
+def test_render_histogram_and_gauges():
+    registry = metrics.metricsRegistry()
+    registry.observe("dreaming_step_seconds", 0.5, backend="sd0")
+    registry.observe("dreaming_step_seconds", 2, backend="sd0")
+    values = {**registry.pending, "dreaming_jobs_inflight": 2, "dreaming_last_skin": 0.25}
+
+    assert registry.render(values).splitlines() == [
+        "# HELP dreaming_jobs_inflight Jobs being worked on",
+        "# TYPE dreaming_jobs_inflight gauge",
+        "dreaming_jobs_inflight 2",
+        "# HELP dreaming_last_skin Skin score of the last generated image",
+        "# TYPE dreaming_last_skin gauge",
+        "dreaming_last_skin 0.25",
+        "# HELP dreaming_step_seconds Time between two steps of the backend",
+        "# TYPE dreaming_step_seconds histogram",
+        'dreaming_step_seconds_bucket{backend="sd0",le="0.1"} 0',
+        'dreaming_step_seconds_bucket{backend="sd0",le="1"} 1',
+        'dreaming_step_seconds_bucket{backend="sd0",le="+Inf"} 2',
+        'dreaming_step_seconds_count{backend="sd0"} 2',
+        'dreaming_step_seconds_sum{backend="sd0"} 2.5',
+    ]
+
+def test_flush_adds_up_in_redis(redis):
+    async def main():
+        first, second = metrics.metricsRegistry(), metrics.metricsRegistry()
+        first.inc("dreaming_jobs_total", event="done")
+        second.inc("dreaming_jobs_total", event="done")
+        second.set("dreaming_last_charlen", 12)
+        await first.flush(redis)
+        await second.flush(redis)
+        return await first.read(redis)
+
+    assert run(main()) == {'dreaming_jobs_total{event="done"}': 2.0, "dreaming_last_charlen": 12.0}
+
+def test_metrics_endpoint_with_live_gauges(api):
+    async def main():
+        await api.queue.push({"uuid": "queued", "initiator": "api", "event": "queued"})
+        await api.redis.redis.hset(api.queue.inflightKey, "worker", "running")
+        async with client(api) as http:
+            return await http.get("/metrics")
+
+    response = run(main())
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert 'dreaming_queue_depth{lane="normal"} 1' in lines
+    assert "dreaming_jobs_inflight 1" in lines
@@ -0,0 +1,28 @@
+import pytest
+
+from api.stableDiffusionComunicator import readLines
+from conftest import run
+
+class chunkedStream():
+    """ Hands out the chunks it was given, like aiohttp's StreamReader.read """
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    async def read(self, size):
+        return self.chunks.pop(0)[:size] if self.chunks else b""
+
+async def collect(stream, **options):
+    return [line async for line in readLines(stream, **options)]
+
+def test_lines_split_over_chunks():
+    chunks = [b'{"event": "st', b'ep"}\n{"ev', b'ent": "result"}\n\n', b'{"a"', b': 1}\n']
+    assert run(collect(chunkedStream(chunks))) == \
+           [b'{"event": "step"}\n', b'{"event": "result"}\n', b"\n", b'{"a": 1}\n']
+
+def test_unterminated_tail_is_dropped():
+    assert run(collect(chunkedStream([b"one\ntw", b"o"]))) == [b"one\n"]
+
+def test_line_too_long():
+    with pytest.raises(ValueError):
+        run(collect(chunkedStream([b"x" * 8, b"x" * 8, b"\n"]), maxLineSize=12))
@@ -0,0 +1,39 @@
+import pytest
+
+import api.resultCache as resultCache
+
+from config import settings
+
+@pytest.fixture(autouse=True)
+def batching(monkeypatch):
+    monkeypatch.setattr(settings.batching, "enabled", True)
+
+JOB = {"prompt": "a lighthouse", "steps": 30, "width": 512, "seed": 42}
+
+def test_numbers_from_forms_and_json_hash_alike():
+    form = dict(JOB, steps="30", width="512", seed="42")
+    assert resultCache.optionsHash(form, random=False) == resultCache.optionsHash(JOB, random=False)
+
+def test_fixed_and_random_seeds():
+    assert resultCache.optionsHash(JOB, random=False)
+    assert resultCache.optionsHash(JOB, random=True) is None
+    assert resultCache.optionsHash(dict(JOB, seed=-1), random=False) is None
+    assert resultCache.optionsHash(dict(JOB, seed=-1), random=True) == \
+           resultCache.optionsHash(dict(JOB, seed="-1"), random=True)
+
+def test_our_own_fields_dont_change_the_hash():
+    ours = dict(JOB, uuid="a", cost=3.5, degraded=True, lane="low", progress_images=True)
+    assert resultCache.optionsHash(ours, random=False) == resultCache.optionsHash(JOB, random=False)
+    assert resultCache.optionsHash(dict(JOB, steps=31), random=False) != resultCache.optionsHash(JOB, random=False)
+    assert resultCache.optionsHash({"steps": 30}, random=False) is None
+
+def test_batch_key():
+    job = dict(JOB, seed=-1)
+    assert resultCache.batchKey(job) == resultCache.batchKey(dict(job, user="someone else"))
+    assert resultCache.batchKey(dict(job, steps=20)) != resultCache.batchKey(job)
+    assert resultCache.batchKey(dict(job, iterations=2)) is None
+    assert resultCache.batchKey(JOB) is None
+
+def test_no_batch_key_without_batching(monkeypatch):
+    monkeypatch.setattr(settings.batching, "enabled", False)
+    assert resultCache.batchKey(dict(JOB, seed=-1)) is None